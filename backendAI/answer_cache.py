@@ -0,0 +1,158 @@
+"""
+Semantic answer cache for the reader chat.
+
+Answers are grouped by book and page bucket (pages 1-10, 11-20, ...), so a
+cached answer never comes from a reader who was much further into the book.
+A lookup first tries the exact normalized question, then compares the
+question embedding against the other questions in the same bucket and
+accepts the best one above `threshold`. The embedding step only runs with a
+semantic embedder (MiniLM); the hashing fallback can't tell "who is X" from
+"who isn't X", so with it the cache matches exact questions only.
+
+Each book holds at most `per_book` answers (LRU), at most `max_books` books
+are kept (LRU), and entries expire after `ttl` seconds.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from embeddings import get_embedder
+from moderation_cache import normalize_comment
+from retrieval import normalize_title
+
+log = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Case, spacing and punctuation don't matter: "Who is Ahab?" == "who is ahab"."""
+    return " ".join(re.sub(r"[^\w ]+", " ", normalize_comment(question)).split())
+
+
+@dataclass
+class CachedAnswer:
+    vector: Optional[np.ndarray]
+    answer: str
+    stored_at: float
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        page_bucket: int = 10,
+        threshold: float = 0.92,
+        per_book: int = 200,
+        max_books: int = 500,
+        ttl: float = 24 * 3600,
+    ):
+        self.page_bucket = max(1, page_bucket)
+        self.threshold = threshold
+        self.per_book = per_book
+        self.max_books = max_books
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # book -> OrderedDict[(bucket, normalized question) -> CachedAnswer]
+        self._books: "OrderedDict[str, OrderedDict[Tuple[int, str], CachedAnswer]]" = OrderedDict()
+        self._semantic: Optional[bool] = None
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _bucket(self, page: int) -> int:
+        return (max(page, 1) - 1) // self.page_bucket
+
+    @property
+    def semantic(self) -> bool:
+        """Whether similar (not only identical) questions may share an answer."""
+        if self._semantic is None:
+            embedder = get_embedder()
+            self._semantic = embedder.semantic
+            if not self._semantic:
+                log.warning("answer cache matches exact questions only", extra={"embedder": embedder.name})
+        return self._semantic
+
+    def lookup(self, book_title: str, page: int, question: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        Returns (answer or None, question vector). The vector is None on an exact
+        hit and when the cache isn't semantic; otherwise pass it to store() to
+        avoid embedding the question twice.
+        """
+        book = normalize_title(book_title)
+        key = (self._bucket(page), normalize_question(question))
+        now = time.time()
+
+        with self._lock:
+            entries = self._books.get(book)
+            if entries is not None:
+                self._books.move_to_end(book)
+                hit = entries.get(key)
+                if hit is not None and now - hit.stored_at <= self.ttl:
+                    entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return hit.answer, None
+                candidates = [
+                    (k, e) for k, e in entries.items()
+                    if k[0] == key[0] and now - e.stored_at <= self.ttl
+                ]
+            else:
+                candidates = []
+
+        if not self.semantic:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        vector = get_embedder().encode([key[1]])[0]
+        if candidates:
+            scores = np.stack([e.vector for _, e in candidates]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                best_key, entry = candidates[best]
+                with self._lock:
+                    entries = self._books.get(book)
+                    if entries is not None and best_key in entries:
+                        entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                return entry.answer, vector
+
+        with self._lock:
+            self.misses += 1
+        return None, vector
+
+    def store(self, book_title: str, page: int, question: str, answer: str, vector: Optional[np.ndarray] = None) -> None:
+        book = normalize_title(book_title)
+        key = (self._bucket(page), normalize_question(question))
+        if vector is None and self.semantic:
+            vector = get_embedder().encode([key[1]])[0]
+        with self._lock:
+            entries = self._books.setdefault(book, OrderedDict())
+            self._books.move_to_end(book)
+            entries[key] = CachedAnswer(vector=vector, answer=answer, stored_at=time.time())
+            entries.move_to_end(key)
+            while len(entries) > self.per_book:
+                entries.popitem(last=False)
+            while len(self._books) > self.max_books:
+                self._books.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        with self._lock:
+            entries = sum(len(e) for e in self._books.values())
+            books = len(self._books)
+        return {
+            "books": books,
+            "entries": entries,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+            "semantic": self._semantic,
+            "threshold": self.threshold,
+            "page_bucket": self.page_bucket,
+        }
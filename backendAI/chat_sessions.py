@@ -0,0 +1,257 @@
+"""
+Server-side chat sessions for the reader assistant.
+
+A session keeps the most recent turns verbatim and folds older turns into a
+running summary, so the prompt stays bounded however long the reading
+session gets:
+
+    system prompt (+ passages) + summary  <= fixed
+    recent turns                          <= CHAT_HISTORY_TOKEN_BUDGET
+    summary                               <= CHAT_SUMMARY_TOKEN_BUDGET
+
+Folding is done by a caller-supplied async `summarize(summary, turns)`
+function (an LLM call in main.py) and runs after the reply is sent. If it
+fails, the turns are kept for the next attempt, up to 2 * recent_turns.
+Sessions live in an in-memory LRU, or in SQLite when a path is configured;
+the SQLite reads and writes run in a worker thread (aget/aput), never on
+the event loop.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from retrieval import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+Turn = Tuple[str, str]  # (user message, assistant reply)
+
+
+@dataclass
+class ChatSession:
+    session_id: str
+    book_title: str = ""
+    summary: str = ""
+    turns: List[Turn] = field(default_factory=list)
+    updated_at: float = field(default_factory=time.time)
+
+
+class MemorySessionStore:
+    def __init__(self, max_sessions: int = 5000):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def put(self, session: ChatSession) -> None:
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def aget(self, session_id: str) -> Optional[ChatSession]:
+        return self.get(session_id)
+
+    async def aput(self, session: ChatSession) -> None:
+        self.put(session)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(MemorySessionStore):
+    """Memory LRU for hot sessions, written through to SQLite so they survive restarts."""
+
+    def __init__(self, path: str, max_sessions: int = 5000):
+        super().__init__(max_sessions)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions (session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _load(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM chat_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        return ChatSession(**{**data, "turns": [tuple(t) for t in data["turns"]]})
+
+    def _write(self, session_id: str, data: str, updated_at: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions (session_id, data, updated_at) VALUES (?, ?, ?)",
+                (session_id, data, updated_at),
+            )
+            self._conn.commit()
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        session = super().get(session_id)
+        if session is not None:
+            return session
+        session = self._load(session_id)
+        if session is not None:
+            super().put(session)
+        return session
+
+    def put(self, session: ChatSession) -> None:
+        super().put(session)
+        self._write(session.session_id, json.dumps(asdict(session)), session.updated_at)
+
+    async def aget(self, session_id: str) -> Optional[ChatSession]:
+        session = super().get(session_id)
+        if session is not None:
+            return session
+        session = await asyncio.to_thread(self._load, session_id)
+        if session is not None:
+            super().put(session)
+        return session
+
+    async def aput(self, session: ChatSession) -> None:
+        super().put(session)
+        # Serialized here, so the thread never sees a session the loop is still changing
+        await asyncio.to_thread(self._write, session.session_id, json.dumps(asdict(session)), session.updated_at)
+
+
+def turn_tokens(turn: Turn) -> int:
+    return estimate_tokens(turn[0]) + estimate_tokens(turn[1])
+
+
+class SessionManager:
+    def __init__(
+        self,
+        store: MemorySessionStore,
+        summarize: Callable[[str, List[Turn]], Awaitable[str]],
+        recent_turns: int = 4,
+        history_token_budget: int = 800,
+        summary_token_budget: int = 200,
+    ):
+        self.store = store
+        self.summarize = summarize
+        self.recent_turns = recent_turns
+        self.history_token_budget = history_token_budget
+        self.summary_token_budget = summary_token_budget
+        # While summarizing keeps failing, older turns are dropped past this many
+        self.max_turns = 2 * recent_turns
+        # session_id -> [lock, holders]; an entry lives only while someone holds or awaits it
+        self._locks: Dict[str, List[Any]] = {}
+        self._folding: set = set()
+        self._tasks: set = set()
+        self.folds = 0
+        self.fold_failures = 0
+
+    @asynccontextmanager
+    async def _session_lock(self, session_id: str) -> AsyncIterator[None]:
+        entry = self._locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[session_id]
+
+    async def open(self, session_id: Optional[str], book_title: str) -> ChatSession:
+        """
+        Fetch a session, or start a new one. A reader who switched books gets a
+        new session under a new ID; the old one is left as it was.
+        """
+        session = await self.store.aget(session_id) if session_id else None
+        if session is None or session.book_title != book_title:
+            if session is not None:
+                session_id = None
+            session = ChatSession(session_id=session_id or uuid.uuid4().hex, book_title=book_title)
+            await self.store.aput(session)
+        return session
+
+    def history_messages(self, session: ChatSession) -> Tuple[str, List[dict]]:
+        """
+        Summary text for the system prompt, plus the newest turns as chat messages.
+        Turns that don't fit the history budget are left out (they are folded soon).
+        """
+        kept: List[Turn] = []
+        used = 0
+        for turn in reversed(session.turns[-self.recent_turns:]):
+            cost = turn_tokens(turn)
+            if used + cost > self.history_token_budget:
+                break
+            kept.append(turn)
+            used += cost
+        messages = []
+        for user, assistant in reversed(kept):
+            messages.append({"role": "user", "content": user})
+            messages.append({"role": "assistant", "content": assistant})
+        return session.summary, messages
+
+    async def record(self, session: ChatSession, user: str, assistant: str) -> None:
+        async with self._session_lock(session.session_id):
+            # Re-read: a fold may have stored a newer copy since open() returned `session`
+            current = await self.store.aget(session.session_id) or session
+            current.turns.append((user, assistant))
+            current.updated_at = time.time()
+            await self.store.aput(current)
+            needs_fold = len(current.turns) > self.recent_turns
+        if needs_fold and session.session_id not in self._folding:
+            task = asyncio.ensure_future(self._fold(session.session_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fold(self, session_id: str) -> None:
+        # The lock is held only around reads and writes, not the summarize call,
+        # so new turns are recorded meanwhile and kept by the write below
+        self._folding.add(session_id)
+        try:
+            async with self._session_lock(session_id):
+                session = await self.store.aget(session_id)
+                if session is None or len(session.turns) <= self.recent_turns:
+                    return
+                previous = session.summary
+                overflow = session.turns[:-self.recent_turns]
+            try:
+                # Hard cap, in case the model ignored the length instruction
+                summary = (await self.summarize(previous, overflow)).strip()[: self.summary_token_budget * 4]
+            except Exception as e:
+                log.warning("failed to summarize chat session", extra={"session_id": session_id, "error": str(e)})
+                summary = None
+                self.fold_failures += 1
+            async with self._session_lock(session_id):
+                session = await self.store.aget(session_id)
+                if session is None:
+                    return
+                if summary is not None and session.turns[:len(overflow)] == overflow:
+                    session.summary = summary
+                    session.turns = session.turns[len(overflow):]
+                    self.folds += 1
+                # Unfolded turns are retried next time, but never grow without bound
+                session.turns = session.turns[-self.max_turns:]
+                session.updated_at = time.time()
+                await self.store.aput(session)
+        finally:
+            self._folding.discard(session_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.store),
+            "folds": self.folds,
+            "fold_failures": self.fold_failures,
+            "recent_turns": self.recent_turns,
+            "history_token_budget": self.history_token_budget,
+            "summary_token_budget": self.summary_token_budget,
+        }
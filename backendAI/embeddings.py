@@ -0,0 +1,91 @@
+"""
+Text embedders used by retrieval.
+
+- "minilm": sentence-transformers all-MiniLM-L6-v2 (same model as
+  frontend/ai-suggestion/ingest.py). Only used if the package is installed.
+- "hashing": signed feature hashing of word unigrams and bigrams. Pure NumPy,
+  no model download, good enough for lexical passage lookup, but blind to
+  meaning ("who is X" and "who isn't X" score close), so it is not
+  `semantic`.
+
+EMBEDDING_BACKEND=auto (default) picks minilm when available, else hashing.
+Every embedder returns L2-normalized float32 rows, so dot product = cosine.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+from typing import List
+
+import numpy as np
+
+EMBEDDING_DIMENSION = 384
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+class HashingEmbedder:
+    name = "hashing-v1"
+    dimension = EMBEDDING_DIMENSION
+    semantic = False
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD_RE.findall(text.casefold())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                sign = 1.0 if digest >> 63 else -1.0
+                out[row, digest % self.dimension] += sign
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+
+class MiniLMEmbedder:
+    name = "all-MiniLM-L6-v2"
+    dimension = EMBEDDING_DIMENSION
+    semantic = True
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(self.name)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+_embedder = None
+# get_embedder() is also called from to_thread workers; the model must load only once
+_embedder_lock = threading.Lock()
+
+
+def embedder_loaded() -> bool:
+    return _embedder is not None
+
+
+def get_embedder():
+    """Process-wide embedder chosen by EMBEDDING_BACKEND (loaded on first call)."""
+    global _embedder
+    if _embedder is not None:
+        return _embedder
+
+    with _embedder_lock:
+        if _embedder is not None:
+            return _embedder
+        backend = os.getenv("EMBEDDING_BACKEND", "auto")
+        embedder = None
+        if backend in ("auto", "minilm"):
+            try:
+                embedder = MiniLMEmbedder()
+            except ImportError:
+                if backend == "minilm":
+                    raise
+        _embedder = embedder or HashingEmbedder()
+    logging.getLogger(__name__).info("using embedder", extra={"embedder": _embedder.name})
+    return _embedder
@@ -0,0 +1,297 @@
+"""
+Content-addressed disk cache in front of the image generator.
+
+Images are keyed by sha256("<width>x<height>\\n<enhanced prompt>"), so the
+same prompt for the same book and page maps to one file however many
+readers ask for it. Each key is fetched from the upstream at most once:
+concurrent misses share one fetch (SingleFlight), and the bytes are written
+atomically to `<root>/<key[:2]>/<key>` with a small JSON sidecar holding the
+content type and a strong ETag (hash of the bytes).
+
+The cache is bounded by total size. Least recently served files are deleted
+first; recency survives restarts through the files' mtimes. The files of
+earlier runs are indexed by `load_index()` (a directory walk, done in the
+background after startup); until then lookups check the disk key by key.
+
+Upstreams are pluggable (see `open_upstream`):
+    pollinations        https://image.pollinations.ai (free, no API key)
+    http(s)://host      any server with the same /prompt/<text>?width=&height= API
+    stub[:<delay ms>]   deterministic solid-colour PNGs generated locally, for tests
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import struct
+import time
+import urllib.parse
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from singleflight import SingleFlight
+from telemetry import counter, histogram
+
+IMAGE_REQUESTS = counter("image_cache_requests_total", "Image lookups, by outcome (hit/miss)", ["outcome"])
+IMAGE_FETCH_SECONDS = histogram("image_upstream_seconds", "Image upstream fetch time, by outcome", ["outcome"])
+
+
+KEY_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def image_key(prompt: str, width: int, height: int) -> str:
+    return hashlib.sha256(f"{width}x{height}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+def is_image_key(key: str) -> bool:
+    """Whether `key` could have come from image_key(); anything else must not reach a disk path."""
+    return KEY_PATTERN.fullmatch(key) is not None
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match semantics: `*`, or any listed tag equal to `etag` (weak comparison)."""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+# --- Upstreams ---
+
+class ImageUpstream:
+    name = "base"
+
+    async def fetch(self, prompt: str, width: int, height: int) -> Tuple[bytes, str]:
+        """(image bytes, content type)."""
+        raise NotImplementedError
+
+
+class PollinationsUpstream(ImageUpstream):
+    name = "pollinations"
+
+    def __init__(self, base_url: str = "https://image.pollinations.ai", timeout: float = 90, max_bytes: int = 16 << 20):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._client = None
+
+    def url(self, prompt: str, width: int, height: int) -> str:
+        encoded_prompt = urllib.parse.quote(prompt)
+        return f"{self.base_url}/prompt/{encoded_prompt}?width={width}&height={height}&nologo=true&enhance=true"
+
+    async def fetch(self, prompt: str, width: int, height: int) -> Tuple[bytes, str]:
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=True)
+        response = await self._client.get(self.url(prompt, width, height))
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip()
+        if not content_type.startswith("image/"):
+            raise ValueError(f"Upstream returned {content_type or 'no content type'}, not an image")
+        if len(response.content) > self.max_bytes:
+            raise ValueError(f"Upstream image is {len(response.content)} bytes, over the {self.max_bytes} limit")
+        return response.content, content_type
+
+
+class StubUpstream(ImageUpstream):
+    """Solid-colour PNG whose colour is derived from the prompt; `delay` simulates generation time."""
+    name = "stub"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+
+    async def fetch(self, prompt: str, width: int, height: int) -> Tuple[bytes, str]:
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        rgb = hashlib.sha256(prompt.encode("utf-8")).digest()[:3]
+        row = b"\x00" + rgb * width
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+        png = (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b"")
+        )
+        return png, "image/png"
+
+
+def open_upstream(spec: str) -> ImageUpstream:
+    """`pollinations`, an http(s) base URL, or `stub[:<delay ms>]`."""
+    if spec == "pollinations":
+        return PollinationsUpstream()
+    if spec.startswith(("http://", "https://")):
+        return PollinationsUpstream(base_url=spec)
+    if spec == "stub" or spec.startswith("stub:"):
+        _, _, delay_ms = spec.partition(":")
+        return StubUpstream(delay=float(delay_ms or 0) / 1000)
+    raise ValueError(f"Unknown image upstream: {spec}")
+
+
+# --- Cache ---
+
+@dataclass
+class CachedImage:
+    path: str
+    content_type: str
+    etag: str
+    size: int
+
+
+class ImageCache:
+    def __init__(self, root: str, upstream: ImageUpstream, max_bytes: int = 512 << 20):
+        self.root = root
+        self.upstream = upstream
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self._flight = SingleFlight(key_fn=lambda key, *args: key)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetch_errors = 0
+        self.evictions = 0
+        self.indexed = False
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        data = os.path.join(self.root, key[:2], key)
+        return data, data + ".json"
+
+    def _read_entry(self, key: str) -> Optional[Tuple[float, CachedImage]]:
+        """(mtime, entry) for a file written by an earlier run, or None."""
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            stat = os.stat(data_path)
+        except (OSError, ValueError):
+            return None
+        return stat.st_mtime, CachedImage(data_path, meta["content_type"], meta["etag"], stat.st_size)
+
+    def _scan(self) -> List[Tuple[float, str, CachedImage]]:
+        found = []
+        for _, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(".json"):
+                    key = name[:-len(".json")]
+                    read = self._read_entry(key)
+                    if read is not None:
+                        found.append((read[0], key, read[1]))
+        return found
+
+    async def load_index(self) -> int:
+        """
+        Picks up the files of earlier runs as older than anything served since
+        startup, least recently served first. Returns how many were added.
+        """
+        found = await asyncio.to_thread(self._scan)
+        added = 0
+        for _, key, entry in sorted(found, key=lambda item: item[0], reverse=True):
+            if key in self._entries:
+                continue
+            self._entries[key] = entry
+            self._entries.move_to_end(key, last=False)
+            self.total_bytes += entry.size
+            added += 1
+        self.indexed = True
+        self._evict()
+        return added
+
+    async def peek(self, key: str) -> Optional[CachedImage]:
+        entry = self._entries.get(key)
+        if entry is None and not self.indexed:
+            read = await asyncio.to_thread(self._read_entry, key)
+            # load_index() or a fetch may have added it while the read ran
+            entry = self._entries.get(key)
+            if entry is None and read is not None:
+                entry = self._entries[key] = read[1]
+                self.total_bytes += entry.size
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    async def get(self, key: str, prompt: str, width: int, height: int) -> CachedImage:
+        """The cached image for `key`, fetching it from the upstream first if needed."""
+        entry = await self.peek(key)
+        if entry is not None:
+            self.hits += 1
+            IMAGE_REQUESTS.inc(outcome="hit")
+            # Recency for the next restart's index; cheap enough per hit
+            await asyncio.to_thread(_touch, entry.path)
+            return entry
+        self.misses += 1
+        IMAGE_REQUESTS.inc(outcome="miss")
+        return await self._flight.run(self._fetch, key, prompt, width, height)
+
+    async def _fetch(self, key: str, prompt: str, width: int, height: int) -> CachedImage:
+        start = time.perf_counter()
+        try:
+            content, content_type = await self.upstream.fetch(prompt, width, height)
+        except Exception:
+            self.fetch_errors += 1
+            IMAGE_FETCH_SECONDS.observe(time.perf_counter() - start, outcome="error")
+            raise
+        IMAGE_FETCH_SECONDS.observe(time.perf_counter() - start, outcome="ok")
+        entry = await asyncio.to_thread(self._store, key, content, content_type)
+        # load_index() may have indexed this key while the fetch ran; don't count it twice
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= previous.size
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        self._evict()
+        return entry
+
+    def _store(self, key: str, content: bytes, content_type: str) -> CachedImage:
+        data_path, meta_path = self._paths(key)
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+        for path, payload in ((data_path, content), (meta_path, json.dumps({"content_type": content_type, "etag": etag}).encode())):
+            tmp = f"{path}.tmp-{os.getpid()}"
+            with open(tmp, "wb") as f:
+                f.write(payload)
+            os.replace(tmp, path)
+        return CachedImage(data_path, content_type, etag, len(content))
+
+    def _evict(self) -> None:
+        # The most recent entry always stays, even if it alone is over the limit
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "upstream": self.upstream.name,
+            "indexed": self.indexed,
+            "images": len(self._entries),
+            "size_mb": round(self.total_bytes / (1 << 20), 2),
+            "max_mb": round(self.max_bytes / (1 << 20), 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "fetch_errors": self.fetch_errors,
+            "evictions": self.evictions,
+            "single_flight": self._flight.stats(),
+        }
+
+
+def _touch(path: str) -> None:
+    try:
+        os.utime(path)
+    except OSError:
+        pass
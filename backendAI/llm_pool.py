@@ -0,0 +1,465 @@
+"""
+Quota-aware, prioritized pool for Groq chat completions.
+
+All endpoints share one AsyncGroq client, created on first use so the
+groq SDK (and httpx under it) stays off the import path, and one Groq
+quota. Calls wait in a single queue and start when three things allow it:
+
+    concurrency   at most `max_concurrency` completions in flight
+    RPM / TPM     token buckets refilled continuously at the account's limits;
+                  a call costs one request and its estimated tokens (prompt
+                  estimate + max_tokens), corrected with the real usage after
+    priority      strictly by class, then arrival: moderation, chat, background;
+                  lower classes also leave `headroom` (a share of each bucket)
+                  unused, so a burst of moderation finds quota left
+
+A call that could not start within its class's `max_wait` is refused with
+LLMRateLimited (with a Retry-After estimate) instead of queueing longer;
+when the buckets already show the wait will be too long it is refused
+right away. If Groq answers 429 anyway, dispatch pauses for its Retry-After
+(or an exponential backoff), the refill rate is halved and then recovers
+5% per successful call, and the call is retried while its deadline allows.
+
+The pool keeps simple counters (queue depth, wait time, in-flight calls) so
+workers can be sized. Latency, token usage and errors per endpoint go to
+/metrics (telemetry.py).
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from telemetry import counter, histogram
+
+LLM_SECONDS = histogram("llm_request_seconds", "Groq call latency after queueing, by endpoint", ["endpoint", "outcome"])
+LLM_QUEUE_SECONDS = histogram("llm_queue_seconds", "Time waiting for a free Groq slot", ["endpoint"])
+LLM_FIRST_TOKEN_SECONDS = histogram("llm_first_token_seconds", "Time to the first streamed token", ["endpoint"])
+LLM_TOKENS = counter("llm_tokens_total", "Tokens reported by Groq, by endpoint and direction (in/out)", ["endpoint", "direction"])
+LLM_ERRORS = counter("llm_errors_total", "Failed Groq calls, by endpoint and exception type", ["endpoint", "error"])
+LLM_REFUSED = counter("llm_refused_total", "Calls refused before reaching Groq, by endpoint and reason (estimate/deadline)",
+                      ["endpoint", "reason"])
+LLM_UPSTREAM_429 = counter("llm_upstream_rate_limited_total", "429s from Groq, by endpoint", ["endpoint"])
+
+# Priority classes; lower runs first
+MODERATION, CHAT, BACKGROUND = 0, 1, 2
+PRIORITY_NAMES = {MODERATION: "moderation", CHAT: "chat", BACKGROUND: "background"}
+
+DEFAULT_MAX_TOKENS = 1024  # completion estimate for calls that do not set max_tokens
+UPSTREAM_ATTEMPTS = 3
+MIN_RATE_FACTOR = 0.1
+MAX_BACKOFF_SECONDS = 60.0
+
+
+class LLMRateLimited(Exception):
+    """The call did not get a slot within its deadline; try again after `retry_after` seconds."""
+
+    def __init__(self, endpoint: str, retry_after: float, reason: str):
+        super().__init__(f"LLM quota exhausted for {endpoint} ({reason}); retry after {retry_after:.1f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def _count_tokens(endpoint: str, usage: Any) -> None:
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, endpoint=endpoint, direction="in")
+    LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, endpoint=endpoint, direction="out")
+
+
+def estimate_cost(kwargs: Dict[str, Any]) -> int:
+    """Tokens a completion counts against TPM: ~4 characters per prompt token, plus max_tokens."""
+    prompt = sum(len(m.get("content") or "") // 4 + 4 for m in kwargs.get("messages", []))
+    return prompt + int(kwargs.get("max_tokens") or DEFAULT_MAX_TOKENS)
+
+
+def upstream_retry_after(error: Exception) -> Optional[float]:
+    """
+    For a 429 from Groq: its Retry-After in seconds (0 if it sent none).
+    None for any other error.
+    """
+    if getattr(error, "status_code", None) != 429:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("retry-after", 0)))
+    except ValueError:
+        return 0.0
+
+
+class TokenBucket:
+    """`per_minute` units, refilled continuously; 0 means unlimited."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def refill(self, now: float, factor: float) -> None:
+        if self.enabled:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60 * factor)
+        self.updated = now
+
+    def seconds_until(self, amount: float, factor: float, headroom: float = 0.0) -> float:
+        """How long until `amount` units are available with `headroom` (a share of capacity) to spare (after refill())."""
+        if not self.enabled:
+            return 0.0
+        # A call larger than the whole bucket waits for a full bucket only
+        missing = min(amount + headroom * self.capacity, self.capacity) - self.level
+        return max(0.0, missing / (self.capacity / 60 * factor))
+
+    def take(self, amount: float) -> None:
+        if self.enabled:
+            self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount: float) -> None:
+        if self.enabled:
+            self.level = min(self.capacity, self.level + amount)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    endpoint: str = field(compare=False)
+    cost: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class LLMPool:
+    """
+    Runs chat completions on an AsyncGroq client under a concurrency cap and
+    the account's RPM/TPM limits. `client_factory` is called once, on the
+    first call or on warm_up(). `priorities` maps endpoint labels to
+    MODERATION/CHAT/BACKGROUND (unlisted labels are BACKGROUND), `max_wait`
+    each class to its queueing deadline in seconds, and `headroom` each class
+    to the share of the RPM/TPM buckets it must leave for the classes above.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        max_concurrency: int = 8,
+        rpm: float = 0,
+        tpm: float = 0,
+        priorities: Optional[Dict[str, int]] = None,
+        max_wait: Optional[Dict[int, float]] = None,
+        headroom: Optional[Dict[int, float]] = None,
+    ):
+        self._client_factory = client_factory
+        self._client = None
+        self.max_concurrency = max(1, max_concurrency)
+        self.priorities = priorities or {}
+        self.max_wait_by_class = {MODERATION: 10.0, CHAT: 8.0, BACKGROUND: 60.0, **(max_wait or {})}
+        self.headroom = {MODERATION: 0.0, CHAT: 0.1, BACKGROUND: 0.25, **(headroom or {})}
+
+        # Scheduler state
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.rate_factor = 1.0
+        self.paused_until = 0.0
+        self.backoff = 0.0
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        # Counters exposed through stats()
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.refused = 0
+        self.upstream_rate_limited = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.by_endpoint: Dict[str, int] = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    @client.setter
+    def client(self, client) -> None:
+        self._client = client
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None
+
+    async def warm_up(self) -> None:
+        """
+        Creates the client and opens a connection to Groq (GET /models, which
+        costs no tokens), so the first completion skips the TCP/TLS handshake.
+        """
+        await self.client.models.list()
+
+    # --- Scheduling ---
+
+    def _refill(self, now: float) -> None:
+        self.requests.refill(now, self.rate_factor)
+        self.tokens.refill(now, self.rate_factor)
+
+    def _seconds_until_fits(self, priority: int, requests: float, tokens: float, now: float) -> float:
+        headroom = self.headroom.get(priority, 0.0)
+        return max(
+            self.paused_until - now,
+            self.requests.seconds_until(requests, self.rate_factor, headroom),
+            self.tokens.seconds_until(tokens, self.rate_factor, headroom),
+        )
+
+    def estimate_wait(self, priority: int, cost: int) -> float:
+        """Seconds until the quota covers everything queued at or above `priority`, plus `cost`."""
+        now = time.monotonic()
+        self._refill(now)
+        ahead = [w for w in self._queue if w.priority <= priority and not w.future.done()]
+        return self._seconds_until_fits(priority, len(ahead) + 1, sum(w.cost for w in ahead) + cost, now)
+
+    def _dispatch(self) -> None:
+        """Starts queued calls, best first, while slots and quota last; else re-arms the timer."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._queue and self._running < self.max_concurrency:
+            head = self._queue[0]
+            if head.future.done():
+                # Timed out or cancelled while queued
+                heapq.heappop(self._queue)
+                continue
+            delay = self._seconds_until_fits(head.priority, 1, head.cost, now)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(head.cost)
+            self._running += 1
+            head.future.set_result(None)
+
+    def _release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+
+    async def _acquire(self, endpoint: str, cost: int, deadline: float, seq: int) -> None:
+        """Waits for a slot and quota until `deadline` (monotonic); raises LLMRateLimited past it."""
+        priority = self.priorities.get(endpoint, BACKGROUND)
+        estimate = self.estimate_wait(priority, cost)
+        if time.monotonic() + estimate > deadline:
+            self._refuse(endpoint, "estimate")
+            raise LLMRateLimited(endpoint, estimate, "estimate")
+
+        waiter = _Waiter(priority, seq, endpoint, cost, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, waiter)
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            self._dispatch()
+            # Not wait_for: on 3.11 it swallows a cancellation that races with the grant
+            done, _ = await asyncio.wait({waiter.future}, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just before the caller went away: hand the slot and quota back
+                self.requests.give_back(1)
+                self.tokens.give_back(cost)
+                self._release()
+            else:
+                waiter.future.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+        if not done:
+            # A grant that lands between the timeout and this check is kept and used
+            waiter.future.cancel()
+            self._refuse(endpoint, "deadline")
+            raise LLMRateLimited(endpoint, self.estimate_wait(priority, cost), "deadline")
+
+        waited = time.perf_counter() - queued_at
+        LLM_QUEUE_SECONDS.observe(waited, endpoint=endpoint)
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    def _refuse(self, endpoint: str, reason: str) -> None:
+        self.refused += 1
+        LLM_REFUSED.inc(endpoint=endpoint, reason=reason)
+
+    def _deadline(self, endpoint: str) -> float:
+        return time.monotonic() + self.max_wait_by_class[self.priorities.get(endpoint, BACKGROUND)]
+
+    def _on_upstream_429(self, endpoint: str, retry_after: float) -> None:
+        """Pause dispatch and halve the refill rate; the buckets start empty again."""
+        self.upstream_rate_limited += 1
+        LLM_UPSTREAM_429.inc(endpoint=endpoint)
+        self.backoff = min(MAX_BACKOFF_SECONDS, self.backoff * 2 or 1.0)
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + (retry_after or self.backoff))
+        self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor / 2)
+        self._refill(now)
+        self.requests.level = min(self.requests.level, 0.0)
+        self.tokens.level = min(self.tokens.level, 0.0)
+
+    def _on_success(self, cost: int, usage: Any) -> None:
+        self.backoff = 0.0
+        self.rate_factor = min(1.0, self.rate_factor + 0.05)
+        total = getattr(usage, "total_tokens", None)
+        if total is not None and total < cost:
+            self.tokens.give_back(cost - total)
+
+    def _retry_or_raise(self, endpoint: str, error: Exception, attempt: int, deadline: float) -> None:
+        """After a failed call: returns if it should be retried, else raises."""
+        retry_after = upstream_retry_after(error)
+        if retry_after is None:
+            raise error
+        self._on_upstream_429(endpoint, retry_after)
+        if attempt + 1 >= UPSTREAM_ATTEMPTS or self.paused_until > deadline:
+            raise LLMRateLimited(endpoint, self.paused_until - time.monotonic(), "upstream") from error
+        self.retries += 1
+
+    # --- Calls ---
+
+    async def complete(self, endpoint: str, **kwargs: Any):
+        """
+        Wait for a slot and quota, then await `client.chat.completions.create(**kwargs)`.
+        `endpoint` labels the call in the stats and picks its priority class.
+        """
+        cost = estimate_cost(kwargs)
+        deadline = self._deadline(endpoint)
+        seq = next(self._seq)
+        for attempt in itertools.count():
+            await self._acquire(endpoint, cost, deadline, seq)
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+                self.completed += 1
+                LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="ok")
+                usage = getattr(response, "usage", None)
+                _count_tokens(endpoint, usage)
+                self._on_success(cost, usage)
+                return response
+            except Exception as e:
+                self.failed += 1
+                LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="error")
+                LLM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                self._retry_or_raise(endpoint, e, attempt, deadline)
+            finally:
+                self.in_flight -= 1
+                self._release()
+
+    async def stream(self, endpoint: str, **kwargs: Any) -> AsyncIterator[str]:
+        """
+        Streaming variant of complete(): yields content deltas as they arrive.
+        The slot is held until the stream finishes. Closing the generator early
+        (e.g. the client disconnected) closes the upstream HTTP stream too.
+        A 429 can only come before the first chunk, so only then is it retried.
+        """
+        cost = estimate_cost(kwargs)
+        deadline = self._deadline(endpoint)
+        seq = next(self._seq)
+        attempt = 0
+        while True:
+            await self._acquire(endpoint, cost, deadline, seq)
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                upstream = await self.client.chat.completions.create(stream=True, **kwargs)
+                break
+            except Exception as e:
+                self.failed += 1
+                LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="error")
+                LLM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                self.in_flight -= 1
+                self._release()
+                self._retry_or_raise(endpoint, e, attempt, deadline)
+                attempt += 1
+            except BaseException:
+                self.in_flight -= 1
+                self._release()
+                raise
+
+        finished = False
+        first_token = True
+        usage = None
+        try:
+            async for chunk in upstream:
+                # Groq reports usage on the last chunk
+                chunk_usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+                if chunk_usage is not None:
+                    usage = chunk_usage
+                    _count_tokens(endpoint, usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token:
+                        first_token = False
+                        LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+                    yield delta
+            finished = True
+            self.completed += 1
+            LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="ok")
+            self._on_success(cost, usage)
+        except Exception as e:
+            finished = True
+            self.failed += 1
+            LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="error")
+            LLM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            if not finished:
+                self.cancelled += 1
+                LLM_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint, outcome="cancelled")
+            await upstream.close()
+            self.in_flight -= 1
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        started = self.completed + self.failed + self.cancelled + self.in_flight
+        now = time.monotonic()
+        self._refill(now)
+        queued: Dict[str, int] = {}
+        for waiter in self._queue:
+            if not waiter.future.done():
+                name = PRIORITY_NAMES.get(waiter.priority, str(waiter.priority))
+                queued[name] = queued.get(name, 0) + 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "connected": self.connected,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "queued_by_priority": queued,
+            "peak_queue_depth": self.peak_waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "calls_by_endpoint": dict(self.by_endpoint),
+            "quota": {
+                "rpm": self.requests.capacity or None,
+                "tpm": self.tokens.capacity or None,
+                "requests_available": round(self.requests.level, 2) if self.requests.enabled else None,
+                "tokens_available": round(self.tokens.level) if self.tokens.enabled else None,
+                "rate_factor": round(self.rate_factor, 3),
+                "paused_for_s": round(max(0.0, self.paused_until - now), 3),
+                "max_wait_s": {PRIORITY_NAMES[k]: v for k, v in self.max_wait_by_class.items()},
+                "headroom": {PRIORITY_NAMES[k]: v for k, v in self.headroom.items()},
+            },
+            "refused": self.refused,
+            "upstream_rate_limited": self.upstream_rate_limited,
+            "retries": self.retries,
+        }
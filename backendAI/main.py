@@ -1,20 +1,234 @@
 import os
-from fastapi import FastAPI, HTTPException
+import re
+import math
+import json
+import time
+import asyncio
+import logging
+import urllib.parse
+from contextlib import aclosing, asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from groq import Groq
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
+from answer_cache import AnswerCache
+from embeddings import embedder_loaded, get_embedder
+from batcher import MicroBatcher
+from chat_sessions import MemorySessionStore, SessionManager, SQLiteSessionStore, Turn
+from image_cache import ImageCache, etag_matches, image_key, is_image_key, open_upstream
+from llm_pool import BACKGROUND, CHAT, MODERATION, LLMPool, LLMRateLimited
+from moderation_cache import build_moderation_cache, normalize_comment
+from prefilter import load_preclassifier
+from retrieval import Retriever, estimate_tokens
+from singleflight import SingleFlight
+from telemetry import configure_logging, counter, histogram, instrument, timed
+
 # Load environment variables
 load_dotenv()
 
+# JSON log lines on stdout; GET /metrics for latency histograms and counters
+configure_logging("backendAI")
+log = logging.getLogger(__name__)
+
+MODERATION_DECISIONS = counter("moderation_decisions_total", "Moderation verdicts, by deciding tier", ["tier"])
+CHAT_STAGE_SECONDS = histogram("chat_stage_seconds", "Time per /api/chat stage", ["stage"])
+CHAT_ANSWERS = counter("chat_answers_total", "Chat answers, by endpoint and source (cache/llm)", ["endpoint", "source"])
+
 API_KEY = os.getenv("GROQ_API_KEY")
 if not API_KEY:
     raise RuntimeError("❌ Missing GROQ_API_KEY in .env")
 
-client = Groq(api_key=API_KEY)
+# Max number of Groq completions in flight per worker
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+# The Groq key's limits for LLM_MODEL, shared by every call; 0 (the default) = unlimited.
+# On the free tier, llama-3.1-8b-instant allows LLM_RPM=30 and LLM_TPM=6000; divide by the worker count.
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+
+# Longest a call may queue for quota before the request gets a 429, per priority class
+LLM_MAX_WAIT_SECONDS = {
+    MODERATION: float(os.getenv("LLM_MODERATION_MAX_WAIT_SECONDS", "10")),
+    CHAT: float(os.getenv("LLM_CHAT_MAX_WAIT_SECONDS", "8")),
+    BACKGROUND: float(os.getenv("LLM_BACKGROUND_MAX_WAIT_SECONDS", "60")),
+}
+
+# Comment posting waits on moderation, so it goes first; session summaries go last
+LLM_PRIORITIES = {
+    "moderate": MODERATION,
+    "moderate_batch": MODERATION,
+    "chat": CHAT,
+    "chat_stream": CHAT,
+    "chat_summary": BACKGROUND,
+}
+
+
+def create_groq_client():
+    # Imported here: the groq SDK and httpx are a good part of the import time
+    from groq import AsyncGroq
+
+    # No SDK retries: on a 429 the pool decides whether to retry, and pauses every other call too
+    return AsyncGroq(api_key=API_KEY, max_retries=0)
+
+
+# The Groq client is created on the first completion, or by the startup warm-up
+llm_pool = LLMPool(
+    create_groq_client,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    rpm=LLM_RPM,
+    tpm=LLM_TPM,
+    priorities=LLM_PRIORITIES,
+    max_wait=LLM_MAX_WAIT_SECONDS,
+)
+
+
+def too_many_requests(error: LLMRateLimited) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="The AI service is at capacity. Please try again shortly.",
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))},
+    )
+
+LLM_MODEL = "llama-3.1-8b-instant"
+
+MODERATION_RULES = """Reject ANY content with:
+- insults (idiot, stupid, dumb, moron, loser, trash, etc.)
+- harassment, threats, bullying
+- hate speech or discrimination
+- explicit or sexual content
+- violence or physical harm
+- self-harm or suicide talk
+- illegal activity
+- profanity, rude or abusive language
+- harmful opinions that attack people
+"""
 
-app = FastAPI()
+MODERATION_PROMPT = f"""
+You are a STRICT content moderation engine.
+
+You must output EXACTLY one of the following:
+
+APPROVED
+
+or
+
+REJECTED: <comma-separated reasons>
+
+{MODERATION_RULES}"""
+
+MODERATION_BATCH_PROMPT = f"""
+You are a STRICT content moderation engine.
+
+You will receive several numbered comments. Judge each one independently.
+For EVERY comment output EXACTLY one line, in the same order, in one of these forms:
+
+<number>. APPROVED
+
+<number>. REJECTED: <comma-separated reasons>
+
+Output nothing else.
+
+{MODERATION_RULES}"""
+
+# Micro-batching: concurrent cache misses are sent to Groq together
+MODERATION_BATCH_WINDOW_MS = float(os.getenv("MODERATION_BATCH_WINDOW_MS", "5"))
+MODERATION_BATCH_MAX = int(os.getenv("MODERATION_BATCH_MAX", "16"))
+
+# Verdict cache: in-memory LRU in front of SQLite (set the path to "" for memory only).
+# Keys include a hash of the prompts and LLM_MODEL, so editing either invalidates it.
+moderation_cache = build_moderation_cache(
+    prompt=MODERATION_PROMPT + MODERATION_BATCH_PROMPT,
+    model=LLM_MODEL,
+    path=os.getenv("MODERATION_CACHE_PATH", "moderation_cache.sqlite3"),
+    max_entries=int(os.getenv("MODERATION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("MODERATION_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+)
+
+# Local first tier: lexicon matcher that settles obvious comments without calling Groq
+preclassifier = load_preclassifier(os.getenv("MODERATION_LEXICON_PATH", ""))
+
+# Page-aware passages for /api/chat (build the index with `python retrieval.py`)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "600"))
+retriever = Retriever(os.getenv("BOOK_INDEX_DIR", "book_index"))
+
+# Chat sessions: recent turns verbatim, older ones folded into a bounded summary
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB", "")  # e.g. chat_sessions.sqlite3; empty = memory only
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "5000"))
+CHAT_RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "4"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "800"))
+CHAT_SUMMARY_TOKEN_BUDGET = int(os.getenv("CHAT_SUMMARY_TOKEN_BUDGET", "200"))
+
+# Answers shared across readers of the same book and page range
+answer_cache = AnswerCache(
+    page_bucket=int(os.getenv("CHAT_CACHE_PAGE_BUCKET", "10")),
+    threshold=float(os.getenv("CHAT_CACHE_THRESHOLD", "0.92")),
+    per_book=int(os.getenv("CHAT_CACHE_PER_BOOK", "200")),
+    max_books=int(os.getenv("CHAT_CACHE_MAX_BOOKS", "500")),
+    ttl=float(os.getenv("CHAT_CACHE_TTL_SECONDS", str(24 * 3600))),
+)
+
+# Generated images: fetched once per (prompt, size), kept on disk, served from here.
+# IMAGE_UPSTREAM: pollinations, a compatible base URL, or stub[:<delay ms>] for tests.
+# IMAGE_PUBLIC_BASE_URL: this service's public URL for the image links (default: the request's,
+# which behind a proxy needs uvicorn's --proxy-headers, as in render.yaml).
+image_cache = ImageCache(
+    os.getenv("IMAGE_CACHE_DIR", "image_cache"),
+    open_upstream(os.getenv("IMAGE_UPSTREAM", "pollinations")),
+    max_bytes=int(float(os.getenv("IMAGE_CACHE_MAX_MB", "512")) * (1 << 20)),
+)
+IMAGE_PUBLIC_BASE_URL = os.getenv("IMAGE_PUBLIC_BASE_URL", "")
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2048"))
+
+# What happens after the server starts listening (see warm_up):
+#   background  warm up while already serving (default; /healthz answers right away)
+#   blocking    warm up before serving, like a readiness gate
+#   off         nothing; each piece is loaded by the first request that needs it
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background")
+STARTED_AT = time.time()
+warmup_state = {"status": "pending", "seconds": None, "failed": []}
+
+
+async def warm_up() -> None:
+    """
+    Loads the embedder, opens the Groq connection and indexes the image cache,
+    each on its own so one failing does not keep the others cold.
+    """
+    started = time.perf_counter()
+    warmup_state["status"] = "running"
+    steps = {
+        "embedder": asyncio.to_thread(get_embedder),
+        "groq": llm_pool.warm_up(),
+        "image_cache": image_cache.load_index(),
+    }
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            warmup_state["failed"].append(name)
+            log.warning("warm-up step failed", extra={"step": name, "error": str(result)})
+    warmup_state["seconds"] = round(time.perf_counter() - started, 3)
+    warmup_state["status"] = "done"
+    log.info("warm-up finished", extra={"seconds": warmup_state["seconds"], "failed": warmup_state["failed"]})
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = None
+    if STARTUP_WARMUP == "blocking":
+        await warm_up()
+    elif STARTUP_WARMUP != "off":
+        task = asyncio.create_task(warm_up())
+    else:
+        warmup_state["status"] = "off"
+    yield
+    if task is not None:
+        task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+instrument(app)
 
 # CORS settings
 app.add_middleware(
@@ -32,15 +246,26 @@ class ModerationResult(BaseModel):
     is_appropriate: bool
     message: str
     reasons: list[str] = []
+    tier: str = "llm"  # which tier decided: "lexicon", "cache" or "llm"
+
+class BatchCommentRequest(BaseModel):
+    texts: list[str] = Field(..., max_length=100)
+
+class BatchModerationResult(BaseModel):
+    results: list[ModerationResult]
 
 class ChatRequest(BaseModel):
     message: str
     book_title: str = ""
     current_page: int = 1
     total_pages: int = 0
+    session_id: str | None = None  # omit to start a new session
 
 class ChatResponse(BaseModel):
     response: str
+    session_id: str
+    prompt_tokens: int
+    cached: bool = False  # served from the answer cache, no Groq call
 
 class ImageRequest(BaseModel):
     prompt: str
@@ -53,114 +278,486 @@ class ImageResponse(BaseModel):
     prompt: str
 
 
-@app.post("/api/moderate", response_model=ModerationResult)
-async def moderate_comment(comment: CommentRequest):
-    try:
-        system_prompt = """
-You are a STRICT content moderation engine.
+def parse_moderation_output(result: str) -> ModerationResult | None:
+    """Map the model's APPROVED / REJECTED: line to a result, or None if it is neither."""
+    # APPROVED
+    if result == "APPROVED":
+        return ModerationResult(
+            is_appropriate=True,
+            message="Comment allowed",
+            reasons=[]
+        )
 
-You must output EXACTLY one of the following:
+    # REJECTED
+    if result.startswith("REJECTED:"):
+        reasons = result.split(":", 1)[1].strip().split(",")
+        reasons = [r.strip() for r in reasons if r.strip()]
 
-APPROVED
+        return ModerationResult(
+            is_appropriate=False,
+            message="Comment rejected",
+            reasons=reasons
+        )
 
-or
+    return None
 
-REJECTED: <comma-separated reasons>
 
-Reject ANY content with:
-- insults (idiot, stupid, dumb, moron, loser, trash, etc.)
-- harassment, threats, bullying
-- hate speech or discrimination
-- explicit or sexual content
-- violence or physical harm
-- self-harm or suicide talk
-- illegal activity
-- profanity, rude or abusive language
-- harmful opinions that attack people
-"""
+UNCLASSIFIED = ModerationResult(
+    is_appropriate=False,
+    message="Comment rejected (unexpected model output)",
+    reasons=["unclassified"]
+)
 
-        response = client.chat.completions.create(
-            model="llama-3.1-8b-instant",
+# Batches whose output could not be parsed and were retried per comment
+batch_fallbacks = 0
+
+BATCH_LINE_RE = re.compile(r"^\s*(\d+)\s*[.):]\s*(.+?)\s*$")
+
+
+async def moderate_with_llm(text: str) -> ModerationResult | None:
+    """One Groq call for one comment. None means the output was not understood."""
+    response = await llm_pool.complete(
+        "moderate",
+        model=LLM_MODEL,
+        messages=[
+            {"role": "system", "content": MODERATION_PROMPT},
+            {"role": "user", "content": text},
+        ],
+        temperature=0,
+        max_tokens=30,
+    )
+    result = response.choices[0].message.content.strip()
+    return parse_moderation_output(result)
+
+
+def parse_batch_output(output: str, expected: int) -> list[ModerationResult] | None:
+    """Parse `<n>. APPROVED` / `<n>. REJECTED: ...` lines; None unless every item is answered once."""
+    verdicts: dict[int, ModerationResult] = {}
+    for line in output.splitlines():
+        match = BATCH_LINE_RE.match(line)
+        if not match:
+            continue
+        number = int(match.group(1))
+        verdict = parse_moderation_output(match.group(2))
+        if verdict is None or number in verdicts or not 1 <= number <= expected:
+            return None
+        verdicts[number] = verdict
+    if len(verdicts) != expected:
+        return None
+    return [verdicts[i] for i in range(1, expected + 1)]
+
+
+async def moderate_batch_with_llm(texts: list[str]) -> list[ModerationResult | None]:
+    """
+    Handler for the micro-batcher: one numbered prompt for the whole batch.
+    Malformed output falls back to one call per comment.
+    """
+    global batch_fallbacks
+    if len(texts) == 1:
+        return [await moderate_with_llm(texts[0])]
+
+    numbered = "\n".join(f"{i}. {' '.join(text.split())}" for i, text in enumerate(texts, start=1))
+    try:
+        response = await llm_pool.complete(
+            "moderate_batch",
+            model=LLM_MODEL,
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": comment.text},
+                {"role": "system", "content": MODERATION_BATCH_PROMPT},
+                {"role": "user", "content": numbered},
             ],
             temperature=0,
-            max_tokens=30,
+            max_tokens=30 * len(texts),
         )
+        verdicts = parse_batch_output(response.choices[0].message.content, len(texts))
+    except LLMRateLimited:
+        # One call per comment would only dig the quota hole deeper
+        raise
+    except Exception as e:
+        log.warning("batch moderation call failed, retrying per item",
+                    extra={"error": type(e).__name__, "detail": str(e), "batch_size": len(texts)})
+        verdicts = None
 
-        result = response.choices[0].message.content.strip()
+    if verdicts is None:
+        batch_fallbacks += 1
+        return list(await asyncio.gather(*(moderate_with_llm(text) for text in texts)))
+    return verdicts
 
-        # APPROVED
-        if result == "APPROVED":
-            return ModerationResult(
-                is_appropriate=True,
-                message="Comment allowed",
-                reasons=[]
-            )
 
-        # REJECTED
-        if result.startswith("REJECTED:"):
-            reasons = result.split(":", 1)[1].strip().split(",")
-            reasons = [r.strip() for r in reasons if r.strip()]
+moderation_batcher = MicroBatcher(
+    moderate_batch_with_llm,
+    window=MODERATION_BATCH_WINDOW_MS / 1000,
+    max_items=MODERATION_BATCH_MAX,
+)
 
-            return ModerationResult(
-                is_appropriate=False,
-                message="Comment rejected",
-                reasons=reasons
-            )
 
-        # Unknown model output
+# Identical comments already waiting on Groq share that call
+moderation_flight = SingleFlight(key_fn=normalize_comment)
+
+
+async def moderate_text(text: str) -> ModerationResult:
+    """Lexicon first, then the verdict cache, then the (micro-batched) LLM."""
+    local = preclassifier.classify(text)
+    if local is not None:
+        is_appropriate, reasons = local
+        MODERATION_DECISIONS.inc(tier="lexicon")
         return ModerationResult(
-            is_appropriate=False,
-            message="Comment rejected (unexpected model output)",
-            reasons=["unclassified"]
+            is_appropriate=is_appropriate,
+            message="Comment allowed" if is_appropriate else "Comment rejected",
+            reasons=reasons,
+            tier="lexicon",
         )
 
+    cached = await moderation_cache.aget(text)
+    if cached is not None:
+        MODERATION_DECISIONS.inc(tier="cache")
+        return ModerationResult(**{**cached, "tier": "cache"})
+
+    verdict = await moderation_flight.run(moderation_batcher.submit, text)
+    if verdict is None:
+        # Unknown model output (not cached, so the next attempt asks again)
+        MODERATION_DECISIONS.inc(tier="unclassified")
+        return UNCLASSIFIED
+    MODERATION_DECISIONS.inc(tier="llm")
+    await moderation_cache.aset(text, verdict.model_dump())
+    return verdict
+
+
+@app.post("/api/moderate", response_model=ModerationResult)
+async def moderate_comment(comment: CommentRequest):
+    try:
+        return await moderate_text(comment.text)
+    except LLMRateLimited as e:
+        raise too_many_requests(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/chat")
-async def chat(request: ChatRequest):
+@app.post("/api/moderate/batch", response_model=BatchModerationResult)
+async def moderate_comments_batch(request: BatchCommentRequest):
+    """Moderate up to 100 comments at once; results come back in request order."""
     try:
-        print(f"Received chat request: {request.message[:50]}...")
-        print(f"Book: {request.book_title}, Page: {request.current_page}")
-        
-        system_prompt = f"""You are a helpful AI assistant for the book "{request.book_title}". 
+        results = await asyncio.gather(*(moderate_text(text) for text in request.texts))
+        return BatchModerationResult(results=list(results))
+    except LLMRateLimited as e:
+        raise too_many_requests(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/api/moderate/cache/stats")
+async def moderation_cache_stats():
+    """Hit/miss counters for the moderation verdict cache."""
+    # Counts the SQLite rows, so off the event loop
+    return await asyncio.to_thread(moderation_cache.stats)
+
+
+@app.get("/api/moderate/stats")
+async def moderation_stats():
+    """How many comments each tier decided, and how well Groq calls are being batched."""
+    calls = llm_pool.stats()["calls_by_endpoint"]
+    return {
+        "lexicon": preclassifier.stats(),
+        "cache": await asyncio.to_thread(moderation_cache.stats),
+        "llm": {
+            "single_calls": calls.get("moderate", 0),
+            "batch_calls": calls.get("moderate_batch", 0),
+            "batcher": {**moderation_batcher.stats(), "fallbacks": batch_fallbacks},
+        },
+    }
+
+
+def build_chat_system_prompt(request: ChatRequest) -> str:
+    return f"""You are a helpful AI assistant for the book "{request.book_title}". 
 The user is currently on page {request.current_page}{f' of {request.total_pages}' if request.total_pages > 0 else ''}. 
 Provide concise, relevant answers about the book's content, themes, characters, and context."""
 
-        print("Calling Groq API...")
-        response = client.chat.completions.create(
-            model="llama-3.1-8b-instant",  # Using the same model as moderation
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": request.message},
-            ],
-            temperature=0.7,
-            max_tokens=500,
+
+def format_passages(passages: list[tuple[int, str]], current_page: int) -> str:
+    lines = [
+        "",
+        f"Passages from the book, all from page {current_page} or earlier.",
+        "Base your answer on them when relevant, and never reveal events from later pages:",
+    ]
+    lines += [f"[p. {page}] {text}" for page, text in passages]
+    return "\n".join(lines)
+
+
+async def summarize_turns(summary: str, turns: list[Turn]) -> str:
+    """Fold older turns into the session's running summary."""
+    transcript = "\n".join(f"Reader: {user}\nAssistant: {assistant}" for user, assistant in turns)
+    response = await llm_pool.complete(
+        "chat_summary",
+        model=LLM_MODEL,
+        messages=[
+            {"role": "system", "content": (
+                "You maintain a running summary of a conversation between a reader and a book assistant. "
+                "Merge the new exchanges into the existing summary. Keep names, facts and open questions "
+                f"the reader may refer back to. Reply with the summary only, under {CHAT_SUMMARY_TOKEN_BUDGET * 3 // 4} words."
+            )},
+            {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew exchanges:\n{transcript}"},
+        ],
+        temperature=0.2,
+        max_tokens=CHAT_SUMMARY_TOKEN_BUDGET,
+    )
+    return response.choices[0].message.content
+
+
+chat_sessions = SessionManager(
+    SQLiteSessionStore(CHAT_SESSION_DB, CHAT_MAX_SESSIONS) if CHAT_SESSION_DB else MemorySessionStore(CHAT_MAX_SESSIONS),
+    summarize=summarize_turns,
+    recent_turns=CHAT_RECENT_TURNS,
+    history_token_budget=CHAT_HISTORY_TOKEN_BUDGET,
+    summary_token_budget=CHAT_SUMMARY_TOKEN_BUDGET,
+)
+
+
+async def build_chat_messages(request: ChatRequest, session=None) -> list[dict]:
+    system_prompt = build_chat_system_prompt(request)
+    with timed(CHAT_STAGE_SECONDS, stage="retrieval"):
+        passages = await asyncio.to_thread(
+            retriever.retrieve,
+            request.book_title,
+            request.message,
+            max_page=request.current_page,
+            k=RETRIEVAL_TOP_K,
+            token_budget=RETRIEVAL_TOKEN_BUDGET,
         )
+    if passages:
+        system_prompt += "\n" + format_passages(passages, request.current_page)
 
-        ai_response = response.choices[0].message.content.strip()
-        print(f"Got response: {ai_response[:50]}...")
-        
-        return {"response": ai_response}
+    history: list[dict] = []
+    if session is not None:
+        summary, history = chat_sessions.history_messages(session)
+        if summary:
+            system_prompt += f"\n\nSummary of the earlier conversation with this reader:\n{summary}"
+
+    return [
+        {"role": "system", "content": system_prompt},
+        *history,
+        {"role": "user", "content": request.message},
+    ]
+
+
+def is_cacheable(session) -> bool:
+    return not session.turns and not session.summary
+
+
+def count_prompt_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(m["content"]) + 4 for m in messages)
+
+
+def chat_flight_key(messages: list[dict]) -> tuple:
+    """Identical prompts (same book, page, history and question, ignoring case and spacing)."""
+    return tuple((m["role"], normalize_comment(m["content"])) for m in messages)
+
+
+async def chat_with_llm(messages: list[dict]) -> tuple[str, int | None]:
+    response = await llm_pool.complete(
+        "chat",
+        model=LLM_MODEL,  # Using the same model as moderation
+        messages=messages,
+        temperature=0.7,
+        max_tokens=500,
+    )
+    usage = getattr(response, "usage", None)
+    return response.choices[0].message.content.strip(), getattr(usage, "prompt_tokens", None)
 
+
+# Readers of the same page asking the same question share one Groq call
+chat_flight = SingleFlight(key_fn=chat_flight_key)
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest):
+    try:
+        log.info("chat request", extra={"book": request.book_title, "page": request.current_page,
+                                        "question": request.message[:50]})
+
+        session = await chat_sessions.open(request.session_id, request.book_title)
+
+        # Only opening questions are shared; follow-ups depend on the conversation
+        cacheable = is_cacheable(session)
+        if cacheable:
+            with timed(CHAT_STAGE_SECONDS, stage="cache_lookup"):
+                cached_answer, question_vector = await asyncio.to_thread(
+                    answer_cache.lookup, request.book_title, request.current_page, request.message
+                )
+            if cached_answer is not None:
+                log.info("chat served from answer cache", extra={"book": request.book_title})
+                CHAT_ANSWERS.inc(endpoint="chat", source="cache")
+                await chat_sessions.record(session, request.message, cached_answer)
+                return ChatResponse(
+                    response=cached_answer, session_id=session.session_id, prompt_tokens=0, cached=True
+                )
+
+        messages = await build_chat_messages(request, session)
+
+        with timed(CHAT_STAGE_SECONDS, stage="llm") as llm_timer:
+            ai_response, prompt_tokens = await chat_flight.run(chat_with_llm, messages)
+        prompt_tokens = prompt_tokens or count_prompt_tokens(messages)
+        CHAT_ANSWERS.inc(endpoint="chat", source="llm")
+        log.info("chat answered", extra={"prompt_tokens": prompt_tokens, "llm_ms": round(llm_timer.elapsed * 1000)})
+
+        if cacheable:
+            answer_cache.store(request.book_title, request.current_page, request.message, ai_response, question_vector)
+        await chat_sessions.record(session, request.message, ai_response)
+        return ChatResponse(response=ai_response, session_id=session.session_id, prompt_tokens=prompt_tokens)
+
+    except LLMRateLimited as e:
+        log.warning("chat refused, LLM quota exhausted", extra={"reason": e.reason, "retry_after": round(e.retry_after, 1)})
+        raise too_many_requests(e)
     except Exception as e:
-        print(f"Error in chat endpoint: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("chat endpoint failed", extra={"error": type(e).__name__})
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/chat/sessions/stats")
+async def chat_session_stats():
+    return chat_sessions.stats()
+
+
+@app.get("/api/chat/cache/stats")
+async def chat_cache_stats():
+    """Exact and semantic hit counts for the chat answer cache."""
+    return answer_cache.stats()
+
+
+def sse_event(data: dict, event: str | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """
+    Same as /api/chat, but forwards tokens as Server-Sent Events:
+    `data: {"token": ...}` per chunk, then `event: done` carrying session_id
+    and prompt_tokens (or `event: error`).
+    If the client goes away the upstream Groq stream is closed.
+    """
+    log.info("streaming chat request", extra={"book": request.book_title, "page": request.current_page,
+                                              "question": request.message[:50]})
+    started = time.perf_counter()
+    session = await chat_sessions.open(request.session_id, request.book_title)
+
+    cacheable = is_cacheable(session)
+    question_vector = None
+    if cacheable:
+        with timed(CHAT_STAGE_SECONDS, stage="cache_lookup"):
+            cached_answer, question_vector = await asyncio.to_thread(
+                answer_cache.lookup, request.book_title, request.current_page, request.message
+            )
+        if cached_answer is not None:
+            log.info("chat served from answer cache", extra={"book": request.book_title})
+            CHAT_ANSWERS.inc(endpoint="chat_stream", source="cache")
+            await chat_sessions.record(session, request.message, cached_answer)
+
+            async def cached_source():
+                yield sse_event({"token": cached_answer})
+                yield sse_event(
+                    {"done": True, "session_id": session.session_id, "prompt_tokens": 0, "cached": True},
+                    event="done",
+                )
+
+            return StreamingResponse(
+                cached_source(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+    messages = await build_chat_messages(request, session)
+    prompt_tokens = count_prompt_tokens(messages)
+
+    upstream = llm_pool.stream(
+        "chat_stream",
+        model=LLM_MODEL,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=500,
+    )
+    # Wait for the first token before answering, so a call refused for quota is a plain 429
+    first_tokens: list[str] = []
+    early_error = None
+    try:
+        first_tokens.append(await upstream.__anext__())
+    except StopAsyncIteration:
+        pass
+    except LLMRateLimited as e:
+        log.warning("chat stream refused, LLM quota exhausted", extra={"reason": e.reason, "retry_after": round(e.retry_after, 1)})
+        raise too_many_requests(e)
+    except Exception as e:
+        early_error = e
+
+    async def chain_first_tokens():
+        for token in first_tokens:
+            yield token
+        async for token in upstream:
+            yield token
+
+    async def event_source():
+        first_token_at = time.perf_counter() if first_tokens else None
+        n_chunks = 0
+        reply: list[str] = []
+        try:
+            if early_error is not None:
+                raise early_error
+            async with aclosing(upstream):
+                async for token in chain_first_tokens():
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    n_chunks += 1
+                    reply.append(token)
+                    yield sse_event({"token": token})
+                    if await http_request.is_disconnected():
+                        log.info("client disconnected, cancelling upstream chat stream", extra={"chunks": n_chunks})
+                        return
+            CHAT_ANSWERS.inc(endpoint="chat_stream", source="llm")
+            log.info("chat stream finished", extra={
+                "chunks": n_chunks,
+                "seconds": round(time.perf_counter() - started, 3),
+                "first_token_ms": round((first_token_at - started) * 1000) if first_token_at else None,
+                "prompt_tokens": prompt_tokens,
+            })
+            answer = "".join(reply).strip()
+            if cacheable and answer:
+                answer_cache.store(request.book_title, request.current_page, request.message, answer, question_vector)
+            await chat_sessions.record(session, request.message, answer)
+            yield sse_event(
+                {"done": True, "session_id": session.session_id, "prompt_tokens": prompt_tokens, "cached": False},
+                event="done",
+            )
+        except Exception as e:
+            log.error("chat stream failed", extra={"error": type(e).__name__, "detail": str(e)})
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/llm/stats")
+async def llm_stats():
+    """Queue depth, wait time and in-flight counts for the Groq pool, plus coalescing counts."""
+    return {
+        **llm_pool.stats(),
+        "single_flight": {
+            "moderate": moderation_flight.stats(),
+            "chat": chat_flight.stats(),
+        },
+    }
+
+
 @app.post("/api/generate-image")
-async def generate_image(request: ImageRequest):
+async def generate_image(request: ImageRequest, http_request: Request):
     """
-    Generate an image based on a text prompt using Pollinations.ai (free, no API key needed)
+    Generate an image based on a text prompt using Pollinations.ai (free, no API key needed).
+    Returns a link to this service's image cache, which fetches each image once and
+    serves it from disk afterwards; the fetch starts right away, before the link is used.
     """
     try:
-        print(f"Image generation request: {request.prompt[:50]}...")
+        log.info("image generation request", extra={"prompt": request.prompt[:50]})
         
         # Enhance the prompt with book context
         enhanced_prompt = f"{request.prompt}. Book: {request.book_title}, Page: {request.current_page}. High quality, detailed, artistic visualization."
@@ -174,28 +771,83 @@ async def generate_image(request: ImageRequest):
             except:
                 pass
         
-        # Use Pollinations.ai - free image generation API
-        # URL format: https://image.pollinations.ai/prompt/{encoded_prompt}
-        import urllib.parse
-        encoded_prompt = urllib.parse.quote(enhanced_prompt)
-        
-        # Generate image URL with custom size
-        image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width={width}&height={height}&nologo=true&enhance=true"
-        
-        print(f"Generated image URL: {image_url[:100]}...")
-        
+        width = min(max(width, 64), IMAGE_MAX_SIDE)
+        height = min(max(height, 64), IMAGE_MAX_SIDE)
+
+        # Content-addressed link; identical prompts for the same book and page share one image
+        key = image_key(enhanced_prompt, width, height)
+        base_url = IMAGE_PUBLIC_BASE_URL or str(http_request.base_url)
+        query = urllib.parse.urlencode({"prompt": enhanced_prompt, "width": width, "height": height})
+        image_url = f"{base_url.rstrip('/')}/api/images/{key}?{query}"
+
+        # Warm the cache while the client renders; the image request joins this fetch
+        if await image_cache.peek(key) is None:
+            prefetch = asyncio.create_task(image_cache.get(key, enhanced_prompt, width, height))
+            prefetch.add_done_callback(lambda t: t.cancelled() or t.exception())
+
         return {
             "image_url": image_url,
             "prompt": enhanced_prompt
         }
         
     except Exception as e:
-        print(f"Error in image generation: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("image generation failed", extra={"error": type(e).__name__})
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/images/cache/stats")
+async def image_cache_stats():
+    """Size, hit ratio and upstream fetch counts of the generated-image cache."""
+    return image_cache.stats()
+
+
+@app.get("/api/images/{key}")
+async def get_image(key: str, http_request: Request, prompt: str = "", width: int = 0, height: int = 0):
+    """
+    Serves a generated image from the cache, fetching it first on a miss. The
+    prompt and size are only needed on a miss and must hash to `key`.
+    Responses carry a strong ETag (304 on If-None-Match) and support Range.
+    """
+    if not is_image_key(key):
+        raise HTTPException(status_code=404, detail="Unknown image.")
+    entry = await image_cache.peek(key)
+    if entry is None:
+        if not prompt or not width or not height:
+            raise HTTPException(status_code=404, detail="Image not cached; prompt, width and height are required.")
+        if width > IMAGE_MAX_SIDE or height > IMAGE_MAX_SIDE or image_key(prompt, width, height) != key:
+            raise HTTPException(status_code=400, detail="Image key does not match the prompt and size.")
+        try:
+            entry = await image_cache.get(key, prompt, width, height)
+        except Exception as e:
+            log.warning("image upstream fetch failed", extra={"key": key, "error": f"{type(e).__name__}: {e}"})
+            raise HTTPException(status_code=502, detail="Image generation failed upstream.")
+    else:
+        entry = await image_cache.get(key, prompt, width, height)
+
+    headers = {"etag": entry.etag, "cache-control": "public, max-age=31536000, immutable"}
+    if etag_matches(http_request.headers.get("if-none-match", ""), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(entry.path, media_type=entry.content_type, headers=headers)
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: answers as soon as the server is listening, without touching
+    Groq or the disk. The components show how far the warm-up has got.
+    """
+    return {
+        "status": "ok",
+        "uptime_s": round(time.time() - STARTED_AT, 3),
+        "warmup": warmup_state,
+        "components": {
+            "groq_client": llm_pool.connected,
+            "embedder": embedder_loaded(),
+            "image_index": image_cache.indexed,
+        },
+    }
+
+
 # Local development only
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,244 @@
+"""
+Content-addressed cache for moderation verdicts.
+
+Keys are sha256(namespace + normalized comment text), where the namespace is a
+hash of the moderation prompt and model. Editing the prompt or switching the
+model therefore changes every key, and stale rows are purged from disk.
+
+Backends are pluggable: MemoryLRUBackend (LRU + TTL), SQLiteBackend (survives
+restarts) and TieredBackend (memory in front of SQLite). The service uses the
+async aget/aset: memory lookups stay on the event loop, SQLite queries and
+commits run in a worker thread.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def normalize_comment(text: str) -> str:
+    """Case-fold, NFKC-normalize and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split())
+
+
+def prompt_fingerprint(prompt: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\x00{prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+class CacheBackend:
+    """Interface for verdict storage. Values are JSON-serializable dicts."""
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def purge_namespace(self, keep: str) -> None:
+        """Drop entries written under any namespace other than `keep`."""
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        self.set(key, value)
+
+    def __len__(self) -> int:
+        return 0
+
+
+class MemoryLRUBackend(CacheBackend):
+    def __init__(self, max_entries: int = 10_000, ttl: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.time() - stored_at > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any], stored_at: Optional[float] = None) -> None:
+        self._data[key] = (stored_at or time.time(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteBackend(CacheBackend):
+    def __init__(self, path: str, namespace: str, ttl: float = 7 * 24 * 3600):
+        self.ttl = ttl
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS moderation_cache (
+                   key TEXT PRIMARY KEY,
+                   namespace TEXT NOT NULL,
+                   value TEXT NOT NULL,
+                   stored_at REAL NOT NULL
+               )"""
+        )
+        self._conn.commit()
+
+    def get_with_time(self, key: str) -> Optional[tuple[float, Dict[str, Any]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, stored_at FROM moderation_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        if time.time() - stored_at > self.ttl:
+            return None
+        return stored_at, json.loads(value)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        hit = self.get_with_time(key)
+        return hit[1] if hit else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO moderation_cache (key, namespace, value, stored_at) VALUES (?, ?, ?, ?)",
+                (key, self.namespace, json.dumps(value), time.time()),
+            )
+            self._conn.commit()
+
+    async def aget_with_time(self, key: str) -> Optional[tuple[float, Dict[str, Any]]]:
+        return await asyncio.to_thread(self.get_with_time, key)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.set, key, value)
+
+    def purge_namespace(self, keep: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM moderation_cache WHERE namespace != ? OR stored_at < ?",
+                (keep, time.time() - self.ttl),
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM moderation_cache").fetchone()[0]
+
+
+class TieredBackend(CacheBackend):
+    """Memory LRU in front of SQLite; disk hits are promoted into memory."""
+
+    def __init__(self, memory: MemoryLRUBackend, disk: SQLiteBackend):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        hit = self.disk.get_with_time(key)
+        if hit is None:
+            return None
+        stored_at, value = hit
+        self.memory.set(key, value, stored_at=stored_at)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        hit = await self.disk.aget_with_time(key)
+        if hit is None:
+            return None
+        stored_at, value = hit
+        self.memory.set(key, value, stored_at=stored_at)
+        return value
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        self.memory.set(key, value)
+        await self.disk.aset(key, value)
+
+    def purge_namespace(self, keep: str) -> None:
+        self.disk.purge_namespace(keep)
+
+    def __len__(self) -> int:
+        return len(self.disk)
+
+
+class ModerationCache:
+    def __init__(self, backend: CacheBackend, prompt: str, model: str):
+        self.backend = backend
+        self.namespace = prompt_fingerprint(prompt, model)
+        self.hits = 0
+        self.misses = 0
+        self.backend.purge_namespace(keep=self.namespace)
+
+    def key(self, text: str) -> str:
+        normalized = normalize_comment(text)
+        return hashlib.sha256(f"{self.namespace}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[Dict[str, Any]]:
+        value = self.backend.get(self.key(text))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, text: str, value: Dict[str, Any]) -> None:
+        self.backend.set(self.key(text), value)
+
+    async def aget(self, text: str) -> Optional[Dict[str, Any]]:
+        """Like get(), without blocking the event loop on disk."""
+        value = await self.backend.aget(self.key(text))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def aset(self, text: str, value: Dict[str, Any]) -> None:
+        await self.backend.aset(self.key(text), value)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def build_moderation_cache(prompt: str, model: str, path: str, max_entries: int, ttl: float) -> ModerationCache:
+    """Memory-only cache when `path` is empty, otherwise memory + SQLite."""
+    memory = MemoryLRUBackend(max_entries=max_entries, ttl=ttl)
+    if not path:
+        return ModerationCache(memory, prompt, model)
+    namespace = prompt_fingerprint(prompt, model)
+    disk = SQLiteBackend(path, namespace=namespace, ttl=ttl)
+    return ModerationCache(TieredBackend(memory, disk), prompt, model)
@@ -0,0 +1,173 @@
+"""
+Local first-tier moderation that runs before the LLM.
+
+Comments are normalized (NFKC, case-folded, common leetspeak undone) and
+scanned with one compiled regex built from the whole lexicon. Each lexicon
+term also matches stretched spellings ("stuuupid", "l0000ser").
+
+- A blocklist hit that is aimed at someone rejects the comment immediately:
+  a "directed" term ("kill yourself"), a term addressed in the second person
+  ("you idiot", "you're such a loser", "shut up you"), or any hit in a
+  comment that @mentions another user.
+- A bare hit ("the dumb waiter scene", "the villain is such a loser") is
+  left to the LLM, which can read the context.
+- A comment that is exactly one of the known-safe phrases is approved.
+- Anything else is ambiguous and escalates to the LLM.
+
+The lexicon can be replaced with a JSON file:
+    {"reject": {"insult": ["idiot", ...], "profanity": [...]},
+     "directed": ["kill yourself", ...],
+     "approve": ["great book", ...]}
+"""
+import json
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_REJECT: Dict[str, List[str]] = {
+    "insult": [
+        "idiot", "idiots", "stupid", "dumb", "dumbass", "moron", "morons", "loser", "losers",
+        "trash", "imbecile", "retard", "retarded",
+    ],
+    "profanity": [
+        "fuck", "fucking", "fucker", "motherfucker", "shit", "shitty", "bullshit",
+        "bitch", "bastard", "asshole", "cunt", "wtf", "stfu",
+    ],
+    "harassment": ["shut up", "go die", "nobody likes you"],
+    "self-harm": ["kill yourself", "kys", "kill myself"],
+    "violence": ["i will kill you", "i will hurt you"],
+}
+
+# Reject terms that are aimed at someone on their own, without a "you" around them
+DEFAULT_DIRECTED: List[str] = [
+    "kill yourself", "kys", "go die", "nobody likes you", "i will kill you", "i will hurt you", "stfu",
+]
+
+DEFAULT_APPROVE: List[str] = [
+    "great book", "good book", "nice book", "amazing book", "awesome book", "loved it",
+    "love it", "love this book", "loved this book", "i loved it", "i love this book",
+    "must read", "a must read", "highly recommend", "highly recommended", "recommended",
+    "great read", "good read", "amazing", "awesome", "beautiful", "brilliant", "excellent",
+    "fantastic", "masterpiece", "wonderful", "interesting", "nice", "good", "great",
+    "thank you", "thanks", "10/10", "5 stars", "five stars",
+]
+
+LEET = {"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s", "!": "i"}
+
+# Only substitute inside words, so "5 stars" or a trailing "dumb!" keep their meaning
+_LEET_RE = re.compile(r"[013457@$](?=[a-z0-9@$])|(?<=[a-z])[013457@$]|!(?=[a-z])")
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split())
+
+
+def unleet(text: str) -> str:
+    return _LEET_RE.sub(lambda m: LEET[m.group(0)], text)
+
+
+def collapse_repeats(text: str) -> str:
+    return re.sub(r"(.)\1+", r"\1", text)
+
+
+# "you", "you're so", "ur a", "you are such a total" ... right before a term
+_SECOND_PERSON = r"(?:you|u|ya|ur|yourself|youre|you['’]re|y['’]?all)"
+_FILLER = r"(?:are|r|re|is|be|being|such|so|a|an|the|really|very|total|totally|complete|absolute|utter|little|big|fucking|freaking)"
+_ADDRESSED_BEFORE_RE = re.compile(r"(?<![a-z'’])" + _SECOND_PERSON + r"(?:[\s,]+" + _FILLER + r")*[\s,]*$")
+# ... or right after it ("shut up you", "fuck you")
+_ADDRESSED_AFTER_RE = re.compile(r"^[\s,!.]*(?:you|u|ya)(?![a-z'’])")
+# @username, checked before unleet() turns "@" into "a"
+_MENTION_RE = re.compile(r"(?<![\w@])@\w")
+
+
+def _term_pattern(term: str) -> str:
+    """'kill you' -> 'k+i+l+\\s+y+o+u+' (repeats are allowed, spaces match any whitespace run)."""
+    parts = []
+    for ch in collapse_repeats(term):
+        parts.append(r"\s+" if ch == " " else re.escape(ch) + "+")
+    return "".join(parts)
+
+
+class PreClassifier:
+    def __init__(self, reject: Dict[str, Iterable[str]], approve: Iterable[str], directed: Iterable[str] = ()):
+        self.reason_by_term: Dict[str, str] = {}
+        for reason, terms in reject.items():
+            for term in terms:
+                self.reason_by_term[collapse_repeats(unleet(normalize(term)))] = reason
+        self._directed = {collapse_repeats(unleet(normalize(term))) for term in directed}
+
+        # Longest terms first so "kill yourself" wins over shorter overlaps
+        terms = sorted(self.reason_by_term, key=len, reverse=True)
+        self._reject_re = re.compile(
+            r"(?<![a-z])(?:" + "|".join(_term_pattern(t) for t in terms) + r")(?![a-z])"
+        ) if terms else None
+        self._approve = {self._phrase_key(p) for p in approve}
+
+        self.rejected = 0
+        self.approved = 0
+        self.escalated = 0
+        self.untargeted_hits = 0
+
+    @staticmethod
+    def _phrase_key(text: str) -> str:
+        return " ".join(re.sub(r"[^\w/ ]+", " ", normalize(text)).split())
+
+    def _targeted(self, term: str, scanned: str, match: "re.Match", mentions: bool) -> bool:
+        if term in self._directed or mentions:
+            return True
+        return bool(_ADDRESSED_BEFORE_RE.search(scanned, 0, match.start())
+                    or _ADDRESSED_AFTER_RE.match(scanned[match.end():]))
+
+    def classify(self, text: str) -> Optional[tuple[bool, List[str]]]:
+        """
+        Returns (False, reasons) for an obvious, targeted violation, (True, [])
+        for a known-safe comment, or None when the LLM has to decide.
+        """
+        if self._reject_re is not None:
+            normalized = normalize(text)
+            mentions = _MENTION_RE.search(normalized) is not None
+            scanned = unleet(normalized)
+            reasons = []
+            bare_hit = False
+            for match in self._reject_re.finditer(scanned):
+                term = collapse_repeats(" ".join(match.group(0).split()))
+                reason = self.reason_by_term.get(term)
+                if not reason:
+                    continue
+                if not self._targeted(term, scanned, match, mentions):
+                    bare_hit = True
+                elif reason not in reasons:
+                    reasons.append(reason)
+            if reasons:
+                self.rejected += 1
+                return False, reasons
+            if bare_hit:
+                self.untargeted_hits += 1
+                self.escalated += 1
+                return None
+
+        if self._phrase_key(text) in self._approve:
+            self.approved += 1
+            return True, []
+
+        self.escalated += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "lexicon_terms": len(self.reason_by_term),
+            "rejected": self.rejected,
+            "approved": self.approved,
+            "escalated": self.escalated,
+            "untargeted_hits": self.untargeted_hits,
+        }
+
+
+def load_preclassifier(path: str = "") -> PreClassifier:
+    """Build from the JSON lexicon at `path`, or from the defaults when no path is given."""
+    if not path:
+        return PreClassifier(DEFAULT_REJECT, DEFAULT_APPROVE, DEFAULT_DIRECTED)
+    with open(path, encoding="utf-8") as f:
+        lexicon = json.load(f)
+    return PreClassifier(lexicon.get("reject", {}), lexicon.get("approve", []), lexicon.get("directed", []))
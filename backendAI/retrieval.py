@@ -0,0 +1,243 @@
+"""
+Page-aware passage retrieval for the in-reader chat assistant.
+
+Build step (run once per catalog change):
+    python retrieval.py --pdf-dir ../frontend/public/pdfs \
+        --catalog ../frontend/public/books-data.json --out book_index
+
+Each book gets a directory under the index root:
+    vectors.npy   float16 [n_chunks, dim], chunks ordered by page
+    pages.npy     int32   [n_chunks], page number of each chunk (sorted)
+    offsets.npy   int64   [n_chunks + 1], byte offsets into text.bin
+    text.bin      UTF-8 chunk texts, concatenated
+    meta.json     title, source file, embedder name, counts
+and manifest.json maps normalized book titles to those directories.
+
+At query time everything is opened with mmap. Because chunks are sorted by
+page, "at or before current_page" is just a prefix of the arrays.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from embeddings import get_embedder
+
+log = logging.getLogger(__name__)
+
+CHUNK_WORDS = 120
+CHUNK_OVERLAP_WORDS = 20
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+def normalize_title(title: str) -> str:
+    return " ".join(re.sub(r"[^\w ]+", " ", title.casefold()).split())
+
+
+def extract_pages(pdf_path: str) -> List[str]:
+    from pypdf import PdfReader
+    reader = PdfReader(pdf_path)
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+def chunk_pages(pages: List[str]) -> List[Tuple[int, str]]:
+    """Split each page into overlapping word windows; returns (page_number, text) pairs."""
+    chunks = []
+    step = CHUNK_WORDS - CHUNK_OVERLAP_WORDS
+    for page_number, text in enumerate(pages, start=1):
+        words = text.split()
+        for start in range(0, len(words), step):
+            window = words[start:start + CHUNK_WORDS]
+            if len(window) < 5:
+                break
+            chunks.append((page_number, " ".join(window)))
+            if start + CHUNK_WORDS >= len(words):
+                break
+    return chunks
+
+
+class BookIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.pages = np.load(os.path.join(path, "pages.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.text = np.memmap(os.path.join(path, "text.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def chunk_text(self, i: int) -> str:
+        return bytes(self.text[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def search(self, query: np.ndarray, max_page: int, k: int) -> List[Tuple[float, int]]:
+        """Top-k (score, chunk_id) among chunks on pages <= max_page."""
+        eligible = int(np.searchsorted(self.pages, max_page, side="right"))
+        if eligible == 0:
+            return []
+        scores = np.asarray(self.vectors[:eligible], dtype=np.float32) @ query
+        k = min(k, eligible)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i)) for i in top]
+
+
+class Retriever:
+    def __init__(self, root: str):
+        self.root = root
+        self._books: Dict[str, Optional[BookIndex]] = {}
+        manifest_path = os.path.join(root, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                self.manifest: Dict[str, str] = json.load(f)
+        else:
+            self.manifest = {}
+        log.info("retrieval index loaded", extra={"books": len(self.manifest), "root": root})
+
+    def get(self, book_title: str) -> Optional[BookIndex]:
+        key = normalize_title(book_title)
+        if key not in self._books:
+            directory = self.manifest.get(key)
+            index = BookIndex(os.path.join(self.root, directory)) if directory else None
+            if index is not None and index.meta.get("embedder") != get_embedder().name:
+                log.warning("index built with a different embedder; skipping retrieval",
+                            extra={"book": book_title, "embedder": index.meta.get("embedder")})
+                index = None
+            self._books[key] = index
+        return self._books[key]
+
+    def retrieve(self, book_title: str, query: str, max_page: int, k: int, token_budget: int) -> List[Tuple[int, str]]:
+        """
+        Best passages at or before `max_page`, trimmed to fit `token_budget`.
+        Returned as (page, text) in reading order.
+        """
+        index = self.get(book_title)
+        if index is None or token_budget <= 0:
+            return []
+        query_vector = get_embedder().encode([query])[0]
+
+        selected = []
+        remaining = token_budget
+        for _, chunk_id in index.search(query_vector, max_page, k):
+            text = index.chunk_text(chunk_id)
+            cost = estimate_tokens(text)
+            if cost > remaining:
+                # Trim the last passage to whatever budget is left, if that is still useful
+                if remaining < 30:
+                    break
+                text = text[:remaining * 4].rsplit(" ", 1)[0] + " …"
+                cost = remaining
+            selected.append((int(index.pages[chunk_id]), text))
+            remaining -= cost
+            if remaining <= 0:
+                break
+        return sorted(selected)
+
+
+def build_book_index(pdf_path: str, title: str, out_dir: str) -> int:
+    """Extract, chunk and embed one PDF into `out_dir`. Returns the number of chunks."""
+    embedder = get_embedder()
+    chunks = chunk_pages(extract_pages(pdf_path))
+    os.makedirs(out_dir, exist_ok=True)
+
+    texts = [text for _, text in chunks]
+    vectors = embedder.encode(texts) if texts else np.zeros((0, embedder.dimension), dtype=np.float32)
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    np.save(os.path.join(out_dir, "vectors.npy"), vectors.astype(np.float16))
+    np.save(os.path.join(out_dir, "pages.npy"), np.array([p for p, _ in chunks], dtype=np.int32))
+    np.save(os.path.join(out_dir, "offsets.npy"), offsets)
+    with open(os.path.join(out_dir, "text.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+
+    stat = os.stat(pdf_path)
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "title": title,
+            "source": os.path.basename(pdf_path),
+            "source_size": stat.st_size,
+            "source_mtime": int(stat.st_mtime),
+            "embedder": embedder.name,
+            "dimension": embedder.dimension,
+            "chunks": len(chunks),
+        }, f, indent=2)
+    return len(chunks)
+
+
+def is_up_to_date(pdf_path: str, out_dir: str) -> bool:
+    try:
+        with open(os.path.join(out_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    stat = os.stat(pdf_path)
+    return (meta.get("source_size") == stat.st_size
+            and meta.get("source_mtime") == int(stat.st_mtime)
+            and meta.get("embedder") == get_embedder().name)
+
+
+def load_titles(catalog_path: str) -> Dict[str, str]:
+    """Map PDF file names to titles using books-data.json (entries with pdfUrl + title)."""
+    if not catalog_path:
+        return {}
+    with open(catalog_path, encoding="utf-8") as f:
+        books = json.load(f)
+    return {
+        os.path.basename(book["pdfUrl"]): book["title"]
+        for book in books
+        if book.get("pdfUrl") and book.get("title")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the per-book retrieval index for /api/chat.")
+    parser.add_argument("--pdf-dir", default="../frontend/public/pdfs")
+    parser.add_argument("--catalog", default="../frontend/public/books-data.json",
+                        help="JSON list with pdfUrl/title, used to name books ('' to use file names)")
+    parser.add_argument("--out", default=os.getenv("BOOK_INDEX_DIR", "book_index"))
+    parser.add_argument("--force", action="store_true", help="Rebuild books that are already indexed")
+    args = parser.parse_args()
+
+    titles = load_titles(args.catalog)
+    os.makedirs(args.out, exist_ok=True)
+    manifest_path = os.path.join(args.out, "manifest.json")
+    manifest: Dict[str, str] = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    for name in sorted(os.listdir(args.pdf_dir)):
+        if not name.lower().endswith(".pdf"):
+            continue
+        pdf_path = os.path.join(args.pdf_dir, name)
+        title = titles.get(name, os.path.splitext(name)[0])
+        key = os.path.splitext(name)[0]
+        out_dir = os.path.join(args.out, key)
+        if not args.force and is_up_to_date(pdf_path, out_dir):
+            print(f"Up to date: {title}")
+        else:
+            try:
+                n = build_book_index(pdf_path, title, out_dir)
+                print(f"Indexed {title}: {n} chunks")
+            except Exception as e:
+                print(f"Error indexing {name}: {e}. Skipping.")
+                continue
+        manifest[normalize_title(title)] = key
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Manifest written with {len(manifest)} books")
+
+
+if __name__ == "__main__":
+    main()
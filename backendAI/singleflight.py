@@ -0,0 +1,43 @@
+"""
+Single-flight request coalescing.
+
+Callers whose key matches a call that is already in flight await that call's
+result instead of starting their own. The shared call runs as its own task,
+so one caller disconnecting does not cancel it for the others.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class SingleFlight:
+    def __init__(self, key_fn: Optional[Callable[..., Hashable]] = None):
+        # key_fn receives the same arguments as the wrapped call
+        self.key_fn = key_fn or (lambda *args, **kwargs: (args, tuple(sorted(kwargs.items()))))
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        key = self.key_fn(*args, **kwargs)
+        task = self._in_flight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.started + self.coalesced
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0,
+        }
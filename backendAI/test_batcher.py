@@ -0,0 +1,99 @@
+"""
+Tests for moderation micro-batching: MicroBatcher coalescing, parsing of the
+numbered batch output, and the per-comment retry when that output is malformed.
+
+    python -m pytest test_batcher.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from batcher import MicroBatcher
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setenv("STARTUP_WARMUP", "off")
+    monkeypatch.setenv("EMBEDDING_BACKEND", "hashing")
+    monkeypatch.setenv("MODERATION_CACHE_PATH", "")
+    monkeypatch.setenv("IMAGE_CACHE_DIR", str(tmp_path / "images"))
+    import main
+
+    return main
+
+
+class ScriptedCompletions:
+    """Answers each call with the next of `replies`, recording the user messages."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    async def create(self, **kwargs):
+        self.prompts.append(kwargs["messages"][-1]["content"])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.replies.pop(0)))],
+            usage=SimpleNamespace(prompt_tokens=5, completion_tokens=1, total_tokens=6),
+        )
+
+
+def test_concurrent_submissions_share_one_handler_call():
+    calls = []
+
+    async def handler(items):
+        calls.append(list(items))
+        return [item * 10 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(handler, window=0.01, max_items=3)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        return batcher, results
+
+    batcher, results = asyncio.run(run())
+    assert results == [0, 10, 20, 30, 40]
+    # Full at three items, the other two after the window
+    assert calls == [[0, 1, 2], [3, 4]]
+    assert batcher.stats()["largest_batch"] == 3
+
+
+def test_handler_errors_reach_every_caller_in_the_batch():
+    async def short(items):
+        return items[:-1]
+
+    async def run():
+        batcher = MicroBatcher(short, window=0.01)
+        return await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_batch_output_is_matched_to_items_by_number(main):
+    output = "2. REJECTED: insult, harassment\n\n1) APPROVED\n 3: APPROVED "
+    verdicts = main.parse_batch_output(output, 3)
+    assert [v.is_appropriate for v in verdicts] == [True, False, True]
+    assert verdicts[1].reasons == ["insult", "harassment"]
+
+
+@pytest.mark.parametrize("output", [
+    "1. APPROVED",                                # item 2 missing
+    "1. APPROVED\n2. APPROVED\n3. APPROVED",      # out of range
+    "1. APPROVED\n1. REJECTED: insult",           # answered twice
+    "1. APPROVED\n2. Looks fine to me",           # not a verdict
+])
+def test_incomplete_batch_output_is_refused(main, output):
+    assert main.parse_batch_output(output, 2) is None
+
+
+def test_malformed_batch_output_falls_back_to_one_call_per_comment(main, monkeypatch):
+    completions = ScriptedCompletions(["Both look fine", "APPROVED", "REJECTED: insult"])
+    monkeypatch.setattr(main.llm_pool, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    fallbacks = main.batch_fallbacks
+
+    verdicts = asyncio.run(main.moderate_batch_with_llm(["nice  chapter", "you clown"]))
+
+    assert completions.prompts == ["1. nice chapter\n2. you clown", "nice  chapter", "you clown"]
+    assert [v.is_appropriate for v in verdicts] == [True, False]
+    assert main.batch_fallbacks == fallbacks + 1
@@ -0,0 +1,156 @@
+"""
+Tests for the LLMPool scheduler: priority order, refusal past the deadline
+(and the 429 + Retry-After it becomes in main.py), and handing back a grant
+that arrived after the caller stopped waiting.
+
+    python -m pytest test_llm_pool.py
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from llm_pool import BACKGROUND, CHAT, MODERATION, LLMPool, LLMRateLimited
+
+PRIORITIES = {"moderate": MODERATION, "chat": CHAT, "chat_summary": BACKGROUND}
+
+
+class FakeCompletions:
+    """Records the order calls reach 'Groq' in; each call waits for `gate` if set."""
+
+    def __init__(self):
+        self.calls = []
+        self.gate = None
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs["messages"][0]["content"])
+        if self.gate is not None:
+            await self.gate.wait()
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="ok"))],
+            usage=SimpleNamespace(prompt_tokens=5, completion_tokens=1, total_tokens=6),
+        )
+
+
+def fake_client():
+    return SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+
+
+def make_pool(**kwargs) -> LLMPool:
+    return LLMPool(fake_client, priorities=PRIORITIES, **kwargs)
+
+
+def ask(pool: LLMPool, endpoint: str, text: str):
+    return pool.complete(endpoint, messages=[{"role": "user", "content": text}], max_tokens=10)
+
+
+def test_queued_calls_start_by_priority_then_arrival():
+    async def run():
+        pool = make_pool(max_concurrency=1)
+        completions = pool.client.chat.completions
+        completions.gate = asyncio.Event()
+        holder = asyncio.create_task(ask(pool, "chat", "holder"))
+        await asyncio.sleep(0)
+
+        # Queued lowest class first; each is enqueued before the next arrives
+        queued = []
+        for endpoint, text in [("chat_summary", "summary"), ("chat", "chat-1"), ("moderate", "moderation"),
+                               ("chat", "chat-2")]:
+            queued.append(asyncio.create_task(ask(pool, endpoint, text)))
+            await asyncio.sleep(0)
+        assert pool.stats()["queued_by_priority"] == {"background": 1, "chat": 2, "moderation": 1}
+
+        completions.gate.set()
+        await asyncio.gather(holder, *queued)
+        return completions.calls
+
+    assert asyncio.run(run()) == ["holder", "moderation", "chat-1", "chat-2", "summary"]
+
+
+def test_call_is_refused_when_the_quota_estimate_exceeds_its_deadline():
+    async def run():
+        pool = make_pool(rpm=1, max_wait={CHAT: 0.5})
+        await ask(pool, "chat", "first")
+        with pytest.raises(LLMRateLimited) as refused:
+            await ask(pool, "chat", "second")
+        return pool, refused.value
+
+    pool, error = asyncio.run(run())
+    assert error.reason == "estimate"
+    # One request per minute: the next one fits in about a minute
+    assert 55 < error.retry_after <= 60
+    assert pool.refused == 1
+    assert pool.client.chat.completions.calls == ["first"]
+
+
+def test_call_is_refused_when_its_deadline_passes_in_the_queue():
+    async def run():
+        pool = make_pool(max_concurrency=1, max_wait={CHAT: 0.05})
+        completions = pool.client.chat.completions
+        completions.gate = asyncio.Event()
+        holder = asyncio.create_task(ask(pool, "chat", "holder"))
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        with pytest.raises(LLMRateLimited) as refused:
+            await ask(pool, "chat", "late")
+        waited = time.monotonic() - started
+        completions.gate.set()
+        await holder
+        return pool, refused.value, waited
+
+    pool, error, waited = asyncio.run(run())
+    assert error.reason == "deadline"
+    assert 0.04 < waited < 0.5
+    assert pool.stats()["queue_depth"] == 0
+    assert pool.client.chat.completions.calls == ["holder"]
+
+
+def test_grant_after_the_caller_gave_up_is_handed_back():
+    async def run():
+        pool = make_pool(max_concurrency=1, rpm=60, tpm=1000)
+        # Hold the only slot directly, so the grant below can be timed exactly
+        await pool._acquire("chat", 100, time.monotonic() + 5, seq=0)
+        before = (pool.requests.level, pool.tokens.level)
+        waiter = asyncio.create_task(pool._acquire("moderate", 200, time.monotonic() + 5, seq=1))
+        await asyncio.sleep(0)
+
+        # The slot frees up and is granted to the waiter, which is cancelled before it resumes
+        pool._release()
+        assert pool._running == 1
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        after = (pool.requests.level, pool.tokens.level)
+
+        # Nothing leaked: the next call gets the slot right away
+        await asyncio.wait_for(ask(pool, "chat", "next"), 1)
+        return pool, before, after
+
+    pool, before, after = asyncio.run(run())
+    assert pool._running == 0
+    assert after[0] == pytest.approx(before[0], abs=0.01)
+    assert after[1] == pytest.approx(before[1], abs=1)
+    assert pool.client.chat.completions.calls == ["next"]
+
+
+def test_refusal_becomes_429_with_retry_after(monkeypatch, tmp_path):
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+    monkeypatch.setenv("STARTUP_WARMUP", "off")
+    monkeypatch.setenv("EMBEDDING_BACKEND", "hashing")
+    monkeypatch.setenv("MODERATION_CACHE_PATH", "")
+    monkeypatch.setenv("IMAGE_CACHE_DIR", str(tmp_path / "images"))
+    from fastapi.testclient import TestClient
+
+    import main
+
+    # One request per minute, so the second chat has to wait about a minute
+    main.llm_pool.client = fake_client()
+    main.llm_pool.requests = type(main.llm_pool.requests)(1)
+    with TestClient(main.app) as client:
+        first = client.post("/api/chat", json={"message": "Who is the narrator?", "book_title": "Test"})
+        second = client.post("/api/chat", json={"message": "Why does she leave?", "book_title": "Test"})
+
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert 55 <= int(second.headers["Retry-After"]) <= 60
@@ -0,0 +1,60 @@
+"""
+Tests for the moderation verdict cache: keys follow the normalized text,
+verdicts are namespaced by prompt and model (stale namespaces are purged from
+disk), and SQLite hits are promoted into memory.
+
+    python -m pytest test_moderation_cache.py
+"""
+import asyncio
+
+from moderation_cache import MemoryLRUBackend, ModerationCache, build_moderation_cache
+
+REJECTED = {"is_appropriate": False, "message": "Comment rejected", "reasons": ["insult"]}
+
+
+def test_equivalent_spellings_share_a_key():
+    cache = build_moderation_cache("prompt", "model", "", max_entries=10, ttl=60)
+    cache.set("You  CLOWN", REJECTED)
+    assert cache.get("you clown") == REJECTED
+    assert cache.get("you clowns") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_changing_the_prompt_or_model_changes_every_key():
+    memory = MemoryLRUBackend()
+    old = ModerationCache(memory, "prompt v1", "model")
+    old.set("you clown", REJECTED)
+
+    assert ModerationCache(memory, "prompt v2", "model").get("you clown") is None
+    assert ModerationCache(memory, "prompt v1", "other-model").get("you clown") is None
+    assert ModerationCache(memory, "prompt v1", "model").get("you clown") == REJECTED
+
+
+def test_stale_namespaces_are_purged_from_disk(tmp_path):
+    path = str(tmp_path / "moderation.sqlite3")
+    old = build_moderation_cache("prompt v1", "model", path, max_entries=10, ttl=60)
+    old.set("you clown", REJECTED)
+    assert len(old.backend) == 1
+
+    # A restart with the same prompt keeps the row; a new prompt drops it
+    assert build_moderation_cache("prompt v1", "model", path, max_entries=10, ttl=60).get("you clown") == REJECTED
+    new = build_moderation_cache("prompt v2", "model", path, max_entries=10, ttl=60)
+    assert len(new.backend) == 0
+
+
+def test_disk_hits_are_promoted_into_memory(tmp_path):
+    path = str(tmp_path / "moderation.sqlite3")
+    build_moderation_cache("prompt", "model", path, max_entries=10, ttl=60).set("you clown", REJECTED)
+
+    async def run():
+        cache = build_moderation_cache("prompt", "model", path, max_entries=10, ttl=60)
+        assert len(cache.backend.memory) == 0
+        first = await cache.aget("you clown")
+        assert len(cache.backend.memory) == 1
+        await cache.aset("great chapter", {"is_appropriate": True, "message": "Comment allowed", "reasons": []})
+        return cache, first
+
+    cache, first = asyncio.run(run())
+    assert first == REJECTED
+    assert cache.stats()["entries"] == 2
+    assert (cache.hits, cache.misses) == (1, 0)
@@ -0,0 +1,77 @@
+"""
+Tests for the local moderation pre-classifier: only hits aimed at someone are
+rejected locally, bare hits and everything else go to the LLM, and exact
+known-safe phrases are approved.
+
+    python -m pytest test_prefilter.py
+"""
+import json
+
+import pytest
+
+from prefilter import load_preclassifier
+
+
+@pytest.fixture
+def classifier():
+    return load_preclassifier()
+
+
+@pytest.mark.parametrize("text, reasons", [
+    ("you idiot", ["insult"]),
+    ("You're such a LOSER", ["insult"]),
+    ("shut up you", ["harassment"]),
+    ("kill yourself", ["self-harm"]),
+    ("kys", ["self-harm"]),
+    ("@maria this take is stupid", ["insult"]),
+    # Leetspeak and stretched spellings
+    ("u r a l0000ser", ["insult"]),
+    ("you are so stuuupid", ["insult"]),
+])
+def test_targeted_hits_are_rejected_locally(classifier, text, reasons):
+    assert classifier.classify(text) == (False, reasons)
+
+
+@pytest.mark.parametrize("text", [
+    "the dumb waiter scene was great",
+    "the villain is such a loser",
+    "what a shitty ending",
+    # "you" too far from the term to address anyone
+    "did you notice the stupid plot twist in chapter 3",
+])
+def test_bare_hits_go_to_the_llm(classifier, text):
+    assert classifier.classify(text) is None
+    assert classifier.stats()["untargeted_hits"] == 1
+
+
+@pytest.mark.parametrize("text", ["Great book!", "  loved   it ", "5 stars", "10/10", "Thank you."])
+def test_known_safe_phrases_are_approved(classifier, text):
+    assert classifier.classify(text) == (True, [])
+
+
+def test_anything_else_goes_to_the_llm(classifier):
+    assert classifier.classify("Great book, but the middle drags") is None
+    assert classifier.classify("I think the narrator is lying to us") is None
+    assert classifier.stats() == {
+        "lexicon_terms": classifier.stats()["lexicon_terms"],
+        "rejected": 0,
+        "approved": 0,
+        "escalated": 2,
+        "untargeted_hits": 0,
+    }
+
+
+def test_lexicon_file_replaces_the_defaults(tmp_path):
+    path = tmp_path / "lexicon.json"
+    path.write_text(json.dumps({
+        "reject": {"spoiler": ["bruce willis was dead"]},
+        "directed": ["bruce willis was dead"],
+        "approve": ["nice"],
+    }))
+    classifier = load_preclassifier(str(path))
+
+    assert classifier.classify("BRUCE WILLIS WAS DEAD") == (False, ["spoiler"])
+    assert classifier.classify("nice") == (True, [])
+    # Not in this lexicon
+    assert classifier.classify("you idiot") is None
+    assert classifier.classify("great book") is None
@@ -0,0 +1,166 @@
+"""
+Local OpenAI/Groq-compatible chat completion server, for benchmarks.
+
+Answers POST /openai/v1/chat/completions (the path the Groq SDK uses; set
+GROQ_BASE_URL to this server) and /v1/chat/completions (OpenAI SDKs), with
+and without `stream`. Replies are deterministic and shaped like what the
+backend parses:
+
+    moderation prompt        "APPROVED", or "REJECTED: ..." for texts containing a BLOCKLIST word
+    batch moderation prompt  one "<n>. APPROVED" / "<n>. REJECTED: ..." line per numbered comment
+    anything else            `reply_tokens` words of filler
+
+Latency is `latency_ms` before the first token plus `token_ms` per output
+token, so streamed and non-streamed calls cost the same in total. With
+`rpm` set, requests beyond that many per minute get a 429 with
+Retry-After, like Groq's rate limiter. GET /openai/v1/models (what the
+backend's warm-up calls) lists one model and is never rate limited.
+GET /__calls returns request and token counts per kind.
+
+Usage:
+    python fake_groq.py --port 8090 --latency-ms 150 --token-ms 2
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+BLOCKLIST = ("hate", "idiot", "kill")
+FILLER = ("the", "captain", "keeps", "a", "careful", "log", "of", "every", "storm", "and", "each", "quiet", "harbour")
+_NUMBERED_RE = re.compile(r"^(\d+)\.\s*(.*)$")
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _verdict(text: str) -> str:
+    hits = [word for word in BLOCKLIST if word in text.lower()]
+    return f"REJECTED: abusive language ({', '.join(hits)})" if hits else "APPROVED"
+
+
+def reply_for(messages: List[Dict[str, Any]], reply_tokens: int) -> Tuple[str, str]:
+    """(kind, reply text) for a chat completion request."""
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    if "content moderation engine" in system:
+        if "numbered comments" in system:
+            lines = [_NUMBERED_RE.match(line) for line in user.splitlines()]
+            return "moderate_batch", "\n".join(f"{m.group(1)}. {_verdict(m.group(2))}" for m in lines if m)
+        return "moderate", _verdict(user)
+    words = [FILLER[i % len(FILLER)] for i in range(reply_tokens)]
+    return "chat", " ".join(words).capitalize() + "."
+
+
+def create_app(latency_ms: float = 150.0, token_ms: float = 2.0, reply_tokens: int = 60, rpm: int = 0) -> FastAPI:
+    app = FastAPI()
+    calls: Counter = Counter()
+    window = {"start": time.monotonic(), "count": 0}
+
+    def rate_limited() -> float:
+        """Seconds until the current one-minute window resets, or 0 if the request is allowed."""
+        if not rpm:
+            return 0.0
+        now = time.monotonic()
+        if now - window["start"] >= 60:
+            window["start"], window["count"] = now, 0
+        if window["count"] >= rpm:
+            return 60 - (now - window["start"])
+        window["count"] += 1
+        return 0.0
+
+    async def completions(request: Request):
+        body = await request.json()
+        retry_after = rate_limited()
+        if retry_after:
+            calls["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": f"{retry_after:.2f}", "x-ratelimit-limit-requests": str(rpm)},
+            )
+
+        kind, text = reply_for(body.get("messages", []), reply_tokens)
+        prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in body.get("messages", []))
+        tokens = text.split(" ")
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        calls[kind + ("_stream" if body.get("stream") else "")] += 1
+        calls["prompt_tokens"] += prompt_tokens
+        calls["completion_tokens"] += len(tokens)
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": body.get("model", "fake")}
+
+        await asyncio.sleep(latency_ms / 1000)
+        if not body.get("stream"):
+            await asyncio.sleep(token_ms * len(tokens) / 1000)
+            return JSONResponse({
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        async def events():
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(token_ms / 1000)
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": token if i == 0 else " " + token}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            # Groq reports usage on the final chunk
+            last = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "x_groq": {"id": base["id"], "usage": usage},
+            }
+            yield f"data: {json.dumps(last)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def models():
+        calls["models"] += 1
+        return {"object": "list", "data": [{"id": "llama-3.1-8b-instant", "object": "model", "owned_by": "fake"}]}
+
+    app.add_api_route("/openai/v1/chat/completions", completions, methods=["POST"])
+    app.add_api_route("/v1/chat/completions", completions, methods=["POST"])
+    app.add_api_route("/openai/v1/models", models, methods=["GET"])
+    app.add_api_route("/v1/models", models, methods=["GET"])
+
+    @app.get("/__calls")
+    async def get_calls():
+        return dict(calls)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=150.0, help="Before the first token")
+    parser.add_argument("--token-ms", type=float, default=2.0, help="Per output token")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="Length of chat replies")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before 429s (0 = unlimited)")
+    args = parser.parse_args()
+    app = create_app(args.latency_ms, args.token_ms, args.reply_tokens, args.rpm)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
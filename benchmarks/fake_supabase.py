@@ -0,0 +1,296 @@
+"""
+Local PostgREST-compatible stand-in for Supabase, for benchmarks.
+
+Serves synthetic `books`, `user_profiles`, `user_books`, `book_ratings` and
+`book_wishlist` tables and the `get_full_user_history` / `get_popular_books` RPCs under
+/rest/v1, so the supabase client in the recommendation service talks to it
+unchanged (point SUPABASE_URL here; any key works). It supports the subset
+of PostgREST the services use: eq/neq/gt/gte/lt/lte/in/cs/is filters,
+select, order (incl. nullslast), limit/offset, `Prefer: count=exact`, and
+single-object responses. GET /auth/v1/user accepts "user-<n>" as that
+user's access token.
+
+Every request waits `latency_ms` (plus up to `jitter_ms`) before answering,
+to stand in for the network round trip. GET /__calls returns how many
+requests each table / RPC got.
+
+Usage:
+    python fake_supabase.py --port 54321 --books 20000 --users 500 --latency-ms 5
+"""
+import argparse
+import asyncio
+import random
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+GENRES = [
+    "Fiction", "History", "Science", "Poetry", "Drama", "Adventure", "Romance", "Mystery",
+    "Philosophy", "Children", "Horror", "Biography", "Travel", "Humor", "Religion", "Economics",
+]
+LANGUAGES = ["en", "fr", "de", "es", "pt", "it"]
+
+
+# --- 1. Synthetic data ---
+
+def make_data(books: int = 5000, users: int = 500, history_max: int = 60, seed: int = 7) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Deterministic for a given seed. Users are `user-0` .. `user-<n-1>`; every
+    10th user has no history (cold start) and every 3rd has no saved genres.
+    Users with history also have a few books they only rated or wishlisted.
+    """
+    rnd = random.Random(seed)
+    authors = [f"Author {i}" for i in range(max(10, books // 8))]
+    rows = []
+    for book_id in range(1, books + 1):
+        genres = rnd.sample(GENRES, rnd.randint(1, 3))
+        rows.append({
+            "id": book_id,
+            "title": f"Book {book_id}",
+            "author": rnd.choice(authors),
+            "cover_image": f"https://covers.example/{book_id}.jpg",
+            "genres": genres,
+            "genre": genres[0],
+            "language": rnd.choice(LANGUAGES),
+            "number_of_downloads": int(rnd.paretovariate(1.2) * 100),
+            "created_at": f"2024-01-{1 + book_id % 28:02d}T00:00:00Z",
+            "updated_at": "2024-01-01T00:00:00Z",
+        })
+
+    profiles, user_books, ratings, wishlist = [], [], [], []
+    for n in range(users):
+        user_id = f"user-{n}"
+        if n % 3:
+            profiles.append({"user_id": user_id, "genres": rnd.sample(GENRES, 2)})
+        count = 0 if n % 10 == 0 else rnd.randint(1, history_max)
+        sampled = rnd.sample(range(1, books + 1), min(count + (4 if count else 0), books))
+        for i, book_id in enumerate(sampled[:count]):
+            rating = rnd.randint(0, 5)
+            user_books.append({
+                "user_id": user_id,
+                "book_id": book_id,
+                "status": "read",
+                "scroll_depth": rnd.randint(0, 100),
+                "updated_at": f"2024-02-{1 + i % 28:02d}T{i % 24:02d}:00:00Z",
+            })
+            if rating:
+                ratings.append({"user_id": user_id, "book_id": book_id, "rating": rating})
+            if book_id % 4 == 0:
+                wishlist.append({"user_id": user_id, "book_id": book_id, "created_at": "2024-01-15T00:00:00Z"})
+        for book_id in sampled[count:count + 2]:
+            ratings.append({"user_id": user_id, "book_id": book_id, "rating": rnd.randint(1, 5)})
+        for book_id in sampled[count + 2:]:
+            wishlist.append({"user_id": user_id, "book_id": book_id, "created_at": "2024-03-01T00:00:00Z"})
+    return {
+        "books": rows, "user_profiles": profiles, "user_books": user_books,
+        "book_ratings": ratings, "book_wishlist": wishlist,
+    }
+
+
+# --- 2. PostgREST query subset ---
+
+def _parse_list(arg: str) -> List[Any]:
+    values = []
+    for value in arg.strip("()").split(","):
+        value = value.strip().strip('"')
+        values.append(int(value) if value.lstrip("-").isdigit() else value)
+    return values
+
+
+def _matches(row: Dict[str, Any], column: str, expr: str) -> bool:
+    negate = expr.startswith("not.")
+    if negate:
+        expr = expr[4:]
+    op, _, arg = expr.partition(".")
+    value = row.get(column)
+
+    def cast(a: str) -> Any:
+        return int(a) if isinstance(value, int) and a.lstrip("-").isdigit() else a
+
+    if op == "eq":
+        result = value == cast(arg)
+    elif op == "neq":
+        result = value != cast(arg)
+    elif op in ("gt", "gte", "lt", "lte"):
+        if value is None:
+            result = False
+        else:
+            other = cast(arg)
+            result = {"gt": value > other, "gte": value >= other, "lt": value < other, "lte": value <= other}[op]
+    elif op == "in":
+        result = value in _parse_list(arg)
+    elif op == "cs":
+        wanted = [w.strip().strip('"') for w in arg.strip("{}").split(",") if w.strip()]
+        result = isinstance(value, list) and all(w in value for w in wanted)
+    elif op == "is":
+        result = value is None if arg == "null" else value == (arg == "true")
+    else:
+        raise ValueError(f"unsupported operator: {op}")
+    return not result if negate else result
+
+
+def _order(rows: List[Dict[str, Any]], spec: str) -> List[Dict[str, Any]]:
+    for part in reversed(spec.split(",")):
+        column, *flags = part.split(".")
+        present = [r for r in rows if r.get(column) is not None]
+        missing = [r for r in rows if r.get(column) is None]
+        present.sort(key=lambda r: r[column], reverse="desc" in flags)
+        nulls_first = "nullsfirst" in flags or ("desc" in flags and "nullslast" not in flags)
+        rows = missing + present if nulls_first else present + missing
+    return rows
+
+
+def apply_query(rows: List[Dict[str, Any]], params: List[Tuple[str, str]]) -> Tuple[List[Dict[str, Any]], int]:
+    """Filters, orders, pages and projects `rows`; returns (page, total before paging)."""
+    select, order, limit, offset = None, None, None, 0
+    for key, value in params:
+        if key == "select":
+            select = [c.strip() for c in value.split(",")]
+        elif key == "order":
+            order = value
+        elif key == "limit":
+            limit = int(value)
+        elif key == "offset":
+            offset = int(value)
+        else:
+            rows = [r for r in rows if _matches(r, key, value)]
+    if order:
+        rows = _order(rows, order)
+    total = len(rows)
+    rows = rows[offset:]
+    if limit is not None:
+        rows = rows[:limit]
+    if select and select != ["*"]:
+        rows = [{c: r.get(c) for c in select} for r in rows]
+    return rows, total
+
+
+def _error(code: str, message: str, status: int) -> JSONResponse:
+    return JSONResponse({"code": code, "message": message, "details": None, "hint": None}, status_code=status)
+
+
+# --- 3. App ---
+
+def create_app(data: Dict[str, List[Dict[str, Any]]], latency_ms: float = 0.0, jitter_ms: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    calls: Counter = Counter()
+    by_user: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    for table in ("user_books", "user_profiles", "book_ratings", "book_wishlist"):
+        index = defaultdict(list)
+        for row in data[table]:
+            index[row["user_id"]].append(row)
+        by_user[table] = index
+    ratings = {(r["user_id"], r["book_id"]): r["rating"] for r in data["book_ratings"]}
+    popular = sorted(data["books"], key=lambda b: -b["number_of_downloads"])[:10]
+
+    async def wait() -> None:
+        delay = latency_ms + (random.uniform(0, jitter_ms) if jitter_ms else 0)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+    def rows_for(table: str, params: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        # Per-user tables are looked up by user_id instead of scanned
+        user = next((v[3:] for k, v in params if k == "user_id" and v.startswith("eq.")), None)
+        if user is not None and table in by_user:
+            return by_user[table].get(user, [])
+        return data[table]
+
+    def history(user_id: Optional[str]) -> List[Dict[str, Any]]:
+        # Like the SQL function: every book the user read, rated or wishlisted, newest first
+        user_books = {r["book_id"]: r for r in by_user["user_books"].get(user_id, [])}
+        wishlisted = {r["book_id"]: r for r in by_user["book_wishlist"].get(user_id, [])}
+        book_ids = set(user_books) | set(wishlisted) | {r["book_id"] for r in by_user["book_ratings"].get(user_id, [])}
+        rows = [
+            {
+                "book_id": book_id,
+                "scroll_depth": user_books[book_id]["scroll_depth"] if book_id in user_books else 0,
+                "rating": ratings.get((user_id, book_id), 0),
+                "was_in_watchlist": book_id in wishlisted,
+                "updated_at": (
+                    user_books[book_id]["updated_at"] if book_id in user_books
+                    else wishlisted[book_id]["created_at"] if book_id in wishlisted
+                    else "2024-01-01T00:00:00Z"
+                ),
+            }
+            for book_id in book_ids
+        ]
+        return sorted(rows, key=lambda r: r["updated_at"], reverse=True)
+
+    def respond(rows: List[Dict[str, Any]], total: int, request: Request) -> JSONResponse:
+        headers = {}
+        if "count=" in request.headers.get("prefer", ""):
+            headers["Content-Range"] = f"0-{max(len(rows) - 1, 0)}/{total}"
+        if "vnd.pgrst.object" in request.headers.get("accept", ""):
+            if len(rows) != 1:
+                return _error("PGRST116", "JSON object requested, multiple (or no) rows returned", 406)
+            return JSONResponse(rows[0], headers=headers)
+        return JSONResponse(rows, headers=headers)
+
+    @app.api_route("/rest/v1/rpc/{fn}", methods=["GET", "POST"])
+    async def rpc(fn: str, request: Request):
+        calls[f"rpc/{fn}"] += 1
+        await wait()
+        body = await request.json() if request.method == "POST" else {}
+        if fn == "get_full_user_history":
+            rows = history(body.get("p_user_id"))
+        elif fn == "get_popular_books":
+            rows = [{k: b[k] for k in ("id", "title", "author", "cover_image")} for b in popular]
+        else:
+            return _error("PGRST202", f"Could not find the function public.{fn}", 404)
+        rows, total = apply_query(rows, list(request.query_params.multi_items()))
+        return respond(rows, total, request)
+
+    @app.get("/rest/v1/{table}")
+    async def table(table: str, request: Request):
+        calls[table] += 1
+        await wait()
+        if table not in data:
+            return _error("42P01", f"relation public.{table} does not exist", 404)
+        params = list(request.query_params.multi_items())
+        try:
+            rows, total = apply_query(rows_for(table, params), params)
+        except KeyError as e:
+            return _error("42703", f"column {e} does not exist", 400)
+        return respond(rows, total, request)
+
+    @app.get("/auth/v1/user")
+    async def auth_user(request: Request):
+        # Any bearer token "user-<n>" is that user's session
+        calls["auth/user"] += 1
+        await wait()
+        token = request.headers.get("authorization", "").partition(" ")[2]
+        if not token.startswith("user-"):
+            return JSONResponse({"code": 401, "msg": "invalid JWT"}, status_code=401)
+        return {
+            "id": token, "aud": "authenticated", "role": "authenticated",
+            "created_at": "2024-01-01T00:00:00Z", "app_metadata": {}, "user_metadata": {},
+        }
+
+    @app.get("/__calls")
+    async def get_calls():
+        return dict(calls)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--history-max", type=int, default=60, help="Most user_books rows per user")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Extra uniform random delay")
+    args = parser.parse_args()
+    data = make_data(args.books, args.users, args.history_max, args.seed)
+    app = create_app(data, args.latency_ms, args.jitter_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Closed-loop load generator for the recommendation service and backendAI.
+
+Runs each scenario in turn. A scenario keeps `concurrency` requests in
+flight until `requests` have completed, after `warmup` requests that are not
+counted:
+
+    recommendations   GET  {recs}/recommendations/user-<n>
+    explore           GET  {recs}/explore/user-<n>
+    moderate          POST {ai}/api/moderate     a share of the comments repeat (--repeat)
+    chat              POST {ai}/api/chat         opening questions about a few books and pages
+
+Users are drawn uniformly from user-0 .. user-<users-1>, the IDs
+fake_supabase.py generates. Per scenario the report has latency
+p50/p95/p99/max, throughput, status codes, and how many calls each fake
+upstream received (from their /__calls endpoints, if reachable).
+
+Usage:
+    python loadgen.py --concurrency 32 --requests 2000 --out results/today.json
+    python loadgen.py --scenarios moderate,chat --compare results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+SCENARIOS = ("recommendations", "explore", "moderate", "chat")
+
+COMMENT_WORDS = (
+    "loved", "this", "chapter", "the", "ending", "was", "slow", "but", "worth", "it", "great", "pacing",
+    "characters", "felt", "real", "idiot", "plot", "twist", "beautiful", "writing", "boring", "middle",
+)
+QUESTIONS = (
+    "Who is the narrator?", "What just happened in this chapter?", "Why did she leave the house?",
+    "Summarize the story so far.", "What does the storm symbolize?", "Who are the main characters?",
+)
+
+
+# --- 1. Request makers ---
+
+def make_request(scenario: str, args: argparse.Namespace, rnd: random.Random) -> Callable[[httpx.AsyncClient], Awaitable[httpx.Response]]:
+    """Returns a function that sends one request of `scenario`."""
+    if scenario in ("recommendations", "explore"):
+        def send(client):
+            return client.get(f"{args.recs}/{scenario}/user-{rnd.randrange(args.users)}")
+        return send
+
+    if scenario == "moderate":
+        repeated = [" ".join(rnd.choices(COMMENT_WORDS, k=8)) for _ in range(50)]
+
+        def send(client):
+            if rnd.random() < args.repeat:
+                text = rnd.choice(repeated)
+            else:
+                text = " ".join(rnd.choices(COMMENT_WORDS, k=10)) + f" #{rnd.randrange(10 ** 9)}"
+            return client.post(f"{args.ai}/api/moderate", json={"text": text})
+        return send
+
+    if scenario == "chat":
+        def send(client):
+            return client.post(f"{args.ai}/api/chat", json={
+                "message": rnd.choice(QUESTIONS),
+                "book_title": f"Book {rnd.randrange(args.chat_books) + 1}",
+                "current_page": rnd.randrange(1, 300),
+                "total_pages": 300,
+            })
+        return send
+
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+# --- 2. Running a scenario ---
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = min(max(1, math.ceil(q * len(sorted_values))), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+async def upstream_calls(client: httpx.AsyncClient, urls: Dict[str, str]) -> Dict[str, Dict[str, int]]:
+    counts = {}
+    for name, url in urls.items():
+        if not url:
+            continue
+        try:
+            counts[name] = (await client.get(f"{url}/__calls", timeout=5)).json()
+        except httpx.HTTPError:
+            pass
+    return counts
+
+
+def diff_calls(before: Dict[str, Dict[str, int]], after: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    return {
+        name: {key: value - before.get(name, {}).get(key, 0) for key, value in counts.items()
+               if value - before.get(name, {}).get(key, 0)}
+        for name, counts in after.items()
+    }
+
+
+async def run_scenario(scenario: str, args: argparse.Namespace) -> Dict[str, Any]:
+    rnd = random.Random(f"{args.seed}:{scenario}")
+    send = make_request(scenario, args, rnd)
+    upstreams = {"supabase": args.supabase, "groq": args.groq}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        async def drive(total: int, latencies: List[float], statuses: Counter) -> None:
+            remaining = iter(range(total))
+
+            async def worker():
+                for _ in remaining:
+                    start = time.perf_counter()
+                    try:
+                        response = await send(client)
+                        statuses[str(response.status_code)] += 1
+                    except httpx.HTTPError as e:
+                        statuses[type(e).__name__] += 1
+                    latencies.append(time.perf_counter() - start)
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+        await drive(args.warmup, [], Counter())
+        before = await upstream_calls(client, upstreams)
+        latencies: List[float] = []
+        statuses: Counter = Counter()
+        started = time.perf_counter()
+        await drive(args.requests, latencies, statuses)
+        elapsed = time.perf_counter() - started
+        after = await upstream_calls(client, upstreams)
+
+    latencies.sort()
+    ok = sum(n for status, n in statuses.items() if status.startswith("2"))
+    return {
+        "requests": len(latencies),
+        "errors": len(latencies) - ok,
+        "status": dict(statuses),
+        "concurrency": args.concurrency,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else 0.0,
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+        "upstream_calls": diff_calls(before, after),
+    }
+
+
+# --- 3. Reporting ---
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(results: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    header = f"{'scenario':<16}{'req':>7}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  upstream calls"
+    print(header)
+    print("-" * len(header))
+    for name, r in results["scenarios"].items():
+        upstream = ", ".join(f"{k}={v}" for counts in r["upstream_calls"].values() for k, v in counts.items())
+        lat = r["latency_ms"]
+        print(f"{name:<16}{r['requests']:>7}{r['errors']:>6}{r['throughput_rps']:>9.1f}"
+              f"{lat['p50']:>10.1f}{lat['p95']:>10.1f}{lat['p99']:>10.1f}  {upstream}")
+        old = (baseline or {}).get("scenarios", {}).get(name)
+        if old:
+            def delta(new: float, previous: float) -> str:
+                return f"{(new - previous) / previous * 100:+.0f}%" if previous else "n/a"
+            print(f"{'  vs baseline':<29}{delta(r['throughput_rps'], old['throughput_rps']):>9}"
+                  f"{delta(lat['p50'], old['latency_ms']['p50']):>10}{delta(lat['p95'], old['latency_ms']['p95']):>10}"
+                  f"{delta(lat['p99'], old['latency_ms']['p99']):>10}")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        },
+        "scenarios": {},
+    }
+    for scenario in args.scenarios:
+        print(f"Running {scenario}: {args.requests} requests at concurrency {args.concurrency}...", file=sys.stderr)
+        results["scenarios"][scenario] = await run_scenario(scenario, args)
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recs", default="http://127.0.0.1:8010", help="Recommendation service URL")
+    parser.add_argument("--ai", default="http://127.0.0.1:8011", help="backendAI URL")
+    parser.add_argument("--supabase", default="http://127.0.0.1:54321", help="fake_supabase.py URL ('' to skip counts)")
+    parser.add_argument("--groq", default="http://127.0.0.1:8090", help="fake_groq.py URL ('' to skip counts)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda s: [x.strip() for x in s.split(",") if x.strip()])
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="Counted requests per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="Uncounted requests per scenario")
+    parser.add_argument("--users", type=int, default=500, help="Same as fake_supabase.py --users")
+    parser.add_argument("--repeat", type=float, default=0.5, help="Share of moderation comments that repeat")
+    parser.add_argument("--chat-books", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Write the results as JSON here")
+    parser.add_argument("--compare", help="Earlier results JSON to print deltas against")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: Optional[List[str]] = None, setup: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """`setup` (e.g. fake data size and latencies from run.py) is recorded in the results' meta."""
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    if setup:
+        results["meta"]["setup"] = setup
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}", file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+One-command offline benchmark of both Python services.
+
+Starts fake_supabase.py and fake_groq.py, then the recommendation service
+(frontend/ai-suggestion) and backendAI against them, each under uvicorn on
+a free local port. It waits until everything answers and the services'
+startup warm-up has finished, runs loadgen.py, and stops everything again. Nothing leaves the machine. Service state (the
+moderation cache, etc.) lives in a fresh temporary directory, so every run
+starts cold, and the service logs are kept there for inspection.
+
+Arguments after `--` go to loadgen.py:
+
+    python run.py --out results/$(git rev-parse --short HEAD).json
+    python run.py --books 50000 --supabase-latency-ms 20 -- --concurrency 64 --requests 5000
+    python run.py --compare results/baseline.json -- --scenarios recommendations,explore
+
+Environment variables set here override the services' .env files; other
+settings (LLM_MAX_CONCURRENCY, REC_CACHE_TTL_SECONDS, ...) pass through from
+the calling shell, so configurations can be compared run against run.
+
+The load generator, the fakes and the services share this machine's CPUs,
+so only compare results taken on the same machine.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import httpx
+
+import loadgen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RECS_DIR = os.path.join(ROOT, "frontend", "ai-suggestion")
+AI_DIR = os.path.join(ROOT, "backendAI")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {proc.returncode} before becoming ready")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def wait_warm(url: str, timeout: float) -> None:
+    """Waits until a service's /healthz reports its startup warm-up as finished (or off)."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if httpx.get(f"{url}/healthz", timeout=1).json()["warmup"]["status"] not in ("pending", "running"):
+            return
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} still warming up after {timeout}s")
+
+
+def service_envs(urls: Dict[str, str], workdir: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """(recommendation service env, backendAI env) pointing at the fakes, with state under `workdir`."""
+    base_env = {**os.environ, "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING")}
+    base_env.setdefault("EMBEDDING_BACKEND", "hashing")  # no model download
+    recs_env = {
+        **base_env,
+        "SUPABASE_URL": urls["supabase"],
+        "SUPABASE_SERVICE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.benchmark",
+        "PRECOMPUTED_DB": "",
+        "VECTOR_INDEX_DIR": os.path.join(workdir, "book_vectors"),
+    }
+    ai_env = {
+        **base_env,
+        "GROQ_API_KEY": "benchmark",
+        "GROQ_BASE_URL": urls["groq"],
+        "MODERATION_CACHE_PATH": os.path.join(workdir, "moderation_cache.sqlite3"),
+        "BOOK_INDEX_DIR": os.path.join(workdir, "book_index"),
+        "CHAT_SESSION_DB": "",
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "image_cache"),
+        "IMAGE_UPSTREAM": base_env.get("IMAGE_UPSTREAM", "stub"),
+        # No local Groq quota unless the calling shell sets one (see --groq-rpm for upstream 429s)
+        "LLM_RPM": base_env.get("LLM_RPM", "0"),
+        "LLM_TPM": base_env.get("LLM_TPM", "0"),
+    }
+    return recs_env, ai_env
+
+
+def fake_commands(args: argparse.Namespace, ports: Dict[str, int]) -> Dict[str, Tuple[List[str], str, str]]:
+    """name -> (command, cwd, ready path) for fake_supabase.py and fake_groq.py."""
+    return {
+        "supabase": ([sys.executable, "fake_supabase.py", "--port", str(ports["supabase"]), "--books", str(args.books),
+                      "--users", str(args.users), "--latency-ms", str(args.supabase_latency_ms),
+                      "--jitter-ms", str(args.supabase_jitter_ms)], HERE, "/__calls"),
+        "groq": ([sys.executable, "fake_groq.py", "--port", str(ports["groq"]), "--latency-ms", str(args.groq_latency_ms),
+                  "--token-ms", str(args.groq_token_ms), "--rpm", str(args.groq_rpm)], HERE, "/__calls"),
+    }
+
+
+def uvicorn_command(port: int, workers: int = 1) -> List[str]:
+    return [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning", "--workers", str(workers)]
+
+
+def spawn(name: str, cmd: List[str], cwd: str, env: Dict[str, str], workdir: str) -> subprocess.Popen:
+    """Starts `cmd` with its output in <workdir>/<name>.log."""
+    log = open(os.path.join(workdir, f"{name}.log"), "w")
+    return subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop(procs: Iterable[subprocess.Popen]) -> None:
+    procs = list(procs)
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--supabase-latency-ms", type=float, default=5.0)
+    parser.add_argument("--supabase-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--groq-latency-ms", type=float, default=150.0)
+    parser.add_argument("--groq-token-ms", type=float, default=2.0)
+    parser.add_argument("--groq-rpm", type=int, default=0, help="Simulated Groq rate limit (0 = none)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_fake_arguments(parser)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers per service")
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--out", help="Write the results as JSON here")
+    parser.add_argument("--compare", help="Earlier results JSON to print deltas against")
+    args, loadgen_args = parser.parse_known_args()
+    if loadgen_args[:1] == ["--"]:
+        loadgen_args = loadgen_args[1:]
+
+    ports = {name: free_port() for name in ("supabase", "groq", "recs", "ai")}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+    workdir = tempfile.mkdtemp(prefix="nextchapter-bench-")
+    print(f"Logs and service state in {workdir}", file=sys.stderr)
+
+    recs_env, ai_env = service_envs(urls, workdir)
+    commands = {name: (cmd, cwd, os.environ, ready_path) for name, (cmd, cwd, ready_path) in fake_commands(args, ports).items()}
+    commands["recs"] = (uvicorn_command(ports["recs"], args.workers), RECS_DIR, recs_env, "/healthz")
+    commands["ai"] = (uvicorn_command(ports["ai"], args.workers), AI_DIR, ai_env, "/healthz")
+
+    procs: Dict[str, subprocess.Popen] = {}
+    try:
+        for name, (cmd, cwd, env, ready_path) in commands.items():
+            procs[name] = spawn(name, cmd, cwd, env, workdir)
+            wait_ready(urls[name] + ready_path, procs[name], args.startup_timeout)
+        # Measure the warm services; startup.py measures cold starts
+        for name in ("recs", "ai"):
+            wait_warm(urls[name], args.startup_timeout)
+
+        argv = ["--recs", urls["recs"], "--ai", urls["ai"], "--supabase", urls["supabase"], "--groq", urls["groq"],
+                "--users", str(args.users)]
+        if args.out:
+            argv += ["--out", args.out]
+        if args.compare:
+            argv += ["--compare", args.compare]
+        setup = {k: v for k, v in vars(args).items() if k not in ("out", "compare", "startup_timeout")}
+        loadgen.main(argv + loadgen_args, setup=setup)
+    finally:
+        stop(procs.values())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Cold-start benchmark for both Python services.
+
+Starts fake_supabase.py and fake_groq.py once, then starts each service
+`--runs` times per STARTUP_WARMUP mode, a fresh process and state directory
+each time, and records:
+
+    import_s     `import main` in a fresh interpreter (no server)
+    listen_s     process spawn to the first 200 from GET /healthz
+    first_ok_s   process spawn to the first successful real request
+                 (GET /recommendations/user-1, POST /api/moderate)
+    warm_s       process spawn until /healthz reports the warm-up finished
+
+Medians are printed per service and mode; --out keeps every run as JSON.
+
+Usage:
+    python startup.py
+    python startup.py --runs 10 --modes background,blocking --out results/startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+import run
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+MODES = ("background", "blocking", "off")
+
+
+def measure_import(cwd: str, env: Dict[str, str]) -> float:
+    out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=cwd, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def first_request(service: str, url: str, n: int) -> Callable[[httpx.Client], httpx.Response]:
+    if service == "recs":
+        return lambda client: client.get(f"{url}/recommendations/user-1")
+    # A new comment each run, so it is not a moderation cache hit
+    return lambda client: client.post(f"{url}/api/moderate", json={"text": f"loved the ending of chapter {n}"})
+
+
+def cold_start(service: str, cwd: str, env: Dict[str, str], workdir: str, n: int, timeout: float) -> Dict[str, Any]:
+    port = run.free_port()
+    url = f"http://127.0.0.1:{port}"
+    send = first_request(service, url, n)
+    result: Dict[str, Optional[float]] = {"listen_s": None, "first_ok_s": None, "warm_s": None}
+    started = time.perf_counter()
+    proc = run.spawn(f"{service}-{env['STARTUP_WARMUP']}-{n}", run.uvicorn_command(port), cwd, env, workdir)
+    try:
+        with httpx.Client(timeout=timeout) as client:
+            while time.perf_counter() - started < timeout:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"{service} exited with code {proc.returncode} during startup")
+                try:
+                    if result["listen_s"] is None:
+                        if client.get(f"{url}/healthz").status_code == 200:
+                            result["listen_s"] = time.perf_counter() - started
+                    elif result["first_ok_s"] is None:
+                        if send(client).is_success:
+                            result["first_ok_s"] = time.perf_counter() - started
+                    elif client.get(f"{url}/healthz").json()["warmup"]["status"] not in ("pending", "running"):
+                        result["warm_s"] = time.perf_counter() - started
+                        return result
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise TimeoutError(f"{service} did not finish starting within {timeout}s: {result}")
+    finally:
+        run.stop([proc])
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, float]:
+    return {key: round(statistics.median(r[key] for r in runs), 3) for key in ("import_s", "listen_s", "first_ok_s", "warm_s")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    run.add_fake_arguments(parser)
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts per service and mode")
+    parser.add_argument("--modes", default=",".join(MODES), type=lambda s: [x.strip() for x in s.split(",") if x.strip()],
+                        help="STARTUP_WARMUP values to compare")
+    parser.add_argument("--services", default="recs,ai", type=lambda s: [x.strip() for x in s.split(",") if x.strip()])
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--out", help="Write every run as JSON here")
+    args = parser.parse_args()
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    ports = {name: run.free_port() for name in ("supabase", "groq")}
+    urls = {name: f"http://127.0.0.1:{port}" for name, port in ports.items()}
+    workdir = tempfile.mkdtemp(prefix="nextchapter-startup-")
+    print(f"Logs and service state in {workdir}", file=sys.stderr)
+
+    results: Dict[str, Any] = {
+        "meta": {"started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "args": vars(args)},
+        "runs": [],
+        "median": {},
+    }
+    fakes = []
+    try:
+        for name, (cmd, cwd, ready_path) in run.fake_commands(args, ports).items():
+            fakes.append(run.spawn(name, cmd, cwd, os.environ, workdir))
+            run.wait_ready(urls[name] + ready_path, fakes[-1], args.timeout)
+
+        dirs = {"recs": run.RECS_DIR, "ai": run.AI_DIR}
+        for service in args.services:
+            for mode in args.modes:
+                runs = []
+                for n in range(args.runs):
+                    # Fresh state directory: no moderation cache or image index from the previous run
+                    state = tempfile.mkdtemp(dir=workdir)
+                    env = {**run.service_envs(urls, state)[0 if service == "recs" else 1], "STARTUP_WARMUP": mode}
+                    sample = {"service": service, "mode": mode, "import_s": measure_import(dirs[service], env)}
+                    sample.update(cold_start(service, dirs[service], env, workdir, n, args.timeout))
+                    runs.append(sample)
+                    print(f"{service:<6}{mode:<12}" + "  ".join(f"{k}={v:.3f}" for k, v in sample.items()
+                                                                if k.endswith("_s")), file=sys.stderr)
+                results["runs"] += runs
+                results["median"][f"{service}/{mode}"] = summarize(runs)
+    finally:
+        run.stop(fakes)
+
+    header = f"{'service/mode':<18}{'import s':>10}{'listen s':>10}{'first ok s':>12}{'warm s':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, m in results["median"].items():
+        print(f"{name:<18}{m['import_s']:>10.3f}{m['listen_s']:>10.3f}{m['first_ok_s']:>12.3f}{m['warm_s']:>10.3f}")
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Micro-benchmark for the vectorized metadata scorer (scoring.py).
+
+Builds synthetic catalogs of growing size and reports, per size:
+    encode    building a CatalogMatrix from book dicts (what a snapshot refresh costs)
+    score     scoring every book against a weighted profile + top-k selection
+    loop      the previous per-book Python loop, for comparison
+
+Usage:
+    python bench_scoring.py
+    python bench_scoring.py --sizes 1000,10000,100000,1000000 --repeat 20
+"""
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+
+from scoring import CatalogMatrix, ScoringWeights, UserProfile
+
+
+def synthetic_arrays(n: int, n_genres: int, n_authors: int, n_languages: int, seed: int):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, 4, size=n)  # 1-3 genres per book
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = rng.integers(0, n_genres, size=int(indptr[-1]), dtype=np.int32)
+    author = rng.integers(0, n_authors, size=n, dtype=np.int32)
+    language = rng.integers(0, n_languages, size=n, dtype=np.int32)
+    return indptr, indices, author, language
+
+
+def synthetic_books(indptr, indices, author, language):
+    return [
+        {
+            "id": row,
+            "genres": [f"g{g}" for g in indices[indptr[row]:indptr[row + 1]]],
+            "author": f"a{author[row]}",
+            "language": f"l{language[row]}",
+        }
+        for row in range(len(author))
+    ]
+
+
+def loop_score(top_book, books, limit=5):
+    """The per-book loop this scorer replaced (single top book, set intersection per book)."""
+    top_genres = set(top_book["genres"])
+    scored = []
+    for book in books:
+        score = len(top_genres & set(book["genres"])) * 3
+        if book["author"] == top_book["author"]:
+            score += 2
+        if book["language"] == top_book["language"]:
+            score += 1
+        if score > 0:
+            scored.append((score, book))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return scored[:limit]
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--genres", type=int, default=200)
+    parser.add_argument("--languages", type=int, default=20)
+    parser.add_argument("--history", type=int, default=5, help="Books in the user profile")
+    parser.add_argument("--encode-max", type=int, default=100000, help="Largest size to time dict encoding / the loop at")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    weights = ScoringWeights()
+    rnd = random.Random(args.seed)
+    print(f"{'books':>10} {'encode ms':>10} {'score ms':>10} {'loop ms':>10} {'speedup':>8}")
+    for n in [int(s) for s in args.sizes.split(",")]:
+        n_authors = max(10, n // 8)
+        indptr, indices, author, language = synthetic_arrays(n, args.genres, n_authors, args.languages, args.seed)
+        matrix = CatalogMatrix.from_arrays(indptr, indices, author, language, args.genres, n_authors, args.languages)
+
+        profile = UserProfile(
+            genres={f"g{rnd.randrange(args.genres)}": rnd.random() for _ in range(args.history * 2)},
+            authors={f"a{rnd.randrange(n_authors)}": rnd.random() for _ in range(args.history)},
+            languages={f"l{rnd.randrange(args.languages)}": rnd.random() for _ in range(2)},
+        )
+        read = set(rnd.sample(range(n), min(n, 50)))
+        score_ms = timed(lambda: matrix.top_k(matrix.score(profile, weights), 5, exclude_ids=read), args.repeat)
+
+        encode_ms = loop_ms = None
+        if n <= args.encode_max:
+            books = synthetic_books(indptr, indices, author, language)
+            encode_ms = timed(lambda: CatalogMatrix(books), max(1, args.repeat // 5))
+            loop_ms = timed(lambda: loop_score(books[0], books), max(1, args.repeat // 5))
+
+        fmt = lambda v: f"{v:10.2f}" if v is not None else f"{'-':>10}"
+        speedup = f"{loop_ms / score_ms:7.1f}x" if loop_ms else f"{'-':>8}"
+        print(f"{n:>10} {fmt(encode_ms)} {fmt(score_ms)} {fmt(loop_ms)} {speedup}")
+
+
+if __name__ == "__main__":
+    main()
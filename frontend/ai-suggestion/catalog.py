@@ -0,0 +1,139 @@
+"""
+In-process snapshot of the `books` catalog for candidate generation.
+
+The snapshot is loaded once with keyset pagination, then kept fresh by a
+background task that polls for rows whose watermark column (`updated_at`
+by default) moved past the last one seen. scoring.py encodes the rows into
+arrays and scores the whole catalog in one vectorized pass, so
+recommendations need no database round trip (and no per-genre/author
+candidate lookup).
+
+Deleted rows are not visible through the watermark, so the snapshot is
+also reloaded in full every `full_reload_interval` seconds.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from postgrest.exceptions import APIError
+
+log = logging.getLogger(__name__)
+
+CATALOG_COLUMNS = "id, title, author, cover_image, genres, language, number_of_downloads"
+
+
+class CatalogSnapshot:
+    def __init__(self, watermark_column: str = "updated_at", page_size: int = 1000):
+        self.watermark_column = watermark_column
+        self.page_size = page_size
+
+        self.books: Dict[Any, Dict[str, Any]] = {}
+
+        self.watermark: Optional[str] = None
+        self.version = 0  # bumped on every change, so derived structures know to rebuild
+        self.ready = False
+        self.loaded_at = 0.0
+        self.refreshed_at = 0.0
+        self.last_refresh_rows = 0
+
+    # --- Maintenance ---
+
+    def upsert(self, rows: Iterable[Dict[str, Any]]) -> int:
+        count = 0
+        for row in rows:
+            if not isinstance(row.get("genres"), list):
+                row["genres"] = []
+            self.books[row["id"]] = row
+            mark = row.get(self.watermark_column)
+            if mark and (self.watermark is None or mark > self.watermark):
+                self.watermark = mark
+            count += 1
+        if count:
+            self.version += 1
+        return count
+
+    # --- Loading ---
+
+    def _select(self) -> str:
+        return f"{CATALOG_COLUMNS}, {self.watermark_column}"
+
+    async def load(self, client) -> None:
+        """Full load with keyset pagination on id; swaps in the new rows when done."""
+        start = time.time()
+        fresh = CatalogSnapshot(self.watermark_column, self.page_size)
+        last_id = None
+        while True:
+            try:
+                query = client.table("books").select(fresh._select()).order("id").limit(self.page_size)
+                if last_id is not None:
+                    query = query.gt("id", last_id)
+                response = await query.execute()
+            except APIError as e:
+                if e.code == "42703" and self.watermark_column != "created_at":
+                    # No updated_at column on this deployment: only new rows can be picked up
+                    log.warning("catalog watermark column missing, using 'created_at'", extra={"column": self.watermark_column})
+                    self.watermark_column = fresh.watermark_column = "created_at"
+                    continue
+                raise
+            rows = response.data or []
+            fresh.upsert(rows)
+            if len(rows) < self.page_size:
+                break
+            last_id = rows[-1]["id"]
+
+        self.books = fresh.books
+        self.watermark = fresh.watermark
+        self.version += 1
+        self.ready = True
+        self.loaded_at = self.refreshed_at = time.time()
+        log.info("catalog snapshot loaded", extra={"books": len(self.books), "seconds": round(time.time() - start, 3)})
+
+    async def refresh(self, client) -> int:
+        """Pulls rows at or past the watermark. Re-reading the boundary rows is harmless."""
+        total = 0
+        while True:
+            query = client.table("books").select(self._select()).order(self.watermark_column).limit(self.page_size)
+            if self.watermark is not None:
+                query = query.gte(self.watermark_column, self.watermark)
+            previous = self.watermark
+            rows = (await query.execute()).data or []
+            total += self.upsert(rows)
+            if len(rows) < self.page_size:
+                break
+            if self.watermark == previous:
+                # A full page with one timestamp: keyset can't advance, so reload everything
+                await self.load(client)
+                break
+        self.refreshed_at = time.time()
+        self.last_refresh_rows = total
+        return total
+
+    async def run_refresher(self, client, interval: float, full_reload_interval: float) -> None:
+        """Background loop: incremental refresh every `interval`, full reload now and then."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if time.time() - self.loaded_at >= full_reload_interval:
+                    await self.load(client)
+                else:
+                    await self.refresh(client)
+            except Exception as e:
+                log.warning("catalog refresh failed", extra={"error": str(e)})
+
+    # --- Queries ---
+
+    def get_many(self, book_ids: Iterable[Any]) -> List[Dict[str, Any]]:
+        return [self.books[i] for i in book_ids if i in self.books]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "books": len(self.books),
+            "watermark_column": self.watermark_column,
+            "watermark": self.watermark,
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "refreshed_at": self.refreshed_at,
+            "last_refresh_rows": self.last_refresh_rows,
+        }
@@ -1,102 +1,392 @@
+import argparse
+import hashlib
+import json
 import os
-from supabase import create_client, Client
-from pinecone import Pinecone, ServerlessSpec
-from dotenv import load_dotenv
+import queue
+import threading
 import time
-from sentence_transformers import SentenceTransformer # <-- NEW IMPORT
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+
+import numpy as np
+
+from ingest_state import IngestState, namespace_for
+from vector_index import ArtifactWriter, iter_artifact, read_meta
+from vector_store import open_vector_store
 
 # --- 1. Load Environment & Initialize Clients ---
-load_dotenv() 
+load_dotenv()
 
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
 PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
 # GROQ_API_KEY is not needed for ingestion
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Local copy of the embeddings for the recommendation service (see vector_index.py)
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "book_vectors")
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", "float16")  # or "int8"
+
+# Where vectors are upserted ("pinecone" or "file:<dir>", see vector_store.py)
+# and where content hashes and run checkpoints are kept (see ingest_state.py)
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "pinecone")
+INGEST_STATE_DB = os.environ.get("INGEST_STATE_DB", "ingest_state.sqlite3")
+
+# Pipeline settings (each can also be given on the command line)
+INGEST_PAGE_SIZE = int(os.environ.get("INGEST_PAGE_SIZE", "1000"))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "256"))
+INGEST_PROCESSES = int(os.environ.get("INGEST_PROCESSES", "0"))  # >1: encode in that many processes
+INGEST_UPSERT_CONCURRENCY = int(os.environ.get("INGEST_UPSERT_CONCURRENCY", "4"))
+PINECONE_UPSERT_BATCH = 100
+PINECONE_DELETE_BATCH = 1000
+UPSERT_ATTEMPTS = 3
+
+# Created by get_supabase(), in the process that fetches; encoder processes
+# re-import this module and never need it (nor the supabase SDK).
+supabase = None
 
-# --- NEW: Load local embedding model ---
-# This model creates 384-dimension vectors
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+# This model creates 384-dimension vectors. It is loaded in run_ingestion, not at
+# import time, because encoder processes re-import this module.
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
 EMBEDDING_DIMENSION = 384 # <-- IMPORTANT CHANGE
 
-# --- 2. Get or Create Pinecone Index ---
+# --- 2. Pinecone Index ---
+# Created on first use if missing, never deleted; each generation lives in its own namespace
 index_name = "nextchapter-books"
-if index_name in pc.list_indexes().names():
-    print(f"Deleting old index '{index_name}'...")
-    pc.delete_index(index_name)
-
-print(f"Waiting for index deletion to complete...")
-time.sleep(10) # Give Pinecone a moment
-
-print(f"Creating new Pinecone index: {index_name} with dimension {EMBEDDING_DIMENSION}")
-pc.create_index(
-    name=index_name,
-    dimension=EMBEDDING_DIMENSION, # <-- Use new 384 dimension
-    metric="cosine", 
-    spec=ServerlessSpec(cloud="aws", region="us-east-1")
-)
-index = pc.Index(index_name)
 
 # --- 3. Helper Functions ---
+def get_supabase():
+    global supabase
+    if supabase is None:
+        from supabase import create_client
+
+        supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return supabase
+
 def get_text_to_embed(book):
     """Combines book fields into a single string for embedding."""
     genres_list = book.get('genres', [])
     genres_str = ", ".join(genres_list) if genres_list else ""
-    
+
     return f"Title: {book.get('title', '')}. " \
            f"Author: {book.get('author', '')}. " \
            f"Genre: {book.get('genre', '')}. " \
            f"Tags: {genres_str}."
 
+def content_hash(book):
+    """Changes whenever the embedded text or the model does, i.e. whenever the vector would."""
+    return hashlib.sha256(f"{EMBEDDING_MODEL_NAME}\n{get_text_to_embed(book)}".encode()).hexdigest()
+
+class StageStats:
+    """Books handled and busy seconds per pipeline stage (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.books = {}
+        self.seconds = {}
+
+    def add(self, stage, books, seconds):
+        with self._lock:
+            self.books[stage] = self.books.get(stage, 0) + books
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def report(self, wall_seconds):
+        for stage in self.books:
+            busy = self.seconds[stage]
+            rate = self.books[stage] / busy if busy else 0.0
+            print(f"   [{stage}] {self.books[stage]} books, {busy:.1f}s busy, {rate:.1f} books/sec")
+        total = self.books.get("embed", 0)
+        print(f"   [pipeline] {total} books in {wall_seconds:.1f}s, {total / wall_seconds if wall_seconds else 0:.1f} books/sec")
+
+def fetch_pages(page_size, pages, stats, after=None):
+    """
+    Producer thread: keyset pagination over books.id (starting after `after`)
+    into the bounded `pages` queue. Puts None when done, or the exception if
+    a fetch failed.
+    """
+    try:
+        client = get_supabase()
+        last_id = after
+        while True:
+            start = time.time()
+            query = client.table('books').select('id, title, author, genre, genres').order('id').limit(page_size)
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            rows = query.execute().data or []
+            stats.add("fetch", len(rows), time.time() - start)
+            if rows:
+                pages.put(rows)
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
+        pages.put(None)
+    except Exception as e:
+        pages.put(e)
+
+def make_encoder(processes, batch_size):
+    """Returns (encode(texts) -> ndarray, close())."""
+    # Imported here: torch alone takes seconds, and only the encoding step needs it
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    if processes > 1:
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * processes)
+        return (
+            lambda texts: model.encode_multi_process(texts, pool, batch_size=batch_size),
+            lambda: model.stop_multi_process_pool(pool),
+        )
+    return (
+        lambda texts: model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True),
+        lambda: None,
+    )
+
+class VectorSpill:
+    """
+    The vectors embedded by one run, appended to `<path>.f32` / `<path>.ids`
+    so the local artifact can be rebuilt at the end of the run, including
+    after a resume. Rows past the last committed page are dropped on reopen.
+    """
+
+    def __init__(self, path, dim, keep_rows=0):
+        self.path = path
+        self.dim = dim
+        self.rows = keep_rows
+        with open(path + ".f32", "ab") as f:
+            f.truncate(keep_rows * dim * 4)
+        ids = []
+        if os.path.exists(path + ".ids"):
+            with open(path + ".ids") as f:
+                ids = [line for _, line in zip(range(keep_rows), f)]
+        with open(path + ".ids", "w") as f:
+            f.writelines(ids)
+        self._vectors = open(path + ".f32", "ab")
+        self._ids = open(path + ".ids", "a")
+
+    def add(self, ids, vectors):
+        self._vectors.write(np.asarray(vectors, dtype=np.float32).tobytes())
+        self._ids.writelines(json.dumps(book_id) + "\n" for book_id in ids)
+        self.rows += len(ids)
+
+    def sync(self):
+        for f in (self._vectors, self._ids):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ids(self):
+        self.sync()
+        with open(self.path + ".ids") as f:
+            return [json.loads(line) for line in f]
+
+    def chunks(self, chunk_rows=65536):
+        self.sync()
+        ids = self.ids()
+        if not ids:
+            return
+        vectors = np.memmap(self.path + ".f32", dtype=np.float32, mode="r", shape=(len(ids), self.dim))
+        for i in range(0, len(ids), chunk_rows):
+            yield ids[i:i + chunk_rows], np.array(vectors[i:i + chunk_rows])
+
+    def remove(self):
+        self._vectors.close()
+        self._ids.close()
+        for suffix in (".f32", ".ids"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+def rebuild_artifact(run, spill, deleted):
+    """
+    Writes the local artifact for the run's generation: a full rebuild is
+    just the spilled vectors; an incremental run keeps the unchanged rows of
+    the current artifact and adds the re-embedded ones.
+    """
+    replaced = set(spill.ids()) | set(deleted)
+    writer = ArtifactWriter(VECTOR_INDEX_DIR, model=EMBEDDING_MODEL_NAME, dtype=VECTOR_INDEX_DTYPE,
+                            extra_meta={"generation": run["generation"], "namespace": namespace_for(run["generation"])})
+    try:
+        if not run["full"] and read_meta(VECTOR_INDEX_DIR) is not None:
+            for ids, vectors in iter_artifact(VECTOR_INDEX_DIR):
+                keep = [row for row, book_id in enumerate(ids) if book_id not in replaced]
+                writer.add([ids[row] for row in keep], vectors[keep])
+        for ids, vectors in spill.chunks():
+            writer.add(ids, vectors)
+        return writer.finish()
+    except BaseException:
+        writer.abort()
+        raise
+
 # --- 4. Main Ingestion Function ---
-def run_ingestion():
-    print("Fetching books from Supabase...")
-    response = supabase.table('books').select('id, title, author, genre, genres').execute()
-    books = response.data
-    
-    if not books:
-        print("No books found to ingest.")
-        return
+def run_ingestion(full=False, store=VECTOR_STORE, state_path=INGEST_STATE_DB, page_size=INGEST_PAGE_SIZE,
+                  batch_size=INGEST_BATCH_SIZE, processes=INGEST_PROCESSES, upsert_concurrency=INGEST_UPSERT_CONCURRENCY):
+    """
+    Incremental, resumable ingestion. Each book's content hash is compared
+    with the one stored for the active generation, and only new or changed
+    books are embedded and upserted; books that disappeared from the catalog
+    are deleted from the store at the end.
 
-    print(f"Found {len(books)} books. Generating local embeddings...")
-    
-    vectors_to_upsert = []
-    for book in books:
-        try:
-            text_to_embed = get_text_to_embed(book)
-            
-            # --- MODIFIED: Use SentenceTransformer ---
-            vector = embedding_model.encode(text_to_embed).tolist()
-            
-            vectors_to_upsert.append({
-                "id": str(book['id']), 
-                "values": vector,
-                "metadata": {
-                    "genre": book.get('genre', 'Unknown'),
-                    "author": book.get('author', 'Unknown')
-                    }
-            })
-            print(f"Generated embedding for book ID: {book['id']}")
-        
-        except Exception as e:
-            print(f"Error embedding book {book['id']}: {e}. Skipping.")
-
-    print(f"Upserting {len(vectors_to_upsert)} vectors to Pinecone...")
-    if vectors_to_upsert:
-        for i in range(0, len(vectors_to_upsert), 100):
-            batch = vectors_to_upsert[i:i+100]
+    Streaming pipeline, with memory bounded by the page and batch sizes:
+
+        fetch   keyset pages of books (producer thread, at most 2 pages queued)
+        embed   changed books in batches of `batch_size` (optionally across `processes` processes)
+        upsert  vector store batches on `upsert_concurrency` threads, while the next batch embeds
+        commit  once all of a page's upserts succeeded: its hashes and the page cursor,
+                in order, so an interrupted run resumes after the last committed page
+        local   the local artifact (see vector_index.py), rebuilt once at the end
+
+    `full` re-embeds every book into a new generation (namespace) while the
+    current one keeps serving, and switches over only once it is complete.
+    """
+    state = IngestState(state_path)
+    run = state.open_run(full)
+    namespace = namespace_for(run["generation"])
+    vector_store = open_vector_store(store, PINECONE_API_KEY, index_name, EMBEDDING_DIMENSION)
+    spill = VectorSpill(f"{state_path}.run-{run['run_id']}", EMBEDDING_DIMENSION, keep_rows=run["spill_rows"])
+    # Stored hashes are only trusted if the local artifact holds the vectors they describe
+    artifact = read_meta(VECTOR_INDEX_DIR)
+    reuse_hashes = not run["full"] and artifact is not None and artifact.get("generation") == run["generation"]
+    if not run["full"] and not reuse_hashes:
+        print(f"Local vector index at '{VECTOR_INDEX_DIR}' is missing or from another generation; re-embedding every book.")
+
+    mode = "Full rebuild" if run["full"] else "Incremental run"
+    resumed = f", resuming after book {run['cursor']}" if run["cursor"] is not None else ""
+    print(f"{mode} {run['run_id']} into generation {run['generation']} (namespace '{namespace}'){resumed}")
+
+    encoder = None  # loaded on the first changed book, so a no-op run skips the model
+    stats = StageStats()
+    start_time = time.time()
+
+    pages = queue.Queue(maxsize=2)
+    threading.Thread(target=fetch_pages, args=(page_size, pages, stats, run["cursor"]), daemon=True).start()
+
+    upserter = ThreadPoolExecutor(max_workers=upsert_concurrency)
+    pending = set()
+    uncommitted = deque()  # pages in fetch order, committed once all their upserts are done
+
+    def upsert(batch):
+        start = time.time()
+        for attempt in range(UPSERT_ATTEMPTS):
             try:
-                index.upsert(vectors=batch)
-                print(f"Upserted batch {i//100 + 1}")
+                vector_store.upsert(batch, namespace)
+                break
             except Exception as e:
-                print(f"Error upserting batch {i//100 + 1}: {e}")
-    else:
-        print("No vectors were generated. Nothing to upsert.")
-    
-    print("Ingestion complete!")
+                if attempt == UPSERT_ATTEMPTS - 1:
+                    raise
+                print(f"Upsert failed ({e}), retrying...")
+                time.sleep(2 ** attempt)
+        stats.add("upsert", len(batch), time.time() - start)
+
+    def commit_ready(wait_all=False):
+        while uncommitted and (wait_all or all(f.done() for f in uncommitted[0]["futures"])):
+            page = uncommitted.popleft()
+            for future in page["futures"]:
+                future.result()  # a failed batch stops the run; the resume redoes this page
+            spill.sync()
+            run.update(cursor=page["cursor"], spill_rows=page["spill_rows"],
+                       embedded=run["embedded"] + len(page["hashed"]),
+                       unchanged=run["unchanged"] + len(page["ids"]) - len(page["hashed"]))
+            state.commit_page(run, page["hashed"], page["ids"])
+
+    def embed_and_upsert(books):
+        nonlocal encoder
+        if encoder is None:
+            encoder = make_encoder(processes, batch_size)
+        start = time.time()
+        vectors = encoder[0]([get_text_to_embed(book) for book in books])
+        stats.add("embed", len(books), time.time() - start)
+        spill.add([book['id'] for book in books], vectors)
+
+        futures = []
+        for i in range(0, len(books), PINECONE_UPSERT_BATCH):
+            batch = [
+                {
+                    "id": str(book['id']),
+                    "values": vector.tolist(),
+                    "metadata": {
+                        "genre": book.get('genre', 'Unknown'),
+                        "author": book.get('author', 'Unknown')
+                    }
+                }
+                for book, vector in zip(books[i:i + PINECONE_UPSERT_BATCH], vectors[i:i + PINECONE_UPSERT_BATCH])
+            ]
+            # Bounded in-flight upserts: wait for one to finish before queueing more
+            while len(pending) >= upsert_concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+                commit_ready()
+            future = upserter.submit(upsert, batch)
+            pending.add(future)
+            futures.append(future)
+        return futures
+
+    print(f"Streaming books from Supabase (pages of {page_size}, batches of {batch_size})...")
+    try:
+        while True:
+            page = pages.get()
+            if isinstance(page, Exception):
+                raise page
+            if page is None:
+                break
+            hashes = {book['id']: content_hash(book) for book in page}
+            stored = state.hashes(run["generation"], list(hashes)) if reuse_hashes else {}
+            changed = [book for book in page if stored.get(book['id']) != hashes[book['id']]]
+            futures = []
+            for i in range(0, len(changed), batch_size):
+                futures.extend(embed_and_upsert(changed[i:i + batch_size]))
+            uncommitted.append({
+                "cursor": page[-1]['id'],
+                "futures": futures,
+                "hashed": [(book['id'], hashes[book['id']]) for book in changed],
+                "ids": list(hashes),
+                "spill_rows": spill.rows,
+            })
+            commit_ready()
+            print(f"Read through book {page[-1]['id']}; committed {run['embedded']} embedded, {run['unchanged']} unchanged")
+
+        wait(pending)
+        commit_ready(wait_all=True)
+    finally:
+        upserter.shutdown(wait=True)
+        if encoder is not None:
+            encoder[1]()
+
+    deleted = [] if run["full"] else state.unseen(run)
+    if deleted:
+        start = time.time()
+        for i in range(0, len(deleted), PINECONE_DELETE_BATCH):
+            vector_store.delete([str(book_id) for book_id in deleted[i:i + PINECONE_DELETE_BATCH]], namespace)
+        stats.add("delete", len(deleted), time.time() - start)
+        run["deleted"] = len(deleted)
+        state.forget(run, deleted)
+
+    if run["full"] and not run["embedded"]:
+        print("No books found to ingest; keeping the current generation.")
+        state.finish_run(run, promote=False)
+        spill.remove()
+        return
+
+    if run["full"] or spill.rows or deleted or not reuse_hashes:
+        start = time.time()
+        meta = rebuild_artifact(run, spill, deleted)
+        stats.add("local", meta["count"], time.time() - start)
+        print(f"Wrote local vector index to '{VECTOR_INDEX_DIR}' ({meta['count']} x {meta['dim']} {meta['dtype']}, ivf={meta['ivf']})")
+
+    previous = state.finish_run(run)
+    spill.remove()
+    if previous is not None and previous != run["generation"]:
+        print(f"Promoted generation {run['generation']}; dropping namespace '{namespace_for(previous)}'")
+        vector_store.drop_namespace(namespace_for(previous))
+
+    print(f"Ingestion complete! {run['embedded']} embedded, {run['unchanged']} unchanged, {run['deleted']} deleted")
+    stats.report(time.time() - start_time)
 
 # --- 5. Run it ---
 if __name__ == "__main__":
-    run_ingestion()
+    parser = argparse.ArgumentParser(description="Embed new and changed books into the vector store and the local vector index.")
+    parser.add_argument("--full", action="store_true", help="Re-embed every book into a new generation, then switch over")
+    parser.add_argument("--store", default=VECTOR_STORE, help='"pinecone" or "file:<dir>"')
+    parser.add_argument("--state", default=INGEST_STATE_DB, help="SQLite file with content hashes and checkpoints")
+    parser.add_argument("--page-size", type=int, default=INGEST_PAGE_SIZE, help="Books per Supabase page")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Books per embedding batch")
+    parser.add_argument("--processes", type=int, default=INGEST_PROCESSES, help="Encoder processes (0/1 = in-process)")
+    parser.add_argument("--upsert-concurrency", type=int, default=INGEST_UPSERT_CONCURRENCY, help="Parallel upserts")
+    args = parser.parse_args()
+    run_ingestion(args.full, args.store, args.state, args.page_size, args.batch_size, args.processes, args.upsert_concurrency)
@@ -0,0 +1,150 @@
+"""
+Checkpoint state for ingest.py, in SQLite.
+
+    book_hashes     content hash of every ingested book, per generation
+    ingest_runs     one row per run: generation, page cursor, counters
+    ingest_meta     the active generation
+
+A generation is one complete copy of the embeddings in the vector store,
+kept in its own namespace (generation 0 is the default namespace that the
+original delete-and-rebuild ingestion wrote to). Incremental runs update the
+active generation in place; a full rebuild fills generation N+1 and is
+promoted only once it is complete.
+
+Book IDs are stored JSON-encoded so integer IDs come back as integers.
+"""
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+def namespace_for(generation: int) -> str:
+    return "" if generation == 0 else f"books-{generation}"
+
+
+class IngestState:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS book_hashes ("
+            "generation INTEGER NOT NULL, book_id TEXT NOT NULL, hash TEXT NOT NULL, seen_run INTEGER, "
+            "PRIMARY KEY (generation, book_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ingest_runs ("
+            "run_id INTEGER PRIMARY KEY AUTOINCREMENT, generation INTEGER NOT NULL, full INTEGER NOT NULL, "
+            "started_at REAL NOT NULL, finished_at REAL, cursor TEXT, spill_rows INTEGER NOT NULL DEFAULT 0, "
+            "embedded INTEGER NOT NULL DEFAULT 0, unchanged INTEGER NOT NULL DEFAULT 0, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS ingest_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+    def active_generation(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM ingest_meta WHERE key = 'active_generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def open_run(self, full: bool) -> Dict[str, Any]:
+        """
+        Resumes the last unfinished run, or starts a new one. A full rebuild
+        supersedes an unfinished incremental run; an incremental request
+        resumes an unfinished full rebuild rather than racing it.
+        """
+        columns = ("run_id", "generation", "full", "cursor", "spill_rows", "embedded", "unchanged", "deleted")
+        active = self.active_generation()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(columns)} FROM ingest_runs WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+            if row is not None and full and not row[2]:
+                self._conn.execute("UPDATE ingest_runs SET finished_at = ? WHERE run_id = ?", (time.time(), row[0]))
+                row = None
+            if row is None:
+                if full:
+                    latest = self._conn.execute("SELECT MAX(generation) FROM ingest_runs").fetchone()[0]
+                    generation = max(active, latest or 0) + 1
+                else:
+                    generation = active
+                cur = self._conn.execute(
+                    "INSERT INTO ingest_runs (generation, full, started_at) VALUES (?, ?, ?)",
+                    (generation, int(full), time.time()),
+                )
+                self._conn.commit()
+                row = (cur.lastrowid, generation, int(full), None, 0, 0, 0, 0)
+        run = dict(zip(columns, row))
+        run["full"] = bool(run["full"])
+        run["cursor"] = json.loads(run["cursor"]) if run["cursor"] is not None else None
+        return run
+
+    def hashes(self, generation: int, book_ids: Iterable[Any]) -> Dict[Any, str]:
+        keys = [json.dumps(book_id) for book_id in book_ids]
+        found: Dict[Any, str] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT book_id, hash FROM book_hashes WHERE generation = ? AND book_id IN ({', '.join('?' * len(chunk))})",
+                    (generation, *chunk),
+                ).fetchall()
+                found.update((json.loads(key), value) for key, value in rows)
+        return found
+
+    def commit_page(self, run: Dict[str, Any], hashed: List[Tuple[Any, str]], seen_ids: List[Any]) -> None:
+        """Records a page whose vectors are all stored, and advances the run's cursor in the same transaction."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO book_hashes (generation, book_id, hash, seen_run) VALUES (?, ?, ?, ?)",
+                [(run["generation"], json.dumps(book_id), value, run["run_id"]) for book_id, value in hashed],
+            )
+            self._conn.executemany(
+                "UPDATE book_hashes SET seen_run = ? WHERE generation = ? AND book_id = ?",
+                [(run["run_id"], run["generation"], json.dumps(book_id)) for book_id in seen_ids],
+            )
+            self._conn.execute(
+                "UPDATE ingest_runs SET cursor = ?, spill_rows = ?, embedded = ?, unchanged = ? WHERE run_id = ?",
+                (json.dumps(run["cursor"]), run["spill_rows"], run["embedded"], run["unchanged"], run["run_id"]),
+            )
+            self._conn.commit()
+
+    def unseen(self, run: Dict[str, Any]) -> List[Any]:
+        """Books of the run's generation that this run did not see, i.e. deleted from the catalog."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT book_id FROM book_hashes WHERE generation = ? AND (seen_run IS NULL OR seen_run != ?)",
+                (run["generation"], run["run_id"]),
+            ).fetchall()
+        return [json.loads(key) for (key,) in rows]
+
+    def forget(self, run: Dict[str, Any], book_ids: List[Any]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM book_hashes WHERE generation = ? AND book_id = ?",
+                [(run["generation"], json.dumps(book_id)) for book_id in book_ids],
+            )
+            self._conn.execute("UPDATE ingest_runs SET deleted = ? WHERE run_id = ?", (run["deleted"], run["run_id"]))
+            self._conn.commit()
+
+    def finish_run(self, run: Dict[str, Any], promote: bool = True) -> Optional[int]:
+        """
+        Marks the run finished. A full rebuild also becomes the active
+        generation (unless `promote` is False) and the previous generation's
+        hashes are dropped; returns that previous generation (None otherwise).
+        """
+        previous = None
+        with self._lock:
+            if run["full"] and promote:
+                row = self._conn.execute("SELECT value FROM ingest_meta WHERE key = 'active_generation'").fetchone()
+                previous = int(row[0]) if row else 0
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ingest_meta (key, value) VALUES ('active_generation', ?)",
+                    (str(run["generation"]),),
+                )
+                self._conn.execute("DELETE FROM book_hashes WHERE generation != ?", (run["generation"],))
+            self._conn.execute("UPDATE ingest_runs SET finished_at = ? WHERE run_id = ?", (time.time(), run["run_id"]))
+            self._conn.commit()
+        return previous
@@ -0,0 +1,158 @@
+"""
+In-memory popularity leaderboard for the cold-start and explore paths.
+
+Two ranked lists are kept:
+    popular   result of the `get_popular_books` RPC, or the head of `top`
+              when the RPC doesn't exist on this deployment
+    top       the `size` most downloaded books (by `created_at` when the
+              `number_of_downloads` column is missing)
+
+Which RPC/column exists is probed on the first successful refresh and
+remembered, so later refreshes don't pay for the failing query again. A
+background task refreshes both lists; readers are served the current lists
+(stale or not) and filter out the user's read books in memory.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from postgrest.exceptions import APIError
+
+from read_sets import ReadSet
+
+log = logging.getLogger(__name__)
+
+LEADERBOARD_COLUMNS = "id, title, author, cover_image"
+MISSING_RPC_CODES = ("PGRST202", "42883", "42703")
+
+
+class Leaderboard:
+    def __init__(self, size: int = 60, popular_size: int = 10, max_age: float = 600):
+        self.size = size
+        self.popular_size = popular_size
+        self.max_age = max_age
+
+        self.popular_books: List[Dict[str, Any]] = []
+        self.top_books: List[Dict[str, Any]] = []
+
+        # Schema probe results (None = not probed yet)
+        self.rpc_available: Optional[bool] = None
+        self.order_column: Optional[str] = None
+
+        self.refreshed_at = 0.0
+        self.refreshes = 0
+        self.failures = 0
+        self.stale_reads = 0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.refreshed_at > 0
+
+    # --- Loading ---
+
+    async def _fetch_top(self, client) -> List[Dict[str, Any]]:
+        column = self.order_column or "number_of_downloads"
+        try:
+            response = await (
+                client.table("books")
+                .select(LEADERBOARD_COLUMNS)
+                .order(column, desc=True, nullsfirst=False)
+                .limit(self.size)
+                .execute()
+            )
+        except APIError as e:
+            if e.code != "42703" or column == "created_at":
+                raise
+            # Fallback to created_at if number_of_downloads column does not exist
+            log.warning("leaderboard column missing, ranking by 'created_at'", extra={"column": column})
+            self.order_column = "created_at"
+            return await self._fetch_top(client)
+        self.order_column = column
+        return response.data or []
+
+    async def _fetch_rpc(self, client) -> Optional[List[Dict[str, Any]]]:
+        if self.rpc_available is False:
+            return None
+        try:
+            response = await client.rpc("get_popular_books", {}).execute()
+        except APIError as e:
+            if e.code in MISSING_RPC_CODES:
+                log.warning("RPC 'get_popular_books' not found, using the download ranking", extra={"code": e.code})
+                self.rpc_available = False
+            else:
+                # Transient: use the download ranking this time, try the RPC again next refresh
+                log.warning("get_popular_books RPC failed", extra={"error": str(e)})
+            return None
+        self.rpc_available = True
+        if not response.data:
+            log.info("RPC 'get_popular_books' returned no data, using the download ranking")
+        return response.data or None
+
+    async def refresh(self, client) -> None:
+        """Reloads both lists. On failure the previous lists stay in place."""
+        start = time.time()
+        try:
+            top, popular = await asyncio.gather(self._fetch_top(client), self._fetch_rpc(client))
+        except Exception as e:
+            self.failures += 1
+            log.warning("leaderboard refresh failed", extra={"error": str(e)})
+            return
+        self.top_books = top
+        self.popular_books = popular or top[: self.popular_size]
+        self.refreshed_at = time.time()
+        self.refreshes += 1
+        log.info("leaderboard refreshed", extra={
+            "top": len(self.top_books), "popular": len(self.popular_books), "seconds": round(time.time() - start, 3),
+        })
+
+    def _refresh_in_background(self, client) -> asyncio.Task:
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self.refresh(client))
+        return self._refreshing
+
+    async def ensure(self, client) -> None:
+        """
+        Waits for the first load only. After that the current lists are served
+        right away, and a background refresh is started if they are too old.
+        """
+        if not self.ready:
+            await asyncio.shield(self._refresh_in_background(client))
+        elif time.time() - self.refreshed_at > self.max_age:
+            self.stale_reads += 1
+            self._refresh_in_background(client)
+
+    async def run_refresher(self, client, interval: float) -> None:
+        """Background loop: refresh every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh(client)
+
+    # --- Queries ---
+
+    @staticmethod
+    def _exclude(books: List[Dict[str, Any]], exclude: Iterable[Any], limit: Optional[int]) -> List[Dict[str, Any]]:
+        exclude = exclude if isinstance(exclude, (set, frozenset, ReadSet)) else set(exclude)
+        unread = [b for b in books if b.get("id") not in exclude]
+        return unread if limit is None else unread[:limit]
+
+    def popular(self, exclude: Iterable[Any] = (), limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self._exclude(self.popular_books, exclude, limit)
+
+    def top(self, exclude: Iterable[Any] = (), limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self._exclude(self.top_books, exclude, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "top": len(self.top_books),
+            "popular": len(self.popular_books),
+            "rpc_available": self.rpc_available,
+            "order_column": self.order_column,
+            "refreshed_at": self.refreshed_at,
+            "age_seconds": round(time.time() - self.refreshed_at, 1) if self.ready else None,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "stale_reads": self.stale_reads,
+        }
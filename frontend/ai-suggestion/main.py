@@ -1,20 +1,51 @@
 #Author - Kirtan Chhatbar - 202301098
+import asyncio
+import hmac
+import logging
 import os
 import time
-from typing import Any, Dict, List, Optional
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from supabase import Client, create_client
 import uvicorn
 from postgrest.exceptions import APIError
 
+from catalog import CatalogSnapshot
+from leaderboard import Leaderboard
+from precompute import PrecomputedStore, encode_stamp
+from read_sets import ReadSet, ReadSetCache
+from result_cache import ResultCache
+from telemetry import configure_logging, counter, histogram, instrument, timed
+from scoring import (
+    RECENT_HISTORY_SIZE,
+    CatalogMatrix,
+    MatrixCache,
+    ScoringWeights,
+    UserProfile,
+    build_user_profile,
+    rank_books,
+    score_recent_history,
+)
+from vector_index import VectorIndex
+
 
 # --- 1. Load Environment & Initialize Clients ---
 load_dotenv() 
 
+# JSON log lines on stdout; GET /metrics for latency histograms and counters
+configure_logging("ai-suggestion")
+log = logging.getLogger(__name__)
+
+STAGE_SECONDS = histogram("recommendation_stage_seconds", "Time per recommendation pipeline stage", ["stage"])
+STRATEGY_SERVED = counter("recommendations_served_total", "Responses served, by endpoint and strategy",
+                          ["endpoint", "strategy"])
+DEADLINE_EXCEEDED = counter("recommendation_deadline_exceeded_total", "Requests that ran past a stage budget",
+                            ["stage"])
+
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
 
@@ -22,13 +53,185 @@ SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
 if not all([SUPABASE_URL, SUPABASE_SERVICE_KEY]):
     raise RuntimeError("Missing one or more required environment variables for recommendation service.")
 
-# Initialize the FastAPI app
-app = FastAPI(title="NextChapter AI Suggestions API")
+# Shared secret a Supabase database webhook sends as its bearer token to
+# /recommendations/invalidate (the service key is accepted too); browsers send the user's JWT
+INVALIDATE_WEBHOOK_SECRET = os.environ.get("INVALIDATE_WEBHOOK_SECRET")
+
+# Catalog snapshot settings (see catalog.py)
+CATALOG_WATERMARK_COLUMN = os.environ.get("CATALOG_WATERMARK_COLUMN", "updated_at")
+CATALOG_REFRESH_SECONDS = float(os.environ.get("CATALOG_REFRESH_SECONDS", "60"))
+CATALOG_FULL_RELOAD_SECONDS = float(os.environ.get("CATALOG_FULL_RELOAD_SECONDS", str(6 * 3600)))
+
+# Popular/explore leaderboard settings (see leaderboard.py)
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", "60"))
+LEADERBOARD_REFRESH_SECONDS = float(os.environ.get("LEADERBOARD_REFRESH_SECONDS", "300"))
+
+# Per-user recommendation cache settings (see result_cache.py)
+REC_CACHE_MAX_USERS = int(os.environ.get("REC_CACHE_MAX_USERS", "10000"))
+REC_CACHE_TTL_SECONDS = float(os.environ.get("REC_CACHE_TTL_SECONDS", "600"))
+REC_CACHE_STALE_SECONDS = float(os.environ.get("REC_CACHE_STALE_SECONDS", "3600"))
+
+# Time budget of one /recommendations request. Past it, the best response already at
+# hand is served (see deadline_fallback); the history stamp lookup gets a smaller share,
+# and if the answer isn't there after REC_HEDGE_AFTER_SECONDS a preferences fetch starts
+# in parallel so that a personalized fallback is ready by the deadline.
+REC_DEADLINE_SECONDS = float(os.environ.get("REC_DEADLINE_SECONDS", "1.5"))
+REC_STAMP_BUDGET_SECONDS = float(os.environ.get("REC_STAMP_BUDGET_SECONDS", "0.4"))
+REC_HEDGE_AFTER_SECONDS = float(os.environ.get("REC_HEDGE_AFTER_SECONDS", "0.5"))
+
+# Per-user read sets used for exclusion (see read_sets.py)
+READ_SET_MAX_USERS = int(os.environ.get("READ_SET_MAX_USERS", "10000"))
+
+# Results of the offline precompute job (see precompute.py); empty path disables
+PRECOMPUTED_DB = os.environ.get("PRECOMPUTED_DB", "precomputed_recommendations.sqlite3")
+PRECOMPUTED_MAX_AGE_SECONDS = float(os.environ.get("PRECOMPUTED_MAX_AGE_SECONDS", str(26 * 3600)))
+
+# Local embedding artifact written by ingest.py (see vector_index.py)
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "book_vectors")
+VECTOR_EXACT_MAX = int(os.environ.get("VECTOR_EXACT_MAX", "50000"))
+VECTOR_NPROBE = int(os.environ.get("VECTOR_NPROBE", "16"))
+
+# Async Supabase client (using service_role key to bypass RLS).
+# Created right after startup (see connect_supabase) so every query is awaited instead of blocking the event loop.
+supabase = None
+
+# In-memory copy of the books table; scoring.py encodes it for vectorized ranking
+catalog = CatalogSnapshot(watermark_column=CATALOG_WATERMARK_COLUMN)
+
+# Vectorized scorer over the snapshot (see scoring.py); weights via SCORE_WEIGHT_GENRE/AUTHOR/LANGUAGE
+scoring_weights = ScoringWeights.from_env()
+catalog_matrix = MatrixCache()
+
+# Most popular / most downloaded books, shared by every cold-start and explore request
+leaderboard = Leaderboard(size=LEADERBOARD_SIZE, max_age=2 * LEADERBOARD_REFRESH_SECONDS)
+
+# Last RecommendationResponse per user, valid while their history stamp is unchanged
+recommendation_cache = ResultCache(
+    max_users=REC_CACHE_MAX_USERS, ttl=REC_CACHE_TTL_SECONDS, stale_ttl=REC_CACHE_STALE_SECONDS
+)
+
+# Book IDs each recently active user has read, synced incrementally from user_books
+read_sets = ReadSetCache(max_users=READ_SET_MAX_USERS)
+
+# (user_id, stamp) -> cache lookup/build still running. Shared by concurrent requests,
+# and left running when a request gives up at its deadline so the result still gets cached.
+inflight_builds: Dict[Tuple[str, Any], "asyncio.Task"] = {}
+
+# user_id -> [preferences fetch, holders]. The build and the request's deadline hedge
+# share one fetch, which is cancelled once neither of them needs it.
+preference_fetches: Dict[str, List[Any]] = {}
+
+precomputed = PrecomputedStore(PRECOMPUTED_DB) if PRECOMPUTED_DB else None
+
+# Book embeddings, memory-mapped in the background after startup; unused until ready
+vector_index = VectorIndex(VECTOR_INDEX_DIR, exact_max=VECTOR_EXACT_MAX, nprobe=VECTOR_NPROBE)
+
+
+def load_vector_index() -> None:
+    try:
+        if not vector_index.load():
+            log.info("no vector index; using metadata scoring only", extra={"path": VECTOR_INDEX_DIR})
+            return
+        vector_index.load_report.update(vector_index.probe_latency())
+        stats = vector_index.stats()
+        log.info("vector index loaded", extra={
+            key: stats.get(key)
+            for key in ("count", "dtype", "mode", "mapped_mb", "resident_mb", "query_p50_ms", "query_p95_ms")
+        })
+    except Exception as e:
+        vector_index.ready = False
+        log.exception("failed to load vector index", extra={"path": VECTOR_INDEX_DIR, "error": str(e)})
+
+
+# What happens after the server starts listening (see warm_up):
+#   background  warm up while already serving (default; /healthz answers right away)
+#   blocking    warm up before serving, like a readiness gate
+#   off         nothing; the caches fill on first use and from the refreshers
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "background")
+STARTED_AT = time.time()
+warmup_state: Dict[str, Any] = {"status": "pending", "seconds": None}
+
+# Set in the lifespan hook; requests that need Supabase wait for it
+supabase_connecting: Optional["asyncio.Task"] = None
 
-# Initialize Supabase client (using service_role key to bypass RLS)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
-print("Supabase client initialized - Lightweight mode (no ML models)")
+async def connect_supabase() -> None:
+    global supabase
+    # Imported here: the supabase SDK is a good part of the import time
+    from supabase import acreate_client
+
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    log.info("supabase async client initialized - lightweight mode (no ML models)")
+
+
+async def require_supabase() -> None:
+    """Waits for the client if the service has only just started; retries a failed connect."""
+    global supabase_connecting
+    if supabase is None:
+        if supabase_connecting.done():
+            supabase_connecting = asyncio.create_task(connect_supabase())
+        await asyncio.shield(supabase_connecting)
+
+
+async def warm_up() -> None:
+    """
+    Loads everything the first requests would otherwise load themselves: the
+    vector index, the catalog snapshot and its matrix, and the leaderboard.
+    The catalog load also opens the Supabase connection the requests reuse.
+    """
+    started = time.perf_counter()
+    warmup_state["status"] = "running"
+    # Precomputed book vectors only; no model is loaded at query time
+    vector_loader = asyncio.create_task(asyncio.to_thread(load_vector_index))
+    try:
+        await require_supabase()
+        try:
+            await catalog.load(supabase)
+            await catalog_matrix.get(catalog)
+        except Exception as e:
+            # Requests fall back to querying Supabase until a later reload succeeds
+            log.warning("catalog snapshot failed to load, using per-request queries", extra={"error": str(e)})
+        # First refresh also probes which popularity RPC/column this deployment has
+        await leaderboard.refresh(supabase)
+    except Exception as e:
+        warmup_state["status"] = "failed"
+        log.exception("warm-up failed", extra={"error": str(e)})
+        return
+    finally:
+        await vector_loader
+    warmup_state["seconds"] = round(time.perf_counter() - started, 3)
+    warmup_state["status"] = "done"
+    log.info("warm-up finished", extra={"seconds": warmup_state["seconds"]})
+
+
+async def run_refreshers() -> None:
+    await require_supabase()
+    await asyncio.gather(
+        catalog.run_refresher(supabase, CATALOG_REFRESH_SECONDS, CATALOG_FULL_RELOAD_SECONDS),
+        leaderboard.run_refresher(supabase, LEADERBOARD_REFRESH_SECONDS),
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase_connecting
+    # Listening starts before the client is ready; /healthz answers meanwhile
+    supabase_connecting = asyncio.create_task(connect_supabase())
+    tasks = [supabase_connecting, asyncio.create_task(run_refreshers())]
+    if STARTUP_WARMUP == "blocking":
+        await warm_up()
+    elif STARTUP_WARMUP != "off":
+        tasks.append(asyncio.create_task(warm_up()))
+    else:
+        warmup_state["status"] = "off"
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+# Initialize the FastAPI app
+app = FastAPI(title="NextChapter AI Suggestions API", lifespan=lifespan)
+instrument(app)
 
 # --- 2. CORS Middleware ---
 # Configure Cross-Origin Resource Sharing (CORS)
@@ -68,76 +271,54 @@ class RecommendationResponse(BaseModel):
     strategy: Optional[str] = None
     is_fallback: bool = False
 
-# --- 4. Helper Functions ---
-
-def get_similar_books_by_metadata(top_book_details: Dict[str, Any], read_book_ids: set, limit: int = 5) -> List[Dict[str, Any]]:
+class InvalidateRequest(BaseModel):
     """
-    Lightweight metadata-based recommendation without ML models.
-    Finds books with matching genres, authors, or language.
+    Either {"user_id": "..."} from the frontend, or a Supabase database
+    webhook payload for user_books / book_ratings / book_wishlist (user_id
+    read from the row).
     """
+    user_id: Optional[str] = None
+    record: Optional[Dict[str, Any]] = None
+    old_record: Optional[Dict[str, Any]] = None
+
+# --- 4. Helper Functions ---
+
+async def fetch_metadata_candidates(read_book_ids: ReadSet, pool_size: int = 100) -> List[Dict[str, Any]]:
+    """Fetches the pool of unread books that metadata matching scores."""
     try:
-        # Extract preferences from top book
-        top_genres = top_book_details.get("genres", [])
-        top_author = top_book_details.get("author")
-        top_language = top_book_details.get("language")
-        
-        # Build query for similar books
-        query = supabase.table("books").select("id, title, author, cover_image, genres, language")
-        
-        # Filter out already read books
-        if read_book_ids:
-            query = query.not_.in_("id", list(read_book_ids))
-        
-        # Get a larger pool to filter from
-        response = query.limit(100).execute()
-        all_books = response.data or []
-        
-        # Score books based on similarity
-        scored_books = []
-        for book in all_books:
-            score = 0
-            book_genres = book.get("genres", [])
-            
-            # Genre matching (highest weight)
-            if top_genres and book_genres:
-                matching_genres = set(top_genres) & set(book_genres)
-                score += len(matching_genres) * 3
-            
-            # Same author (medium weight)
-            if top_author and book.get("author") == top_author:
-                score += 2
-            
-            # Same language (low weight)
-            if top_language and book.get("language") == top_language:
-                score += 1
-            
-            if score > 0:
-                scored_books.append((score, book))
-        
-        # Sort by score and return top results
-        scored_books.sort(key=lambda x: x[0], reverse=True)
-        return [book for _, book in scored_books[:limit]]
-        
+        # Read books are dropped in memory rather than sent as a not.in filter, which
+        # grows with the user's history. Over-fetch by up to 900 to make up for them.
+        response = await (
+            supabase.table("books")
+            .select("id, title, author, cover_image, genres, language")
+            .limit(pool_size + min(len(read_book_ids), 900))
+            .execute()
+        )
+        return [b for b in response.data or [] if b.get("id") not in read_book_ids][:pool_size]
     except Exception as e:
-        print(f"Error in metadata-based recommendation: {e}")
+        log.warning("error fetching metadata candidates", extra={"error": str(e)})
         return []
 
-def calculate_love_score(history_item: Dict[str, Any]) -> float:
+async def get_similar_books_by_metadata(profile: UserProfile, scored_history: List[Dict[str, Any]], matrix: CatalogMatrix,
+                                  books_by_id: Dict[Any, Dict[str, Any]], read_book_ids: ReadSet, limit: int = 5,
+                                  use_vectors: bool = True) -> Tuple[List[Dict[str, Any]], str]:
     """
-    Calculates a "Love Score" (from 0 to 1) based on user's interaction
-    with a book. This score weighs scroll depth, rating, and watchlist status.
-    
-    This function now works with the data from our new SQL function.
+    Lightweight metadata-based recommendation without ML models.
+    Scores every book in `matrix` against the user's weighted genre, author
+    and language profile in one vectorized pass and keeps the best unread ones.
+    When the local vector index is loaded, its neighbours of the user's
+    history centroid are the candidates instead. Returns (books, strategy).
+    Scoring and vector search run in a worker thread; at full catalog size
+    they take tens of milliseconds, which the event loop shouldn't stall for.
     """
-    raw_scroll = history_item.get("scroll_depth", 0) or 0
-    raw_rating = history_item.get("rating", 0) or 0
-    raw_watchlist = history_item.get("was_in_watchlist", False)
-    
-    # Weighted average: scroll (50%), watchlist (30%), rating (20%)
-    scroll_norm = (raw_scroll / 100) * 0.5
-    watchlist_norm = (1 if raw_watchlist else 0) * 0.3
-    rating_norm = (raw_rating / 5) * 0.2
-    return scroll_norm + watchlist_norm + rating_norm
+    try:
+        return await asyncio.to_thread(
+            rank_books, profile, scored_history, matrix, books_by_id, read_book_ids, scoring_weights, limit,
+            vectors=vector_index if use_vectors else None,
+        )
+    except Exception:
+        log.exception("error in metadata-based recommendation")
+        return [], "metadata_matching"
 
 def format_books(raw_books: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
@@ -156,40 +337,17 @@ def format_books(raw_books: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         )
     return formatted
 
-async def get_popular_books_from_supabase() -> List[Dict[str, Any]]:
+async def get_popular_books(exclude: ReadSet) -> List[Dict[str, Any]]:
     """
-    The final fallback. Tries to get popular books by calling a
-    PostgreSQL RPC function 'get_popular_books'. If that fails,
-    it runs a manual query to get books ordered by 'number_of_downloads'.
+    The final fallback: popular books from the in-memory leaderboard,
+    minus the ones in `exclude`. Only waits on the database if the
+    leaderboard has never loaded.
     """
     try:
-        # First, try calling the database function
-        response = supabase.rpc("get_popular_books", {}).execute()
-        if response.data:
-            return response.data
-        print("RPC 'get_popular_books' returned no data. Using fallback query.")
-    except APIError as e:
-        # This catches errors if the RPC function doesn't exist or fails
-        if e.code == "PGRST202" or e.code == "42883" or e.code == "42703":
-            print(f"RPC 'get_popular_books' failed or not found ({e.code}). Using fallback query.")
-        else:
-            print(f"Error calling get_popular_books RPC: {e}")
+        await leaderboard.ensure(supabase)
     except Exception as e:
-        print(f"A general error occurred in get_popular_books: {e}")
-    
-    # Manual fallback query if the RPC fails
-    try:
-        fallback_response = (
-            supabase.table("books")
-            .select("id, title, author, cover_image")
-            .order("number_of_downloads", desc=True, nullsfirst=False)
-            .limit(10)
-            .execute()
-        )
-        return fallback_response.data or []
-    except Exception as e:
-        print(f"Error fetching popular books via fallback: {e}")
-        return []
+        log.warning("leaderboard unavailable for popular books", extra={"error": str(e)})
+    return leaderboard.popular(exclude)
 
 async def get_recs_from_preferences(user_id: str) -> Optional[List[Dict[str, Any]]]:
     """
@@ -198,7 +356,7 @@ async def get_recs_from_preferences(user_id: str) -> Optional[List[Dict[str, Any
     table and finds books that match.
     """
     try:
-        profile_res = (
+        profile_res = await (
             supabase.table("user_profiles")
             .select("genres")
             .eq("user_id", user_id)
@@ -207,20 +365,20 @@ async def get_recs_from_preferences(user_id: str) -> Optional[List[Dict[str, Any
         )
         
         if not profile_res or not profile_res.data or not profile_res.data.get("genres"):
-            print(f"User {user_id} has no preferences saved.")
+            log.info("user has no preferences saved", extra={"user_id": user_id})
             return None
             
         preferred_genres = profile_res.data["genres"]
         if not preferred_genres:
             return None
             
-        print(f"User {user_id} has preferred genres: {preferred_genres}")
+        log.info("user preferred genres", extra={"user_id": user_id, "genres": preferred_genres})
         
         # --- FIX: Convert Python list to PostgreSQL array string ---
         # e.g., ['Fiction', 'History'] becomes '{"Fiction","History"}'
         postgres_array_string = "{" + ",".join(f'"{g}"' for g in preferred_genres) + "}"
         
-        book_res = (
+        book_res = await (
             supabase.table("books")
             .select("id, title, author, cover_image")
             # Use the correctly formatted string
@@ -231,68 +389,242 @@ async def get_recs_from_preferences(user_id: str) -> Optional[List[Dict[str, Any
         return book_res.data if book_res.data else None
     except APIError as e:
         if e.code == "PGRST116":
-             print(f"No profile found for user {user_id}. Cannot get preferences.")
+             log.info("no profile found, cannot get preferences", extra={"user_id": user_id})
              return None
-        print(f"Error fetching preference-based recommendations: {e}")
+        log.warning("error fetching preference-based recommendations", extra={"user_id": user_id, "error": str(e)})
         return None
     except Exception as e:
-        print(f"A general error occurred in get_recs_from_preferences: {e}")
+        log.warning("error in get_recs_from_preferences", extra={"user_id": user_id, "error": str(e)})
         return None
 
+def cancel_pending(*tasks: "asyncio.Task") -> None:
+    """Cancels speculative fetches whose results turned out not to be needed."""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+
+def hold_preferences(user_id: str) -> "asyncio.Task":
+    """The user's preferences fetch, started if none is running; pair with release_preferences."""
+    entry = preference_fetches.get(user_id)
+    if entry is None:
+        entry = preference_fetches[user_id] = [asyncio.create_task(get_recs_from_preferences(user_id)), 0]
+    entry[1] += 1
+    return entry[0]
+
+def release_preferences(user_id: str, task: "asyncio.Task") -> None:
+    """Drops one hold on the fetch; the last holder cancels it if it is still running."""
+    entry = preference_fetches.get(user_id)
+    if entry is None or entry[0] is not task:
+        return
+    entry[1] -= 1
+    if entry[1] == 0:
+        del preference_fetches[user_id]
+        cancel_pending(task)
+
+async def history_stamp(user_id: str) -> Optional[tuple]:
+    """
+    Cheap fingerprint of the user's history (see ReadSetCache.fetch_stamp):
+    user_books row count and latest updated_at, plus the book_ratings and
+    book_wishlist row counts. Rating value changes don't move it, so the
+    frontend calls /recommendations/invalidate for those.
+    """
+    return await read_sets.fetch_stamp(supabase, user_id)
+
+async def fresh_precomputed_books(user_id: str, stamp: Optional[tuple], trust_unknown: bool = False) -> List[Dict[str, Any]]:
+    """
+    Books from the precompute job, if its row is recent enough and the
+    user's history stamp still equals the one the job recorded. Else [].
+    With `trust_unknown`, a row is also served when either stamp is
+    (partly) unknown, but never when both are known and differ.
+    """
+    if precomputed is None or not catalog.ready:
+        return []
+    current = encode_stamp(stamp)
+    if current is None and not trust_unknown:
+        return []
+    try:
+        row = await precomputed.aget(user_id)
+    except Exception as e:
+        log.warning("error reading precomputed recommendations", extra={"error": str(e)})
+        return []
+    if row is None:
+        return []
+    book_ids, recorded, computed_at = row
+    if time.time() - computed_at > PRECOMPUTED_MAX_AGE_SECONDS:
+        return []
+    if recorded != current and not (trust_unknown and (recorded is None or current is None)):
+        return []
+    return catalog.get_many(book_ids)
+
+async def precomputed_or_live(user_id: str, stamp: Optional[tuple]) -> RecommendationResponse:
+    books = await fresh_precomputed_books(user_id, stamp)
+    if books:
+        return RecommendationResponse(
+            user_id=user_id,
+            books=[RecommendedBook(**book) for book in format_books(books)],
+            strategy="precomputed",
+            is_fallback=False,
+        )
+    return await build_recommendations_payload(user_id, stamp)
+
+def shared_build(user_id: str, stamp: Optional[tuple]) -> "asyncio.Task":
+    """The user's running cache lookup/build for `stamp`, started if there is none."""
+    key = (user_id, stamp)
+    task = inflight_builds.get(key)
+    if task is None:
+        task = asyncio.create_task(recommendation_cache.get_or_build(
+            user_id, stamp, lambda: precomputed_or_live(user_id, stamp)
+        ))
+        inflight_builds[key] = task
+        task.add_done_callback(lambda t: _build_done(key, t))
+    return task
+
+def _build_done(key: Tuple[str, Any], task: "asyncio.Task") -> None:
+    if inflight_builds.get(key) is task:
+        del inflight_builds[key]
+    if not task.cancelled():
+        # Retrieve it, so a build nobody waited for doesn't log "exception was never retrieved"
+        task.exception()
+
+async def deadline_fallback(user_id: str, stamp: Optional[tuple], preferences: Optional["asyncio.Task"]) -> RecommendationResponse:
+    """
+    The best response at hand once the deadline has passed, without another
+    Supabase round trip, in order:
+        stale_cache    the user's last response (unless the stamp shows their history moved)
+        precomputed    the offline job's row, trusted even without a stamp
+        preferences    the hedged preferences fetch, if it has finished
+        popular        the in-memory leaderboard
+    Read books are excluded through the cached read set, if there is one.
+    """
+    cached = recommendation_cache.peek(user_id, stamp)
+    if cached is not None:
+        return RecommendationResponse(user_id=user_id, books=cached.books, strategy="stale_cache", is_fallback=True)
+
+    read_book_ids = read_sets.peek(user_id) or ReadSet()
+    candidates, strategy = await fresh_precomputed_books(user_id, stamp, trust_unknown=True), "precomputed"
+    if not candidates and preferences is not None and preferences.done() and not preferences.cancelled():
+        candidates, strategy = preferences.result() or [], "preferences"
+    if not candidates:
+        candidates, strategy = leaderboard.popular(read_book_ids), "popular"
+    formatted = format_books([b for b in candidates if b.get("id") not in read_book_ids])
+    if not formatted:
+        raise HTTPException(status_code=503, detail="Recommendations are temporarily unavailable.")
+    return RecommendationResponse(
+        user_id=user_id,
+        books=[RecommendedBook(**book) for book in formatted],
+        strategy=strategy,
+        is_fallback=True,
+    )
+
+async def cached_recommendations(user_id: str) -> RecommendationResponse:
+    """
+    Serves the cached response while the user's history stamp is unchanged,
+    within REC_DEADLINE_SECONDS (see deadline_fallback for what is served
+    when that runs out). The clock includes waiting for a cold Supabase client.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REC_DEADLINE_SECONDS
+    # Past the hedge delay, hold the build's preferences fetch (or start one) for the fallback
+    hedge: Dict[str, asyncio.Task] = {}
+    hedge_timer = loop.call_later(
+        REC_HEDGE_AFTER_SECONDS, lambda: hedge.update(preferences=hold_preferences(user_id)),
+    )
+
+    async def connected_stamp() -> Optional[tuple]:
+        await require_supabase()
+        return await history_stamp(user_id)
+
+    try:
+        stamp = None
+        try:
+            with timed(STAGE_SECONDS, stage="history_stamp"):
+                stamp = await asyncio.wait_for(
+                    connected_stamp(), min(REC_STAMP_BUDGET_SECONDS, deadline - loop.time())
+                )
+        except asyncio.TimeoutError:
+            # Carry on without it: only a fresh cache entry can be served, else it's a rebuild
+            DEADLINE_EXCEEDED.inc(stage="history_stamp")
+
+        try:
+            # Shielded: at the deadline the build keeps going and caches its result for next time
+            response = await asyncio.wait_for(
+                asyncio.shield(shared_build(user_id, stamp)), max(0.0, deadline - loop.time())
+            )
+        except asyncio.TimeoutError:
+            DEADLINE_EXCEEDED.inc(stage="build")
+            log.warning("recommendation deadline exceeded, serving a fallback", extra={"user_id": user_id})
+            response = await deadline_fallback(user_id, stamp, hedge.get("preferences"))
+    finally:
+        hedge_timer.cancel()
+        if "preferences" in hedge:
+            release_preferences(user_id, hedge["preferences"])
+    STRATEGY_SERVED.inc(endpoint="recommendations", strategy=response.strategy)
+    return response
+
 # --- 5. Main Logic (REPLACED WITH NEW RPC CALL) ---
 
-async def build_recommendations_payload(user_id: str) -> RecommendationResponse:
+async def build_recommendations_payload(user_id: str, stamp: Optional[tuple] = None) -> RecommendationResponse:
     """
     This is the main function that builds the recommendation response.
     It handles both "Cold Start" (new users) and "Warm Start" (returning users).
     
     This version uses the 'get_full_user_history' RPC call to join data
-    from user_books, book_ratings, and book_wishlist.
+    from user_books, book_ratings, and book_wishlist. Only the most recent
+    items are fetched; read books are excluded through the user's cached
+    read set, kept in sync with `stamp` (see history_stamp).
     """
     start_total_time = time.time()
-    print(f"Generating recommendations for {user_id}")
-    top_book_details = None
+    # The request may have given up on the client at its deadline; the build still needs it
+    await require_supabase()
+
+    # Start the preferences fallback speculatively, alongside the history fetch. Whatever
+    # path we end up on, its fallback data is then already in flight (or done).
+    # Popular books come from the leaderboard and need no request of their own.
+    # Shared with the request's deadline hedge, hence the shield on every await.
+    preferences_task = hold_preferences(user_id)
     
     try:
-        # --- Step 1: Get ALL history data in ONE call ---
-        # This one RPC call replaces all our old, broken queries
-        start_step_time = time.time()
-        history_res = (
-            supabase.rpc("get_full_user_history", {"p_user_id": user_id})
-            .execute()
-        )
-        
-        all_history_data = history_res.data or []
-        
-        # --- Step 2: Get ALL "read" book IDs for accurate filtering ---
-        read_book_ids = set(item['book_id'] for item in all_history_data) if all_history_data else set()
+        # --- Step 1: Get the RECENT history the "Love Score" needs, in ONE call ---
+        # The SQL function returns newest first, so the limit keeps the payload
+        # constant however long the user's history gets
+        with timed(STAGE_SECONDS, stage="history_fetch"):
+            history_res, read_set = await asyncio.gather(
+                supabase.rpc("get_full_user_history", {"p_user_id": user_id})
+                .limit(RECENT_HISTORY_SIZE)
+                .execute(),
+                # --- Step 2: Get ALL book IDs in the history (read, rated, wishlisted) for accurate filtering ---
+                # Compact cached set, only re-fetched in part when the user's history changed
+                read_sets.get(supabase, user_id, stamp),
+            )
+            recent_history_data = history_res.data or []
 
-        # --- Step 3: Get RECENT 5 "read" books for "Love Score" logic ---
-        # We just slice the list we already have, since it's pre-sorted by the SQL function
-        recent_history_data = all_history_data[:5]
-        print(f"   [TIMING] Fetched and processed history: {time.time() - start_step_time:.2f}s")
+            # --- Step 3: The recent items count as read too (they may come from ratings or the wishlist) ---
+            read_book_ids = read_set.union(item['book_id'] for item in recent_history_data)
 
 
         # --- Step 4: COLD START Logic ---
         # If the user has no recent reading history, they are a "Cold Start".
         if not recent_history_data:
-            print(f"Cold start detected for user: {user_id}")
-            
-            # Plan A: Try to get recommendations from their saved preferences
-            preferred = await get_recs_from_preferences(user_id)
-            strategy = "preferences" if preferred else "popular"
-            
-            # Plan B: If no preferences, get popular books
-            candidate_books_raw = preferred or await get_popular_books_from_supabase()
-            
-            # Filter out any books they *may* have read (from all_history_res)
-            candidate_books = [b for b in candidate_books_raw if b.get('id') not in read_book_ids]
+            with timed(STAGE_SECONDS, stage="fallback"):
+                # Plan A: Try to get recommendations from their saved preferences
+                preferred = await asyncio.shield(preferences_task)
+                strategy = "preferences" if preferred else "popular"
 
-            formatted = format_books(candidate_books)
+                # Plan B: If no preferences, get popular books
+                candidate_books_raw = preferred or await get_popular_books(read_book_ids)
+
+                # Filter out any books they *may* have read (from the read set)
+                candidate_books = [b for b in candidate_books_raw if b.get('id') not in read_book_ids]
+
+            with timed(STAGE_SECONDS, stage="formatting"):
+                formatted = format_books(candidate_books)
             if not formatted:
                 raise HTTPException(status_code=404, detail="No recommendations available for this user.")
 
-            print(f"--- [TIMING] Total request time: {time.time() - start_total_time:.2f}s ---")
+            log.info("recommendations built", extra={
+                "user_id": user_id, "start": "cold", "strategy": strategy,
+                "ms": round((time.time() - start_total_time) * 1000),
+            })
             # Return the response without justification
             return RecommendationResponse(
                 user_id=user_id,
@@ -303,135 +635,95 @@ async def build_recommendations_payload(user_id: str) -> RecommendationResponse:
 
         # --- Step 5: WARM START Logic ---
         # If we are here, the user has reading history.
-        print(f"Warm start for user: {user_id}. Using 'Love Score' logic.")
-        (top_book, top_genre, top_author, top_book_details) = (None, None, None, None)
-
         # --- Step 5a: Calculate "Love Score" and find top preferences ---
-        # We can use the *exact same* calculate_love_score function as before,
-        # because our SQL function provides the columns it needs.
-        start_step_time = time.time()
-        scored_books_history = []
-        for item in recent_history_data: # Use the recent 5
-            score = calculate_love_score(item) # This function still works!
-            scored_books_history.append({"book_id": item["book_id"], "score": score})
-        
+        # calculate_love_score (scoring.py) reads the columns our SQL function provides.
+        # The batch job in precompute.py goes through the same functions.
+        scored_books_history = score_recent_history(recent_history_data)
+
         recent_book_ids = [b["book_id"] for b in scored_books_history]
-        books_response = (
-            supabase.table("books")
-            .select("id, title, author, genres, language")
-            .in_("id", recent_book_ids)
-            .execute()
-        )
-        books_response_data = books_response.data or []
-        print(f"   [TIMING] Scored & fetched history book details: {time.time() - start_step_time:.2f}s")
-
-        # Calculate weighted scores for genres, authors, and languages
-        start_step_time = time.time()
-        genre_scores: Dict[str, float] = {}
-        author_scores: Dict[str, float] = {}
-        language_scores: Dict[str, float] = {}
-        for history_item in scored_books_history:
-            for book_detail in books_response_data:
-                if history_item["book_id"] == book_detail["id"]:
-                    score = history_item["score"]
-                    if genre_list := book_detail.get("genres"):
-                        if isinstance(genre_list, list):
-                            for g in genre_list:
-                                if g: genre_scores[g] = genre_scores.get(g, 0) + score
-                    if a := book_detail.get("author"):
-                        author_scores[a] = author_scores.get(a, 0) + score
-                    if l := book_detail.get("language"):
-                        language_scores[l] = language_scores.get(l, 0) + score
-                    history_item["details"] = book_detail
-                    break
-        
-        # Find the single book with the highest Love Score
-        top_book = max(scored_books_history, key=lambda x: x["score"])
-        top_genre = max(genre_scores, key=genre_scores.get) if genre_scores else None
-        top_author = max(author_scores, key=author_scores.get) if author_scores else None
-        top_book_details = top_book.get("details", {})
-        print(f"   [TIMING] Calculated user preferences: {time.time() - start_step_time:.2f}s")
+        candidate_pool = None
+        with timed(STAGE_SECONDS, stage="detail_fetch"):
+            if catalog.ready:
+                # History details come straight from the snapshot
+                books_response_data = catalog.get_many(recent_book_ids)
+            else:
+                # The history details and the candidate pool don't depend on each other: fetch both at once
+                books_response, candidate_pool = await asyncio.gather(
+                    supabase.table("books")
+                    .select("id, title, author, genres, language")
+                    .in_("id", recent_book_ids)
+                    .execute(),
+                    fetch_metadata_candidates(read_book_ids),
+                )
+                books_response_data = books_response.data or []
 
         # --- Step 5b: Metadata-based Recommendation (Lightweight) ---
-        start_step_time = time.time()
-        candidate_books = get_similar_books_by_metadata(top_book_details, read_book_ids, limit=5)
-        print(f"   [TIMING] Found similar books by metadata: {time.time() - start_step_time:.2f}s")
+        with timed(STAGE_SECONDS, stage="scoring"):
+            # Love-score-weighted genre, author and language preferences across the recent history
+            profile = build_user_profile(scored_books_history, {b["id"]: b for b in books_response_data})
+            if candidate_pool is None:
+                # Score the whole catalog snapshot (no DB call)
+                matrix = await catalog_matrix.get(catalog)
+                books_by_id = catalog.books
+            else:
+                matrix = CatalogMatrix(candidate_pool)
+                books_by_id = {b["id"]: b for b in candidate_pool}
+            candidate_books, strategy = await get_similar_books_by_metadata(
+                profile, scored_books_history, matrix, books_by_id, read_book_ids, limit=5,
+                use_vectors=candidate_pool is None,
+            )
 
         # --- Step 5c: Handle Fallback Logic ---
-        strategy = "metadata_matching"
-        
         if not candidate_books:
-            print("Metadata matching produced no results. Falling back to preferences/popular.")
-            prefs = await get_recs_from_preferences(user_id)
-            strategy = "preferences" if prefs else "popular"
-            candidate_books_raw = prefs or await get_popular_books_from_supabase()
-            candidate_books = [b for b in candidate_books_raw if b.get('id') not in read_book_ids]
+            log.info("metadata matching produced no results, falling back to preferences/popular",
+                     extra={"user_id": user_id})
+            with timed(STAGE_SECONDS, stage="fallback"):
+                prefs = await asyncio.shield(preferences_task)
+                strategy = "preferences" if prefs else "popular"
+                candidate_books_raw = prefs or await get_popular_books(read_book_ids)
+                candidate_books = [b for b in candidate_books_raw if b.get('id') not in read_book_ids]
 
         # --- Step 6: Format and Return ---
-        formatted = format_books(candidate_books)
+        with timed(STAGE_SECONDS, stage="formatting"):
+            formatted = format_books(candidate_books)
         if not formatted:
             raise HTTPException(status_code=404, detail="No recommendations available for this user.")
-        
-        print(f"--- [TIMING] Total request time: {time.time() - start_total_time:.2f}s ---")
+
+        log.info("recommendations built", extra={
+            "user_id": user_id, "start": "warm", "strategy": strategy,
+            "ms": round((time.time() - start_total_time) * 1000),
+        })
         return RecommendationResponse(
             user_id=user_id,
             books=[RecommendedBook(**book) for book in formatted],
             strategy=strategy,
-            is_fallback=strategy != "metadata_matching",
+            is_fallback=strategy not in ("metadata_matching", "embedding_similarity"),
         )
 
     except HTTPException:
         raise 
-    except Exception as e:
-        print(f"An error occurred in recommendation generation: {e}")
+    except Exception:
+        log.exception("recommendation generation failed", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail="An internal server error occurred.")
+    finally:
+        # Drop the speculative fallback unless the hedge still holds it
+        release_preferences(user_id, preferences_task)
 
 
 async def build_explore_payload(user_id: str, limit: int = 5) -> RecommendationResponse:
     """Return curated books the user has not read yet."""
     if not user_id:
         raise HTTPException(status_code=400, detail="Missing user_id.")
+    await require_supabase()
 
     try:
-        read_response = (
-            supabase.table("user_books")
-            .select("book_id")
-            .eq("user_id", user_id)
-            .execute()
+        # The read set is per user; the ranking comes from the shared leaderboard
+        read_ids, _ = await asyncio.gather(
+            read_sets.get(supabase, user_id),
+            leaderboard.ensure(supabase),
         )
-        read_ids = {
-            row.get("book_id")
-            for row in (read_response.data or [])
-            if row.get("book_id") is not None
-        }
-
-        try:
-            books_response = (
-                supabase.table("books")
-                .select("id, title, author, cover_image")
-                .order("number_of_downloads", desc=True, nullsfirst=False)
-                .limit(60)
-                .execute()
-            )
-        except APIError as e:
-            if e.code != "42703":
-                raise
-            # Fallback to created_at if number_of_downloads column does not exist
-            books_response = (
-                supabase.table("books")
-                .select("id, title, author, cover_image")
-                .order("created_at", desc=True, nullsfirst=False)
-                .limit(60)
-                .execute()
-            )
 
-        candidate_books: List[Dict[str, Any]] = []
-        for book in books_response.data or []:
-            if book.get("id") in read_ids:
-                continue
-            candidate_books.append(book)
-            if len(candidate_books) >= limit:
-                break
+        candidate_books = leaderboard.top(exclude=read_ids, limit=limit)
 
         if not candidate_books:
             raise HTTPException(status_code=404, detail="No explore titles available. Try again later.")
@@ -448,8 +740,8 @@ async def build_explore_payload(user_id: str, limit: int = 5) -> RecommendationR
         )
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error building explore payload: {e}")
+    except Exception:
+        log.exception("error building explore payload", extra={"user_id": user_id})
         raise HTTPException(status_code=500, detail="Unable to fetch explore recommendations.")
 
 
@@ -461,7 +753,7 @@ async def get_smart_suggestions(user_id: str):
     GET endpoint to fetch recommendations.
     Called directly from the browser or other services.
     """
-    return await build_recommendations_payload(user_id)
+    return await cached_recommendations(user_id)
 
 @app.post("/recommendations", response_model=RecommendationResponse)
 async def post_smart_suggestions(payload: RecommendationRequest):
@@ -471,17 +763,114 @@ async def post_smart_suggestions(payload: RecommendationRequest):
     """
     if not payload.user_id:
         raise HTTPException(status_code=400, detail="Missing user_id in request body.")
-    return await build_recommendations_payload(payload.user_id)
+    return await cached_recommendations(payload.user_id)
+
+async def authorize_invalidation(authorization: Optional[str], user_id: str) -> None:
+    """
+    Lets a webhook (bearer = INVALIDATE_WEBHOOK_SECRET or the service key)
+    invalidate any user, and a signed-in user (bearer = their Supabase JWT)
+    only themselves. Raises 401/403 otherwise.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing bearer token.",
+                            headers={"WWW-Authenticate": "Bearer"})
+    for secret in (INVALIDATE_WEBHOOK_SECRET, SUPABASE_SERVICE_KEY):
+        if secret and hmac.compare_digest(token.encode(), secret.encode()):
+            return
+    await require_supabase()
+    try:
+        response = await supabase.auth.get_user(token)
+    except Exception as e:
+        log.info("invalidate token rejected", extra={"user_id": user_id, "error": str(e)})
+        response = None
+    if response is None or response.user is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired token.",
+                            headers={"WWW-Authenticate": "Bearer"})
+    if response.user.id != user_id:
+        raise HTTPException(status_code=403, detail="Token does not belong to this user.")
+
+@app.post("/recommendations/invalidate")
+async def invalidate_recommendations(payload: InvalidateRequest, authorization: Optional[str] = Header(None)):
+    """
+    Drops the cached recommendations of one user. Called by the frontend
+    after a rating changes (with the user's access token), or by a database
+    webhook on user_books/book_ratings/book_wishlist (with the webhook secret).
+    """
+    user_id = payload.user_id
+    for row in (payload.record, payload.old_record):
+        if not user_id and row:
+            user_id = row.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Missing user_id.")
+    await authorize_invalidation(authorization, user_id)
+    if precomputed is not None:
+        await precomputed.adiscard(user_id)
+    return {"user_id": user_id, "invalidated": recommendation_cache.invalidate(user_id)}
+
+@app.get("/recommendations/cache/stats")
+async def get_recommendation_cache_stats():
+    """Entries and per-strategy hit ratios of the per-user recommendation cache."""
+    return recommendation_cache.stats()
+
+@app.get("/read-sets/stats")
+async def get_read_set_stats():
+    """Users, size, memory and sync counters of the cached read sets."""
+    return read_sets.stats()
+
+@app.get("/precomputed/stats")
+async def get_precomputed_stats():
+    """Rows and last run of the offline precompute job."""
+    if precomputed is None:
+        return {"enabled": False}
+    return {"enabled": True, **precomputed.stats()}
+
+@app.get("/vectors/stats")
+async def get_vector_stats():
+    """Size, memory footprint and probe latency of the local vector index."""
+    return vector_index.stats()
+
+@app.get("/catalog/stats")
+async def get_catalog_stats():
+    """Size, watermark and refresh times of the in-memory catalog snapshot."""
+    return {**catalog.stats(), "matrix": catalog_matrix.stats(), "weights": vars(scoring_weights)}
+
+@app.get("/leaderboard/stats")
+async def get_leaderboard_stats():
+    """Probe results, size and age of the popular/explore leaderboard."""
+    return leaderboard.stats()
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: answers as soon as the server is listening, without touching
+    Supabase. The components show how far the warm-up has got.
+    """
+    return {
+        "status": "ok",
+        "uptime_s": round(time.time() - STARTED_AT, 3),
+        "warmup": warmup_state,
+        "components": {
+            "supabase_client": supabase is not None,
+            "catalog": catalog.ready,
+            "leaderboard": leaderboard.ready,
+            "vectors": vector_index.ready,
+        },
+    }
 
 @app.get("/explore/{user_id}", response_model=RecommendationResponse)
 async def get_explore(user_id: str):
-    return await build_explore_payload(user_id)
+    response = await build_explore_payload(user_id)
+    STRATEGY_SERVED.inc(endpoint="explore", strategy=response.strategy)
+    return response
 
 @app.post("/explore", response_model=RecommendationResponse)
 async def post_explore(payload: RecommendationRequest):
     if not payload.user_id:
         raise HTTPException(status_code=400, detail="Missing user_id in request body.")
-    return await build_explore_payload(payload.user_id)
+    response = await build_explore_payload(payload.user_id)
+    STRATEGY_SERVED.inc(endpoint="explore", strategy=response.strategy)
+    return response
 
 
 # --- 7. Run the App ---
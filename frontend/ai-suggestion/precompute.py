@@ -0,0 +1,319 @@
+"""
+Offline batch precompute of recommendations.
+
+The job loads one catalog snapshot and encodes it (scoring.py), then walks
+the users that have reading history in pages:
+
+    enumerate users   keyset pages over user_books.user_id
+    fetch histories   get_full_user_history RPC, `--fetch-concurrency` at a time
+    score             love score + metadata scoring, split across a process pool
+                      that shares the snapshot (forked workers, copy-on-write)
+    write             book IDs per user into SQLite, with the user's history stamp
+                      and the page cursor
+
+Fetching the next page overlaps with scoring the current one. The cursor is
+committed together with each page, so an interrupted run resumes where it
+stopped. Only users whose history yields metadata matches get a row; the
+service computes everyone else live.
+
+Each user's history stamp (ReadSetCache.fetch_stamp) is read just before
+the history. main.py serves a precomputed row while it is younger than
+PRECOMPUTED_MAX_AGE_SECONDS and the user's current stamp still equals the
+stored one: any read, rating or wishlist change since then moves it.
+
+Usage:
+    python precompute.py                            # resume the last unfinished run, or start one
+    python precompute.py --restart --workers 8
+    python precompute.py --active-days 1            # only users active in the last day
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from catalog import CatalogSnapshot
+from read_sets import ReadSet, ReadSetCache
+from scoring import CatalogMatrix, ScoringWeights, build_user_profile, rank_books, score_recent_history
+from vector_index import VectorIndex
+
+
+def encode_stamp(stamp: Optional[tuple]) -> Optional[str]:
+    """A history stamp as stored with a precomputed row; None if any part of it is unknown."""
+    if stamp is None or any(part is None for part in stamp):
+        return None
+    return json.dumps(stamp, separators=(",", ":"))
+
+
+class PrecomputedStore:
+    """SQLite table of precomputed book IDs per user, plus the job's run checkpoints."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS recommendations ("
+            "user_id TEXT PRIMARY KEY, book_ids TEXT NOT NULL, history_at REAL NOT NULL, computed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS precompute_runs ("
+            "run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at REAL NOT NULL, finished_at REAL, "
+            "cursor TEXT, users INTEGER NOT NULL DEFAULT 0, written INTEGER NOT NULL DEFAULT 0, seconds REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(recommendations)")}
+        if "stamp" not in columns:
+            # Rows written before stamps were stored keep NULL and are only served as a last resort
+            self._conn.execute("ALTER TABLE recommendations ADD COLUMN stamp TEXT")
+        self._conn.commit()
+
+    # --- Online lookups ---
+
+    def get(self, user_id: str) -> Optional[Tuple[List[Any], Optional[str], float]]:
+        """(book IDs, encoded history stamp or None, computed_at) or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT book_ids, stamp, computed_at FROM recommendations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return _decode_ids(row[0]), row[1], row[2]
+
+    def discard(self, user_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM recommendations WHERE user_id = ?", (user_id,))
+            self._conn.commit()
+
+    # The service calls these from the event loop; the SQLite work runs in a worker thread
+
+    async def aget(self, user_id: str) -> Optional[Tuple[List[Any], Optional[str], float]]:
+        return await asyncio.to_thread(self.get, user_id)
+
+    async def adiscard(self, user_id: str) -> None:
+        await asyncio.to_thread(self.discard, user_id)
+
+    # --- Job checkpoints ---
+
+    def open_run(self, restart: bool) -> Dict[str, Any]:
+        with self._lock:
+            row = None if restart else self._conn.execute(
+                "SELECT run_id, cursor, users, written, seconds FROM precompute_runs "
+                "WHERE finished_at IS NULL ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                cur = self._conn.execute("INSERT INTO precompute_runs (started_at) VALUES (?)", (time.time(),))
+                self._conn.commit()
+                row = (cur.lastrowid, None, 0, 0, 0.0)
+        return dict(zip(("run_id", "cursor", "users", "written", "seconds"), row))
+
+    def write_page(self, run: Dict[str, Any], rows: List[Tuple[str, List[Any], float, Optional[str]]]) -> None:
+        """Stores one page of results and advances the run's cursor in the same transaction."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO recommendations (user_id, book_ids, history_at, computed_at, stamp) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(user_id, _encode_ids(ids), history_at, now, stamp) for user_id, ids, history_at, stamp in rows],
+            )
+            self._conn.execute(
+                "UPDATE precompute_runs SET cursor = ?, users = ?, written = ?, seconds = ? WHERE run_id = ?",
+                (run["cursor"], run["users"], run["written"], run["seconds"], run["run_id"]),
+            )
+            self._conn.commit()
+
+    def finish_run(self, run: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("UPDATE precompute_runs SET finished_at = ? WHERE run_id = ?", (time.time(), run["run_id"]))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows, oldest, newest = self._conn.execute(
+                "SELECT COUNT(*), MIN(computed_at), MAX(computed_at) FROM recommendations"
+            ).fetchone()
+            run = self._conn.execute(
+                "SELECT run_id, started_at, finished_at, users, written, seconds FROM precompute_runs ORDER BY run_id DESC LIMIT 1"
+            ).fetchone()
+        last_run = dict(zip(("run_id", "started_at", "finished_at", "users", "written", "seconds"), run)) if run else None
+        if last_run and last_run["seconds"]:
+            last_run["users_per_sec"] = round(last_run["users"] / last_run["seconds"], 1)
+        return {"rows": rows, "oldest_computed_at": oldest, "newest_computed_at": newest, "last_run": last_run}
+
+
+def _encode_ids(ids: List[Any]) -> str:
+    return ",".join(str(i) for i in ids)
+
+
+def _decode_ids(text: str) -> List[Any]:
+    return [int(i) if i.lstrip("-").isdigit() else i for i in text.split(",") if i]
+
+
+# --- Worker side ---
+
+_matrix: Optional[CatalogMatrix] = None
+_books: Dict[Any, Dict[str, Any]] = {}
+_weights: Optional[ScoringWeights] = None
+_vectors: Optional[VectorIndex] = None
+
+
+def _init_worker(matrix: CatalogMatrix, books: Dict[Any, Dict[str, Any]], weights: ScoringWeights,
+                 vectors: Optional[VectorIndex]) -> None:
+    global _matrix, _books, _weights, _vectors
+    _matrix, _books, _weights, _vectors = matrix, books, weights, vectors
+
+
+def recommend_chunk(chunk: List[Tuple[str, List[Dict[str, Any]], float, Optional[str]]],
+                    limit: int) -> List[Tuple[str, List[Any], float, Optional[str]]]:
+    """Same steps as the warm-start path in main.py, for a batch of (user_id, history, history_at, stamp)."""
+    results = []
+    for user_id, history, history_at, stamp in chunk:
+        if not history:
+            continue
+        scored_history = score_recent_history(history)
+        profile = build_user_profile(scored_history, _books)
+        read_book_ids = ReadSet(item["book_id"] for item in history)
+        picks, _ = rank_books(profile, scored_history, _matrix, _books, read_book_ids, _weights, limit, _vectors)
+        if picks:
+            results.append((user_id, [book["id"] for book in picks], history_at, stamp))
+    return results
+
+
+# --- Job ---
+
+async def iter_user_pages(client, page_size: int, after: Optional[str], active_since: Optional[str]):
+    """Yields lists of distinct user IDs in user_id order, starting after `after`."""
+    page: List[str] = []
+    last_seen = after
+    while True:
+        query = client.table("user_books").select("user_id").order("user_id").limit(page_size * 4)
+        if after is not None:
+            query = query.gt("user_id", after)
+        if active_since:
+            query = query.gte("updated_at", active_since)
+        rows = (await query.execute()).data or []
+        for row in rows:
+            user_id = row["user_id"]
+            if user_id != last_seen:
+                last_seen = user_id
+                page.append(user_id)
+                if len(page) == page_size:
+                    yield page
+                    page = []
+        if len(rows) < page_size * 4:
+            break
+        # Skips the rest of this user's rows: every fetch moves on to at least one new user
+        after = rows[-1]["user_id"]
+    if page:
+        yield page
+
+
+async def fetch_histories(client, user_ids: List[str],
+                          concurrency: int) -> List[Tuple[str, List[Dict[str, Any]], float, Optional[str]]]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(user_id: str):
+        async with semaphore:
+            history_at = time.time()
+            # Stamp first: a change that lands in between moves the stamp past the stored one
+            stamp = await ReadSetCache.fetch_stamp(client, user_id)
+            response = await client.rpc("get_full_user_history", {"p_user_id": user_id}).execute()
+            return user_id, response.data or [], history_at, encode_stamp(stamp)
+
+    return await asyncio.gather(*(fetch(u) for u in user_ids))
+
+
+async def run(args) -> None:
+    # Imported here: the service imports this module for PrecomputedStore only
+    from supabase import acreate_client
+
+    load_dotenv()
+    client = await acreate_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_KEY"])
+    store = PrecomputedStore(args.db)
+    run_state = store.open_run(args.restart)
+    if run_state["cursor"]:
+        print(f"Resuming run {run_state['run_id']} after user {run_state['cursor']} ({run_state['users']} users done)")
+
+    catalog = CatalogSnapshot(watermark_column=os.environ.get("CATALOG_WATERMARK_COLUMN", "updated_at"))
+    await catalog.load(client)
+    start = time.time()
+    matrix = CatalogMatrix(list(catalog.books.values()))
+    print(f"Catalog encoded: {len(matrix)} books in {time.time() - start:.2f}s")
+    vectors = VectorIndex(os.environ.get("VECTOR_INDEX_DIR", "book_vectors"),
+                          exact_max=int(os.environ.get("VECTOR_EXACT_MAX", "50000")),
+                          nprobe=int(os.environ.get("VECTOR_NPROBE", "16")))
+    if vectors.load():
+        print(f"Using vector index: {vectors.stats()['count']} books, {vectors.stats()['mode']} search")
+    else:
+        vectors = None
+
+    active_since = None
+    if args.active_days:
+        active_since = (datetime.now(timezone.utc) - timedelta(days=args.active_days)).isoformat()
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    loop = asyncio.get_running_loop()
+    weights = ScoringWeights.from_env()
+    with ProcessPoolExecutor(args.workers, mp_context=context, initializer=_init_worker,
+                             initargs=(matrix, catalog.books, weights, vectors)) as pool:
+
+        async def score(histories):
+            size = max(1, -(-len(histories) // args.workers))
+            chunks = [histories[i:i + size] for i in range(0, len(histories), size)]
+            parts = await asyncio.gather(*(loop.run_in_executor(pool, recommend_chunk, c, args.limit) for c in chunks))
+            return [row for part in parts for row in part]
+
+        resumed_seconds, started = run_state["seconds"], time.time()
+
+        async def flush(page_users, scoring):
+            rows = await scoring
+            run_state["cursor"] = page_users[-1]
+            run_state["users"] += len(page_users)
+            run_state["written"] += len(rows)
+            run_state["seconds"] = resumed_seconds + time.time() - started
+            store.write_page(run_state, rows)
+            rate = run_state["users"] / run_state["seconds"] if run_state["seconds"] else 0.0
+            print(f"  {run_state['users']} users ({run_state['written']} written), {rate:.1f} users/sec")
+
+        pending = None
+        async for user_ids in iter_user_pages(client, args.page_size, run_state["cursor"], active_since):
+            histories = await fetch_histories(client, user_ids, args.fetch_concurrency)
+            # Score this page in the pool while the next page is being fetched
+            if pending is not None:
+                await flush(*pending)
+            pending = (user_ids, asyncio.ensure_future(score(histories)))
+        if pending is not None:
+            await flush(*pending)
+
+    store.finish_run(run_state)
+    rate = run_state["users"] / run_state["seconds"] if run_state["seconds"] else 0.0
+    print(f"Precompute finished: {run_state['users']} users, {run_state['written']} written, "
+          f"{run_state['seconds']:.1f}s, {rate:.1f} users/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.environ.get("PRECOMPUTED_DB", "precomputed_recommendations.sqlite3"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--page-size", type=int, default=500, help="Users per page")
+    parser.add_argument("--fetch-concurrency", type=int, default=16, help="History RPCs in flight")
+    parser.add_argument("--limit", type=int, default=5, help="Books per user")
+    parser.add_argument("--active-days", type=float, default=0, help="Only users with user_books changes in the last N days")
+    parser.add_argument("--restart", action="store_true", help="Start a new run instead of resuming")
+    # Progress from the shared modules (catalog load etc.) goes to the console like the prints here
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Compact per-user read sets for excluding books the user already has.
+
+A ReadSet keeps book IDs as a sorted integer array (4 or 8 bytes per book),
+plus a small frozenset for any ID that isn't an integer. Membership is a
+binary search, and CatalogMatrix masks the whole set in one vectorized
+pass, so exclusion happens in memory instead of as a `not.in.(...)` filter
+that grows with the user's lifetime.
+
+A user's read set is the union of every book in their history, the same
+rows get_full_user_history joins: user_books, book_ratings and
+book_wishlist. ReadSetCache keeps the sets of recently active users (LRU),
+one part per table, tagged with the user's history stamp (see
+`fetch_stamp`). Per part:
+
+    stamp part unchanged                      -> cached part
+    user_books moved, count adds up           -> fetch only rows updated after the cached stamp
+    anything else (deletes, no stamp)         -> reload that table's IDs with keyset pagination
+
+book_ratings and book_wishlist are only stamped by row count, so their
+parts are also reloaded once they are older than `max_age`.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+PAGE_SIZE = 1000
+
+log = logging.getLogger(__name__)
+
+
+class ReadSet:
+    __slots__ = ("ints", "others")
+
+    def __init__(self, book_ids: Iterable[Any] = ()):
+        ints, others = [], set()
+        for book_id in book_ids:
+            if isinstance(book_id, (int, np.integer)) and not isinstance(book_id, bool):
+                ints.append(int(book_id))
+            elif book_id is not None:
+                others.add(book_id)
+        self.ints = self._pack(np.unique(np.asarray(ints, dtype=np.int64)))
+        self.others = frozenset(others)
+
+    @staticmethod
+    def _pack(ints: np.ndarray) -> np.ndarray:
+        if len(ints) and ints[0] >= np.iinfo(np.int32).min and ints[-1] <= np.iinfo(np.int32).max:
+            return ints.astype(np.int32)
+        return ints
+
+    def __len__(self) -> int:
+        return len(self.ints) + len(self.others)
+
+    def __contains__(self, book_id: Any) -> bool:
+        if isinstance(book_id, (int, np.integer)) and not isinstance(book_id, bool):
+            pos = np.searchsorted(self.ints, book_id)
+            return bool(pos < len(self.ints) and self.ints[pos] == book_id)
+        return book_id in self.others
+
+    def __iter__(self) -> Iterator[Any]:
+        yield from self.ints.tolist()
+        yield from self.others
+
+    def union(self, book_ids: Iterable[Any]) -> "ReadSet":
+        """A new set with `book_ids` added; this one is left unchanged (entries are shared between requests)."""
+        added = ReadSet(book_ids)
+        merged = ReadSet.__new__(ReadSet)
+        merged.ints = self._pack(np.union1d(self.ints.astype(np.int64), added.ints.astype(np.int64)))
+        merged.others = self.others | added.others
+        return merged
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.ints.nbytes) + 64 * len(self.others)
+
+
+SOURCES = ("user_books", "book_ratings", "book_wishlist")
+
+# (user_books (row count, latest updated_at), book_ratings count, book_wishlist count);
+# a part whose query failed is None
+Stamp = Tuple[Optional[Tuple[int, Optional[str]]], Optional[int], Optional[int]]
+
+
+@dataclass
+class _Entry:
+    parts: Dict[str, ReadSet]
+    stamp: Tuple[Any, ...]
+    loaded_at: Dict[str, float]
+    read_set: ReadSet
+
+
+class ReadSetCache:
+    def __init__(self, max_users: int = 10000, ttl: float = 60, max_age: float = 600):
+        self.max_users = max_users
+        # Only used when a stamp part can't be fetched
+        self.ttl = ttl
+        # Count-only parts are reloaded after this long, in case a delete and an insert cancelled out
+        self.max_age = max_age
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.incremental_loads = 0
+        self.full_loads = 0
+
+    @staticmethod
+    async def fetch_stamp(client, user_id: str) -> Optional[Stamp]:
+        """
+        Cheap fingerprint of the user's history: row count and latest
+        updated_at of user_books, plus the row counts of book_ratings and
+        book_wishlist. None if every query failed.
+        """
+        books_res, ratings_res, wishlist_res = await asyncio.gather(
+            client.table("user_books")
+            .select("updated_at", count="exact")
+            .eq("user_id", user_id)
+            .order("updated_at", desc=True, nullsfirst=False)
+            .limit(1)
+            .execute(),
+            client.table("book_ratings").select("book_id", count="exact").eq("user_id", user_id).limit(1).execute(),
+            client.table("book_wishlist").select("book_id", count="exact").eq("user_id", user_id).limit(1).execute(),
+            return_exceptions=True,
+        )
+        results = (books_res, ratings_res, wishlist_res)
+        failed = [r for r in results if isinstance(r, Exception)]
+        for source, result in zip(SOURCES, results):
+            if isinstance(result, Exception):
+                log.warning("could not fetch history stamp part",
+                            extra={"user_id": user_id, "table": source, "error": str(result)})
+        if len(failed) == len(results):
+            return None
+        books_part = None if isinstance(books_res, Exception) else (
+            books_res.count, books_res.data[0].get("updated_at") if books_res.data else None
+        )
+        return (
+            books_part,
+            None if isinstance(ratings_res, Exception) else ratings_res.count,
+            None if isinstance(wishlist_res, Exception) else wishlist_res.count,
+        )
+
+    @staticmethod
+    async def _fetch_all(client, table: str, user_id: str) -> List[Any]:
+        book_ids: List[Any] = []
+        last = None
+        while True:
+            query = client.table(table).select("book_id").eq("user_id", user_id).order("book_id").limit(PAGE_SIZE)
+            if last is not None:
+                query = query.gt("book_id", last)
+            rows = (await query.execute()).data or []
+            book_ids.extend(row["book_id"] for row in rows)
+            if len(rows) < PAGE_SIZE:
+                return book_ids
+            last = rows[-1]["book_id"]
+
+    @staticmethod
+    async def _fetch_since(client, user_id: str, updated_after: str) -> List[Any]:
+        rows = []
+        offset = 0
+        while True:
+            page = (await (
+                client.table("user_books")
+                .select("book_id")
+                .eq("user_id", user_id)
+                .gt("updated_at", updated_after)
+                .order("book_id")
+                .range(offset, offset + PAGE_SIZE - 1)
+                .execute()
+            )).data or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return [row["book_id"] for row in rows]
+            offset += PAGE_SIZE
+
+    def peek(self, user_id: str) -> Optional[ReadSet]:
+        """The cached set, whatever its stamp or age, without querying; None if not cached."""
+        entry = self._entries.get(user_id)
+        return entry.read_set if entry is not None else None
+
+    def _reusable(self, entry: Optional[_Entry], index: int, part: Any, now: float) -> bool:
+        if entry is None:
+            return False
+        source = SOURCES[index]
+        age = now - entry.loaded_at[source]
+        if part is None:
+            return age <= self.ttl
+        if entry.stamp[index] != part:
+            return False
+        return source == "user_books" or age <= self.max_age
+
+    async def _sync_part(self, client, user_id: str, index: int, part: Any, entry: Optional[_Entry]) -> ReadSet:
+        source = SOURCES[index]
+        if (source == "user_books" and entry is not None and part is not None
+                and entry.stamp[index] is not None and entry.stamp[index][1] is not None):
+            # Upserts bump updated_at, so new and re-read books are the rows past the cached stamp
+            merged = entry.parts[source].union(await self._fetch_since(client, user_id, entry.stamp[index][1]))
+            if len(merged) == part[0]:
+                self.incremental_loads += 1
+                return merged
+        self.full_loads += 1
+        return ReadSet(await self._fetch_all(client, source, user_id))
+
+    async def get(self, client, user_id: str, stamp: Optional[Stamp] = None) -> ReadSet:
+        """
+        Every book in the user's history, synced to `stamp` (fetched first if
+        not given). A part whose stamp is unknown is served as cached while
+        younger than `ttl`.
+        """
+        if stamp is None:
+            try:
+                stamp = await self.fetch_stamp(client, user_id)
+            except Exception as e:
+                log.warning("could not fetch read-set stamp", extra={"user_id": user_id, "error": str(e)})
+        parts_stamp = tuple(stamp) if stamp is not None else (None,) * len(SOURCES)
+
+        now = time.time()
+        entry = self._entries.get(user_id)
+        stale = [i for i, part in enumerate(parts_stamp) if not self._reusable(entry, i, part, now)]
+        if not stale:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry.read_set
+
+        parts = dict(entry.parts) if entry is not None else {}
+        loaded_at = dict(entry.loaded_at) if entry is not None else {}
+        synced = await asyncio.gather(*(self._sync_part(client, user_id, i, parts_stamp[i], entry) for i in stale))
+        for i, part_set in zip(stale, synced):
+            parts[SOURCES[i]] = part_set
+            loaded_at[SOURCES[i]] = now
+        read_set = parts["user_books"].union(
+            book_id for source in SOURCES[1:] for book_id in parts[source]
+        )
+
+        self._entries[user_id] = _Entry(parts, parts_stamp, loaded_at, read_set)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return read_set
+
+    def stats(self) -> Dict[str, Any]:
+        sizes = [len(entry.read_set) for entry in self._entries.values()]
+        part_bytes = sum(part.nbytes for entry in self._entries.values() for part in entry.parts.values())
+        return {
+            "users": len(sizes),
+            "max_users": self.max_users,
+            "books": sum(sizes),
+            "largest": max(sizes, default=0),
+            "memory_kb": round((sum(entry.read_set.nbytes for entry in self._entries.values()) + part_bytes) / 1024, 1),
+            "hits": self.hits,
+            "incremental_loads": self.incremental_loads,
+            "full_loads": self.full_loads,
+        }
@@ -0,0 +1,141 @@
+"""
+Per-user cache of recommendation responses.
+
+Each entry is tagged with the user's history stamp, a cheap fingerprint of
+their reading history (see `history_stamp` in main.py). A cached response
+is served while the stamp still matches:
+
+    stamp differs / entry invalidated   -> rebuild now (the result is known to be wrong)
+    age <= ttl                          -> fresh hit
+    ttl < age <= ttl + stale_ttl        -> stale hit, served while a rebuild runs in the background
+    older                               -> rebuild now
+
+The TTL only covers changes outside the user's history (catalog, leaderboard).
+At most `max_users` entries are kept (LRU).
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResult:
+    stamp: Any
+    response: Any
+    strategy: str
+    stored_at: float
+
+
+class ResultCache:
+    def __init__(self, max_users: int = 10000, ttl: float = 600, stale_ttl: float = 3600):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self._revalidating: Dict[str, asyncio.Task] = {}
+        # user -> time of the last invalidate(), so builds that started earlier aren't stored
+        self._invalidated_at: "OrderedDict[str, float]" = OrderedDict()
+        # strategy -> {"hits", "stale_hits", "misses"}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self.invalidations = 0
+
+    def _count(self, strategy: Optional[str], outcome: str) -> None:
+        counters = self._counters.setdefault(strategy or "unknown", {"hits": 0, "stale_hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+    def put(self, user_id: str, stamp: Any, response: Any, strategy: Optional[str], started_at: Optional[float] = None) -> None:
+        if started_at is not None and self._invalidated_at.get(user_id, 0.0) >= started_at:
+            return
+        self._entries[user_id] = CachedResult(stamp, response, strategy or "unknown", time.time())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> bool:
+        self.invalidations += 1
+        self._invalidated_at[user_id] = time.time()
+        self._invalidated_at.move_to_end(user_id)
+        while len(self._invalidated_at) > self.max_users:
+            self._invalidated_at.popitem(last=False)
+        return self._entries.pop(user_id, None) is not None
+
+    def peek(self, user_id: str, stamp: Any = None) -> Optional[Any]:
+        """
+        The cached response within ttl + stale_ttl, without counting a lookup or
+        rebuilding. If `stamp` is given, an entry for another stamp is ignored.
+        """
+        entry = self._entries.get(user_id)
+        if entry is None or (stamp is not None and entry.stamp != stamp):
+            return None
+        if time.time() - entry.stored_at > self.ttl + self.stale_ttl:
+            return None
+        return entry.response
+
+    async def get_or_build(self, user_id: str, stamp: Any, build: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns a cached response for `stamp`, or awaits `build()` and caches it.
+        A `stamp` of None (lookup failed) only accepts fresh entries.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and (stamp is None or entry.stamp == stamp):
+            age = time.time() - entry.stored_at
+            if age <= self.ttl:
+                self._entries.move_to_end(user_id)
+                self._count(entry.strategy, "hits")
+                return entry.response
+            if stamp is not None and age <= self.ttl + self.stale_ttl:
+                self._entries.move_to_end(user_id)
+                self._count(entry.strategy, "stale_hits")
+                self._revalidate(user_id, stamp, build)
+                return entry.response
+
+        started_at = time.time()
+        response = await build()
+        strategy = getattr(response, "strategy", None)
+        self._count(strategy, "misses")
+        self.put(user_id, stamp, response, strategy, started_at)
+        return response
+
+    def _revalidate(self, user_id: str, stamp: Any, build: Callable[[], Awaitable[Any]]) -> None:
+        if user_id in self._revalidating:
+            return
+
+        async def run():
+            started_at = time.time()
+            try:
+                response = await build()
+                self.put(user_id, stamp, response, getattr(response, "strategy", None), started_at)
+            except Exception as e:
+                # Keep serving the stale entry; the next request tries again
+                log.warning("background refresh of recommendations failed", extra={"user_id": user_id, "error": str(e)})
+            finally:
+                self._revalidating.pop(user_id, None)
+
+        self._revalidating[user_id] = asyncio.create_task(run())
+
+    def stats(self) -> Dict[str, Any]:
+        by_strategy = {}
+        for strategy, counters in self._counters.items():
+            total = sum(counters.values())
+            by_strategy[strategy] = {
+                **counters,
+                "hit_ratio": round((counters["hits"] + counters["stale_hits"]) / total, 4) if total else 0.0,
+            }
+        totals = {k: sum(c[k] for c in self._counters.values()) for k in ("hits", "stale_hits", "misses")}
+        lookups = sum(totals.values())
+        return {
+            "users": len(self._entries),
+            "max_users": self.max_users,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            **totals,
+            "hit_ratio": round((totals["hits"] + totals["stale_hits"]) / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "revalidating": len(self._revalidating),
+            "by_strategy": by_strategy,
+        }
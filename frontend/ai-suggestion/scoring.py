@@ -0,0 +1,311 @@
+"""
+Vectorized metadata scoring for recommendations.
+
+The catalog is encoded column-wise once per snapshot version:
+    genres    CSR rows (genre_indptr / genre_indices) of genre codes
+    author    int32 code per book (last code = unknown)
+    language  int32 code per book (last code = unknown)
+
+A user profile is three weight vectors (genre, author, language) built from
+the love-score-weighted history. Scoring the whole catalog is then one
+sparse matrix-vector product for genres plus two gathers:
+
+    score = w_genre * (G @ genre_w) + w_author * author_w[author] + w_language * language_w[language]
+
+and the top-k comes from np.argpartition.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from read_sets import ReadSet
+
+log = logging.getLogger(__name__)
+
+
+# The love score looks at this many of the most recent history items
+RECENT_HISTORY_SIZE = 5
+
+# Nearest neighbours of the history centroid that get re-ranked (see rank_books)
+EMBEDDING_CANDIDATES = 100
+
+
+@dataclass
+class ScoringWeights:
+    genre: float = 3.0
+    author: float = 2.0
+    language: float = 1.0
+    embedding: float = 4.0  # times cosine similarity, when a vector index is loaded
+
+    @classmethod
+    def from_env(cls) -> "ScoringWeights":
+        return cls(
+            genre=float(os.environ.get("SCORE_WEIGHT_GENRE", "3.0")),
+            author=float(os.environ.get("SCORE_WEIGHT_AUTHOR", "2.0")),
+            language=float(os.environ.get("SCORE_WEIGHT_LANGUAGE", "1.0")),
+            embedding=float(os.environ.get("SCORE_WEIGHT_EMBEDDING", "4.0")),
+        )
+
+
+@dataclass
+class UserProfile:
+    """Love-score-weighted preferences, e.g. {"Fiction": 1.3, "History": 0.4}."""
+    genres: Dict[str, float]
+    authors: Dict[str, float]
+    languages: Dict[str, float]
+
+
+def calculate_love_score(history_item: Dict[str, Any]) -> float:
+    """
+    Calculates a "Love Score" (from 0 to 1) based on user's interaction
+    with a book. This score weighs scroll depth, rating, and watchlist status.
+    
+    This function now works with the data from our new SQL function.
+    """
+    raw_scroll = history_item.get("scroll_depth", 0) or 0
+    raw_rating = history_item.get("rating", 0) or 0
+    raw_watchlist = history_item.get("was_in_watchlist", False)
+    
+    # Weighted average: scroll (50%), watchlist (30%), rating (20%)
+    scroll_norm = (raw_scroll / 100) * 0.5
+    watchlist_norm = (1 if raw_watchlist else 0) * 0.3
+    rating_norm = (raw_rating / 5) * 0.2
+    return scroll_norm + watchlist_norm + rating_norm
+
+
+def score_recent_history(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Love scores of the most recent history items (the RPC returns newest first)."""
+    return [
+        {"book_id": item["book_id"], "score": calculate_love_score(item)}
+        for item in history[:RECENT_HISTORY_SIZE]
+    ]
+
+
+def _genre_list(book: Dict[str, Any]) -> List[str]:
+    genres = book.get("genres")
+    return genres if isinstance(genres, list) else []
+
+
+def build_user_profile(scored_history: Iterable[Dict[str, Any]], books_by_id: Dict[Any, Dict[str, Any]]) -> UserProfile:
+    """
+    Sums each history item's love score into its book's genres, author and
+    language. `scored_history` items are {"book_id", "score"}.
+    """
+    genres: Dict[str, float] = {}
+    authors: Dict[str, float] = {}
+    languages: Dict[str, float] = {}
+    for item in scored_history:
+        book = books_by_id.get(item["book_id"])
+        if not book:
+            continue
+        score = item["score"]
+        for g in _genre_list(book):
+            if g:
+                genres[g] = genres.get(g, 0) + score
+        if a := book.get("author"):
+            authors[a] = authors.get(a, 0) + score
+        if l := book.get("language"):
+            languages[l] = languages.get(l, 0) + score
+    return UserProfile(genres, authors, languages)
+
+
+class CatalogMatrix:
+    def __init__(self, books: List[Dict[str, Any]], version: int = 0):
+        self.version = version
+        n = len(books)
+        self.ids: List[Any] = [b["id"] for b in books]
+        self.row_of: Dict[Any, int] = {book_id: row for row, book_id in enumerate(self.ids)}
+
+        self.genre_codes: Dict[str, int] = {}
+        self.author_codes: Dict[str, int] = {}
+        self.language_codes: Dict[str, int] = {}
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indices: List[int] = []
+        author = np.empty(n, dtype=np.int32)
+        language = np.empty(n, dtype=np.int32)
+        for row, book in enumerate(books):
+            for g in _genre_list(book):
+                if g:
+                    indices.append(self.genre_codes.setdefault(g, len(self.genre_codes)))
+            indptr[row + 1] = len(indices)
+            a = book.get("author")
+            author[row] = self.author_codes.setdefault(a, len(self.author_codes)) if a else -1
+            l = book.get("language")
+            language[row] = self.language_codes.setdefault(l, len(self.language_codes)) if l else -1
+
+        self.genre_indptr = indptr
+        self.genre_indices = np.asarray(indices, dtype=np.int32)
+        # Row of each non-zero, so the sparse product is a single weighted bincount
+        self.genre_rows = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+        # Unknown author/language point at an extra trailing slot that always weighs 0
+        self.author = np.where(author < 0, len(self.author_codes), author).astype(np.int32)
+        self.language = np.where(language < 0, len(self.language_codes), language).astype(np.int32)
+        self._index_ids()
+
+    def _index_ids(self) -> None:
+        # Integer IDs sorted alongside their rows, so a ReadSet maps to rows with one searchsorted
+        self.sorted_ids: Optional[np.ndarray] = None
+        self.sorted_rows: Optional[np.ndarray] = None
+        if self.ids and all(isinstance(i, int) and not isinstance(i, bool) for i in self.ids):
+            ids = np.asarray(self.ids, dtype=np.int64)
+            self.sorted_rows = np.argsort(ids, kind="stable")
+            self.sorted_ids = ids[self.sorted_rows]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_arrays(cls, genre_indptr, genre_indices, author, language, n_genres, n_authors, n_languages) -> "CatalogMatrix":
+        """Build directly from encoded arrays (used by the benchmark)."""
+        matrix = cls.__new__(cls)
+        matrix.version = 0
+        matrix.ids = list(range(len(author)))
+        matrix.row_of = {i: i for i in matrix.ids}
+        matrix.genre_codes = {f"g{i}": i for i in range(n_genres)}
+        matrix.author_codes = {f"a{i}": i for i in range(n_authors)}
+        matrix.language_codes = {f"l{i}": i for i in range(n_languages)}
+        matrix.genre_indptr = genre_indptr
+        matrix.genre_indices = genre_indices
+        matrix.genre_rows = np.repeat(np.arange(len(author), dtype=np.int32), np.diff(genre_indptr))
+        matrix.author = author
+        matrix.language = language
+        matrix._index_ids()
+        return matrix
+
+    def _weight_vector(self, codes: Dict[str, int], weights: Dict[str, float], extra_slot: bool) -> np.ndarray:
+        vector = np.zeros(len(codes) + (1 if extra_slot else 0), dtype=np.float32)
+        top = max(weights.values(), default=0.0)
+        if top <= 0:
+            return vector
+        for key, weight in weights.items():
+            code = codes.get(key)
+            if code is not None:
+                # Normalized so the user's strongest preference weighs 1.0
+                vector[code] = weight / top
+        return vector
+
+    def score(self, profile: UserProfile, weights: ScoringWeights) -> np.ndarray:
+        n = len(self)
+        genre_w = self._weight_vector(self.genre_codes, profile.genres, extra_slot=False)
+        author_w = self._weight_vector(self.author_codes, profile.authors, extra_slot=True)
+        language_w = self._weight_vector(self.language_codes, profile.languages, extra_slot=True)
+
+        genre_part = np.bincount(self.genre_rows, weights=genre_w[self.genre_indices], minlength=n) if n else np.zeros(0)
+        scores = weights.genre * genre_part.astype(np.float32)
+        scores += weights.author * author_w[self.author]
+        scores += weights.language * language_w[self.language]
+        return scores
+
+    def rows_of(self, book_ids: Iterable[Any]) -> np.ndarray:
+        """Rows of the given IDs that are in the matrix (vectorized for a ReadSet)."""
+        if isinstance(book_ids, ReadSet) and self.sorted_ids is not None:
+            pos = np.searchsorted(self.sorted_ids, book_ids.ints)
+            pos[pos == len(self.sorted_ids)] = 0
+            rows = self.sorted_rows[pos[self.sorted_ids[pos] == book_ids.ints]]
+            others = [self.row_of[i] for i in book_ids.others if i in self.row_of]
+            return np.concatenate([rows, np.asarray(others, dtype=rows.dtype)]) if others else rows
+        return np.asarray([self.row_of[i] for i in book_ids if i in self.row_of], dtype=np.int64)
+
+    def top_k(self, scores: np.ndarray, k: int, exclude_ids: Iterable[Any] = ()) -> List[Any]:
+        """IDs of the k best-scoring books with a positive score, best first."""
+        scores = scores.copy()
+        exclude_rows = self.rows_of(exclude_ids)
+        if len(exclude_rows):
+            scores[exclude_rows] = -np.inf
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.ids[row] for row in top if scores[row] > 0]
+
+
+def similar_books(profile: UserProfile, matrix: CatalogMatrix, books_by_id: Dict[Any, Dict[str, Any]],
+                  read_book_ids: Iterable[Any], weights: ScoringWeights, limit: int = 5) -> List[Dict[str, Any]]:
+    """The `limit` best unread books for `profile`, as rows of `books_by_id`."""
+    scores = matrix.score(profile, weights)
+    # A little slack, in case a stale matrix still holds books that were since deleted
+    top_ids = matrix.top_k(scores, limit * 2, exclude_ids=read_book_ids)
+    return [books_by_id[i] for i in top_ids if i in books_by_id][:limit]
+
+
+def rank_books(profile: UserProfile, scored_history: List[Dict[str, Any]], matrix: CatalogMatrix,
+               books_by_id: Dict[Any, Dict[str, Any]], read_book_ids: Iterable[Any], weights: ScoringWeights,
+               limit: int = 5, vectors=None) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Returns (books, strategy). With a loaded vector index (vector_index.py),
+    the nearest neighbours of the love-score-weighted history centroid are
+    the candidates, ranked by metadata score + weights.embedding * similarity.
+    Otherwise the whole catalog is ranked by metadata score alone.
+    """
+    if vectors is not None and vectors.ready:
+        candidates = vectors.similar_to_history(scored_history, read_book_ids, EMBEDDING_CANDIDATES)
+        if candidates:
+            scores = matrix.score(profile, weights)
+            ranked = []
+            for book_id, similarity in candidates:
+                row = matrix.row_of.get(book_id)
+                metadata = float(scores[row]) if row is not None else 0.0
+                ranked.append((metadata + weights.embedding * similarity, book_id))
+            ranked.sort(key=lambda pair: pair[0], reverse=True)
+            books = [books_by_id[i] for _, i in ranked if i in books_by_id][:limit]
+            if books:
+                return books, "embedding_similarity"
+    return similar_books(profile, matrix, books_by_id, read_book_ids, weights, limit), "metadata_matching"
+
+
+class MatrixCache:
+    """
+    Holds the CatalogMatrix for the catalog snapshot. When the snapshot version
+    moves, the matrix is rebuilt in a worker thread and the previous one keeps
+    serving until the new one is ready.
+    """
+
+    def __init__(self):
+        self.matrix: Optional[CatalogMatrix] = None
+        self.builds = 0
+        self.last_build_seconds = 0.0
+        self._building: Optional[asyncio.Future] = None
+
+    async def get(self, catalog) -> CatalogMatrix:
+        if self.matrix is not None and self.matrix.version == catalog.version:
+            return self.matrix
+        if self._building is None:
+            # Copy the rows here, on the event loop, so refreshes can't mutate them mid-build
+            books, version = list(catalog.books.values()), catalog.version
+            self._building = asyncio.ensure_future(asyncio.to_thread(self._build, books, version))
+            self._building.add_done_callback(self._built)
+        if self.matrix is not None:
+            return self.matrix
+        return await asyncio.shield(self._building)
+
+    def _build(self, books: List[Dict[str, Any]], version: int) -> CatalogMatrix:
+        start = time.time()
+        matrix = CatalogMatrix(books, version=version)
+        self.last_build_seconds = time.time() - start
+        return matrix
+
+    def _built(self, future: asyncio.Future) -> None:
+        self._building = None
+        if future.cancelled() or future.exception() is not None:
+            log.warning("catalog matrix build failed",
+                        extra={"error": "cancelled" if future.cancelled() else repr(future.exception())})
+            return
+        self.matrix = future.result()
+        self.builds += 1
+
+    def stats(self) -> Dict[str, Any]:
+        matrix = self.matrix
+        return {
+            "version": matrix.version if matrix is not None else None,
+            "books": len(matrix) if matrix is not None else 0,
+            "genres": len(matrix.genre_codes) if matrix is not None else 0,
+            "builds": self.builds,
+            "last_build_seconds": round(self.last_build_seconds, 4),
+        }
@@ -0,0 +1,135 @@
+"""
+Tests for incremental ingestion against a `file:` vector store, with a fake
+Supabase page source and a fake encoder: an interrupted run resumes after
+its last committed page, and a later run re-embeds only changed books and
+deletes the ones that left the catalog.
+
+    python -m pytest test_ingest.py
+"""
+import hashlib
+
+import numpy as np
+import pytest
+
+import ingest
+from vector_index import iter_artifact
+from vector_store import FileVectorStore
+
+
+class FakeQuery:
+    def __init__(self, source):
+        self.source = source
+        self.after = None
+        self.size = None
+
+    def select(self, columns):
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, size):
+        self.size = size
+        return self
+
+    def gt(self, column, value):
+        self.after = value
+        return self
+
+    def execute(self):
+        rows = [book for book in sorted(self.source.books, key=lambda b: b["id"])
+                if self.after is None or book["id"] > self.after]
+        return type("Response", (), {"data": [dict(row) for row in rows[:self.size]]})
+
+
+class FlakyStore(FileVectorStore):
+    """Fails every upsert that contains one of `failing` (vector IDs)."""
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.failing = set()
+
+    def upsert(self, vectors, namespace):
+        if self.failing & {vector["id"] for vector in vectors}:
+            raise ConnectionError("upsert failed")
+        super().upsert(vectors, namespace)
+
+
+class FakeSupabase:
+    """The `books` table, keyset-paginated."""
+
+    def __init__(self, books):
+        self.books = books
+
+    def table(self, name):
+        assert name == "books"
+        return FakeQuery(self)
+
+
+def fake_vector(text):
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+    vector = np.random.default_rng(seed).standard_normal(ingest.EMBEDDING_DIMENSION).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def book(book_id, title=None):
+    return {"id": book_id, "title": title or f"Book {book_id}", "author": "A", "genre": "Fiction", "genres": ["x"]}
+
+
+@pytest.fixture
+def env(monkeypatch, tmp_path):
+    source = FakeSupabase([book(i) for i in range(1, 7)])
+    embedded = []
+
+    def make_encoder(processes, batch_size):
+        def encode(texts):
+            embedded.extend(texts)
+            return np.stack([fake_vector(text) for text in texts])
+        return encode, lambda: None
+
+    monkeypatch.setattr(ingest, "supabase", source)
+    monkeypatch.setattr(ingest, "make_encoder", make_encoder)
+    monkeypatch.setattr(ingest, "VECTOR_INDEX_DIR", str(tmp_path / "book_vectors"))
+    monkeypatch.setattr(ingest, "UPSERT_ATTEMPTS", 1)
+    store = FlakyStore(str(tmp_path / "store"))
+    monkeypatch.setattr(ingest, "open_vector_store", lambda spec, *args: store)
+
+    def run():
+        embedded.clear()
+        ingest.run_ingestion(store=f"file:{tmp_path / 'store'}", state_path=str(tmp_path / "state.sqlite3"),
+                             page_size=2, batch_size=2, processes=0, upsert_concurrency=2)
+        return [text.split(".")[0].removeprefix("Title: ") for text in embedded]
+
+    return source, run, store, str(tmp_path / "book_vectors")
+
+
+def artifact_ids(path):
+    return [book_id for ids, _ in iter_artifact(path) for book_id in ids]
+
+
+def test_interrupted_run_resumes_after_the_last_committed_page(env):
+    source, run, store, _ = env
+    store.failing = {"5"}
+    with pytest.raises(ConnectionError):
+        run()
+    # Pages 1-2 and 3-4 were committed; the page holding book 5 was not
+    assert sorted(store.records("")) == ["1", "2", "3", "4"]
+
+    store.failing = set()
+    assert run() == ["Book 5", "Book 6"]
+    assert sorted(store.records("")) == ["1", "2", "3", "4", "5", "6"]
+
+
+def test_incremental_run_embeds_changes_and_deletes_removed_books(env):
+    source, run, store, vectors_dir = env
+    assert len(run()) == 6
+    assert run() == []
+
+    source.books = [b for b in source.books if b["id"] != 3]
+    source.books[3] = book(5, "Book 5, revised")
+    assert run() == ["Book 5, revised"]
+
+    records = store.records("")
+    assert sorted(records) == ["1", "2", "4", "5", "6"]
+    assert np.allclose(records["5"]["values"], fake_vector(ingest.get_text_to_embed(book(5, "Book 5, revised"))))
+    assert sorted(artifact_ids(vectors_dir)) == [1, 2, 4, 5, 6]
@@ -0,0 +1,141 @@
+"""
+Tests for ReadSetCache: the read set is the union of user_books, book_ratings
+and book_wishlist; new user_books rows are fetched incrementally past the
+cached stamp, while deletes and other tables' changes reload only their part.
+
+    python -m pytest test_read_sets.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from read_sets import ReadSet, ReadSetCache
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.filters = []
+        self.order_by = None
+        self.descending = False
+        self.window = (0, None)
+
+    def select(self, columns, count=None):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row[column] > value)
+        return self
+
+    def order(self, column, desc=False, nullsfirst=False):
+        self.order_by, self.descending = column, desc
+        return self
+
+    def limit(self, size):
+        self.window = (0, size)
+        return self
+
+    def range(self, start, end):
+        self.window = (start, end + 1)
+        return self
+
+    async def execute(self):
+        self.client.queries.append((self.table, len(self.filters)))
+        rows = [row for row in self.client.tables[self.table] if all(f(row) for f in self.filters)]
+        if self.order_by:
+            rows.sort(key=lambda row: row[self.order_by], reverse=self.descending)
+        start, end = self.window
+        return SimpleNamespace(data=rows[start:end], count=len(rows))
+
+
+class FakeClient:
+    def __init__(self):
+        self.tables = {"user_books": [], "book_ratings": [], "book_wishlist": []}
+        self.queries = []
+        self.clock = 0
+
+    def add(self, table, book_id, user_id="u1"):
+        self.clock += 1
+        self.tables[table].append({"user_id": user_id, "book_id": book_id, "updated_at": f"2026-01-01T00:00:{self.clock:02d}"})
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+async def read(cache, client, user_id="u1"):
+    client.queries.clear()
+    stamp = await cache.fetch_stamp(client, user_id)
+    client.queries.clear()
+    return sorted(await cache.get(client, user_id, stamp))
+
+
+def test_read_set_packs_integers_and_keeps_other_ids():
+    read_set = ReadSet([3, 1, 3, "isbn-1", None]).union([2, 2**40])
+    assert sorted(read_set, key=str) == sorted([1, 2, 3, 2**40, "isbn-1"], key=str)
+    assert 2**40 in read_set and "isbn-1" in read_set and 4 not in read_set and True not in read_set
+    assert ReadSet([1, 2]).ints.dtype.itemsize == 4
+
+
+def test_every_history_table_counts_as_read():
+    client = FakeClient()
+    client.add("user_books", 1)
+    client.add("book_ratings", 2)
+    client.add("book_wishlist", 3)
+    client.add("user_books", 9, user_id="u2")
+
+    assert asyncio.run(read(ReadSetCache(), client)) == [1, 2, 3]
+
+
+def test_new_user_books_rows_are_fetched_incrementally():
+    async def run():
+        client = FakeClient()
+        cache = ReadSetCache()
+        for book_id in (1, 2, 3):
+            client.add("user_books", book_id)
+        first = await read(cache, client)
+
+        # Unchanged stamp: no queries beyond the stamp itself
+        unchanged = await read(cache, client)
+        assert client.queries == []
+
+        client.add("user_books", 4)
+        grown = await read(cache, client)
+        # Only the rows past the cached updated_at, from user_books
+        assert client.queries == [("user_books", 2)]
+        return cache, first, unchanged, grown
+
+    cache, first, unchanged, grown = asyncio.run(run())
+    assert first == unchanged == [1, 2, 3]
+    assert grown == [1, 2, 3, 4]
+    assert cache.stats()["incremental_loads"] == 1
+
+
+def test_deletes_and_other_tables_reload_only_their_part():
+    async def run():
+        client = FakeClient()
+        cache = ReadSetCache()
+        for book_id in (1, 2, 3):
+            client.add("user_books", book_id)
+        client.add("book_ratings", 7)
+        await read(cache, client)
+
+        # A delete plus a re-read keeps the count, but the newer updated_at reveals it
+        client.tables["user_books"] = [row for row in client.tables["user_books"] if row["book_id"] != 2]
+        client.add("user_books", 5)
+        after_delete = await read(cache, client)
+        user_books_queries = [table for table, _ in client.queries]
+
+        client.add("book_wishlist", 8)
+        after_wishlist = await read(cache, client)
+        return after_delete, user_books_queries, after_wishlist, [table for table, _ in client.queries]
+
+    after_delete, delete_queries, after_wishlist, wishlist_queries = asyncio.run(run())
+    assert after_delete == [1, 3, 5, 7]
+    # The incremental fetch doesn't add up to the new count, so user_books is reloaded
+    assert delete_queries == ["user_books", "user_books"]
+    assert after_wishlist == [1, 3, 5, 7, 8]
+    assert wishlist_queries == ["book_wishlist"]
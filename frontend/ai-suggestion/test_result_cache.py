@@ -0,0 +1,92 @@
+"""
+Tests for ResultCache: entries are served only for the stamp they were built
+for, stale entries are served while a background rebuild runs, and a build
+that started before invalidate() is not stored.
+
+    python -m pytest test_result_cache.py
+"""
+import asyncio
+from types import SimpleNamespace
+
+from result_cache import ResultCache
+
+
+def builder(*responses):
+    """A build function returning `responses` in turn, counting its calls."""
+    queue = list(responses)
+
+    async def build():
+        build.calls += 1
+        return SimpleNamespace(strategy="metadata_matching", books=queue.pop(0))
+
+    build.calls = 0
+    return build
+
+
+def test_a_new_stamp_forces_a_rebuild():
+    async def run():
+        cache = ResultCache()
+        build = builder(["a"], ["b"])
+        first = await cache.get_or_build("u1", (3, "t1"), build)
+        again = await cache.get_or_build("u1", (3, "t1"), build)
+        moved = await cache.get_or_build("u1", (4, "t2"), build)
+        return cache, build, first, again, moved
+
+    cache, build, first, again, moved = asyncio.run(run())
+    assert (first.books, again.books, moved.books) == (["a"], ["a"], ["b"])
+    assert build.calls == 2
+    assert cache.peek("u1", (3, "t1")) is None
+    assert cache.peek("u1", (4, "t2")).books == ["b"]
+
+
+def test_unknown_stamp_accepts_only_fresh_entries():
+    async def run():
+        cache = ResultCache(ttl=0.05, stale_ttl=60)
+        build = builder(["a"], ["b"])
+        await cache.get_or_build("u1", (3, "t1"), build)
+        fresh = await cache.get_or_build("u1", None, build)
+        await asyncio.sleep(0.06)
+        expired = await cache.get_or_build("u1", None, build)
+        return fresh, expired
+
+    fresh, expired = asyncio.run(run())
+    assert (fresh.books, expired.books) == (["a"], ["b"])
+
+
+def test_stale_entry_is_served_while_it_is_rebuilt():
+    async def run():
+        cache = ResultCache(ttl=0.05, stale_ttl=60)
+        build = builder(["a"], ["b"])
+        await cache.get_or_build("u1", (3, "t1"), build)
+        await asyncio.sleep(0.06)
+        stale = await cache.get_or_build("u1", (3, "t1"), build)
+        await asyncio.sleep(0.01)
+        refreshed = await cache.get_or_build("u1", (3, "t1"), build)
+        return cache, stale, refreshed
+
+    cache, stale, refreshed = asyncio.run(run())
+    assert (stale.books, refreshed.books) == (["a"], ["b"])
+    stats = cache.stats()
+    assert (stats["hits"], stats["stale_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_build_started_before_invalidate_is_not_stored():
+    async def run():
+        cache = ResultCache()
+        gate = asyncio.Event()
+
+        async def slow_build():
+            await gate.wait()
+            return SimpleNamespace(strategy="metadata_matching", books=["old"])
+
+        building = asyncio.create_task(cache.get_or_build("u1", (3, "t1"), slow_build))
+        await asyncio.sleep(0)
+        cache.invalidate("u1")
+        gate.set()
+        served = await building
+        return cache, served
+
+    cache, served = asyncio.run(run())
+    # The caller still gets its response, but it isn't cached for the next one
+    assert served.books == ["old"]
+    assert cache.peek("u1") is None
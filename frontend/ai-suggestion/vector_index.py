@@ -0,0 +1,373 @@
+"""
+Local book embedding artifact and nearest-neighbour search.
+
+ingest.py writes the artifact next to the Pinecone upsert:
+
+    <dir>/meta.json          model, dim, dtype, count, IVF settings
+    <dir>/ids.json           book ID of each row
+    <dir>/vectors.npy        (count, dim) unit vectors, float16 or int8
+    <dir>/scales.npy         (count,) float32 per-row scale (int8 only)
+    <dir>/ivf_*.npy          coarse centroids + rows grouped by centroid (large catalogs only)
+
+VectorIndex memory-maps the arrays, so only the pages a query touches are
+read. Catalogs up to `exact_max` rows are searched exactly (one chunked
+matmul, over a resident float32 copy when it fits in `exact_cache_mb`);
+larger ones go through the IVF index and only score the rows of the
+`nprobe` nearest centroids.
+
+Synthetic benchmark (exact vs IVF latency and recall):
+    python vector_index.py --synthetic 200000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from read_sets import ReadSet
+
+CHUNK_ROWS = 65536
+
+
+# --- Writing ---
+
+def _quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"Unsupported vector dtype: {dtype}")
+
+
+def _kmeans(vectors: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over `vectors` (a sample of the catalog); returns unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = ~sums.any(axis=1)
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+def _decode(stored: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+    vectors = np.asarray(stored, dtype=np.float32)
+    if scales is not None:
+        vectors *= scales[:, None]
+    return vectors
+
+
+class ArtifactWriter:
+    """
+    Streams vectors into a new artifact with bounded memory: rows are
+    quantized and appended to a raw file as they arrive, and finish() turns
+    that into the .npy files (plus the IVF index for large catalogs) in a
+    temporary directory before swapping it in, so a running service never
+    sees half an artifact.
+    """
+
+    def __init__(self, out_dir: str, model: str, dtype: str = "float16", ivf_min_rows: int = 50000,
+                 extra_meta: Optional[Dict[str, Any]] = None):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.out_dir = out_dir
+        self.model = model
+        self.dtype = dtype
+        self.ivf_min_rows = ivf_min_rows
+        self.extra_meta = extra_meta or {}
+        parent = os.path.dirname(os.path.abspath(out_dir))
+        os.makedirs(parent, exist_ok=True)
+        self.tmp = tempfile.mkdtemp(prefix=".vectors-", dir=parent)
+        self._raw = open(os.path.join(self.tmp, "vectors.raw"), "wb")
+        self._raw_scales = open(os.path.join(self.tmp, "scales.raw"), "wb") if dtype == "int8" else None
+        self.ids: List[Any] = []
+        self.dim: Optional[int] = None
+
+    def add(self, ids: Sequence[Any], vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(ids):
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        stored, scales = _quantize(vectors / np.where(norms == 0, 1, norms), self.dtype)
+        self._raw.write(stored.tobytes())
+        if self._raw_scales is not None:
+            self._raw_scales.write(scales.tobytes())
+        self.ids.extend(ids)
+
+    def _to_npy(self, raw_name: str, npy_name: str, dtype, shape) -> np.ndarray:
+        raw_path = os.path.join(self.tmp, raw_name)
+        out = np.lib.format.open_memmap(os.path.join(self.tmp, npy_name), mode="w+", dtype=dtype, shape=shape)
+        if shape[0]:
+            raw = np.memmap(raw_path, dtype=dtype, mode="r", shape=shape)
+            for i in range(0, shape[0], CHUNK_ROWS):
+                out[i:i + CHUNK_ROWS] = raw[i:i + CHUNK_ROWS]
+            del raw
+        out.flush()
+        os.remove(raw_path)
+        return out
+
+    def finish(self) -> Dict[str, Any]:
+        """Finalizes the artifact, swaps it in, and returns the meta dict."""
+        self._raw.close()
+        count, dim = len(self.ids), self.dim or 0
+        stored = self._to_npy("vectors.raw", "vectors.npy", np.float16 if self.dtype == "float16" else np.int8, (count, dim))
+        scales = None
+        if self._raw_scales is not None:
+            self._raw_scales.close()
+            scales = np.array(self._to_npy("scales.raw", "scales.npy", np.float32, (count,)))
+        with open(os.path.join(self.tmp, "ids.json"), "w") as f:
+            json.dump(self.ids, f)
+
+        meta = {"model": self.model, "dim": dim, "count": count, "dtype": self.dtype,
+                "ivf": False, "created_at": time.time(), **self.extra_meta}
+        if count and count >= self.ivf_min_rows:
+            nlist = int(min(4096, count, max(16, 4 * np.sqrt(count))))
+            rng = np.random.default_rng(0)
+            sample_rows = np.sort(rng.choice(count, size=min(count, nlist * 64), replace=False))
+            centroids = _kmeans(_decode(stored[sample_rows], scales[sample_rows] if scales is not None else None), nlist)
+            assign = np.concatenate([
+                np.argmax(_decode(stored[i:i + CHUNK_ROWS], scales[i:i + CHUNK_ROWS] if scales is not None else None) @ centroids.T, axis=1)
+                for i in range(0, count, CHUNK_ROWS)
+            ])
+            order = np.argsort(assign, kind="stable").astype(np.int32)
+            offsets = np.zeros(nlist + 1, dtype=np.int64)
+            np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+            np.save(os.path.join(self.tmp, "ivf_centroids.npy"), centroids)
+            np.save(os.path.join(self.tmp, "ivf_order.npy"), order)
+            np.save(os.path.join(self.tmp, "ivf_offsets.npy"), offsets)
+            meta.update(ivf=True, nlist=nlist)
+        del stored
+        with open(os.path.join(self.tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        old = None
+        if os.path.exists(self.out_dir):
+            old = self.out_dir.rstrip("/") + f".old-{int(time.time())}"
+            os.rename(self.out_dir, old)
+        os.rename(self.tmp, self.out_dir)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+        return meta
+
+    def abort(self) -> None:
+        for f in (self._raw, self._raw_scales):
+            if f is not None:
+                f.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def write_artifact(out_dir: str, ids: Sequence[Any], vectors: np.ndarray, model: str,
+                   dtype: str = "float16", ivf_min_rows: int = 50000) -> Dict[str, Any]:
+    """Writes a whole artifact in one go (see ArtifactWriter). Returns the meta dict."""
+    writer = ArtifactWriter(out_dir, model, dtype, ivf_min_rows)
+    writer.add(ids, vectors)
+    return writer.finish()
+
+
+# --- Reading ---
+
+def read_meta(path: str) -> Optional[Dict[str, Any]]:
+    """The artifact's meta dict, or None if there is no artifact at `path`."""
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def iter_artifact(path: str, chunk_rows: int = CHUNK_ROWS) -> Iterable[Tuple[List[Any], np.ndarray]]:
+    """(book IDs, decoded float32 vectors) of an artifact, `chunk_rows` rows at a time."""
+    with open(os.path.join(path, "ids.json")) as f:
+        ids = json.load(f)
+    stored = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    scales_path = os.path.join(path, "scales.npy")
+    scales = np.load(scales_path) if os.path.exists(scales_path) else None
+    for i in range(0, len(ids), chunk_rows):
+        yield ids[i:i + chunk_rows], _decode(stored[i:i + chunk_rows], scales[i:i + chunk_rows] if scales is not None else None)
+
+
+class VectorIndex:
+    # 80 MB keeps a full exact-search catalog (50k x 384 float32 = 73 MB) resident
+    def __init__(self, path: str, exact_max: int = 50000, nprobe: int = 16, exact_cache_mb: float = 80):
+        self.path = path
+        self.exact_max = exact_max
+        self.nprobe = nprobe
+        self.exact_cache_mb = exact_cache_mb
+        self.resident: Optional[np.ndarray] = None
+        self.ready = False
+        self.meta: Dict[str, Any] = {}
+        self.load_report: Dict[str, Any] = {}
+
+    def load(self) -> bool:
+        """Memory-maps the artifact; returns False if there is none."""
+        if not os.path.exists(os.path.join(self.path, "meta.json")):
+            return False
+        start = time.time()
+        with open(os.path.join(self.path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(self.path, "ids.json")) as f:
+            self.ids: List[Any] = json.load(f)
+        self.row_of: Dict[Any, int] = {book_id: row for row, book_id in enumerate(self.ids)}
+        self.vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r")
+        scales_path = os.path.join(self.path, "scales.npy")
+        self.scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        self.ivf = bool(self.meta.get("ivf")) and len(self.ids) > self.exact_max
+        if self.ivf:
+            self.centroids = np.load(os.path.join(self.path, "ivf_centroids.npy"))
+            self.order = np.load(os.path.join(self.path, "ivf_order.npy"), mmap_mode="r")
+            self.offsets = np.load(os.path.join(self.path, "ivf_offsets.npy"))
+        elif self.vectors.size * 4 <= self.exact_cache_mb * 2**20:
+            # Small catalog: decode once instead of converting float16/int8 on every query
+            self.resident = self.vectors_for(np.arange(len(self.ids)))
+        self.ready = True
+        self.load_report = {"load_seconds": round(time.time() - start, 3), **self._memory()}
+        return True
+
+    def _memory(self) -> Dict[str, Any]:
+        mapped = sum(
+            os.path.getsize(os.path.join(self.path, name))
+            for name in os.listdir(self.path) if name.endswith(".npy")
+        )
+        resident = self.resident.nbytes if self.resident is not None else 0
+        return {"mapped_mb": round(mapped / 2**20, 2), "resident_mb": round(resident / 2**20, 2),
+                "id_map_entries": len(self.ids)}
+
+    def vectors_for(self, rows: np.ndarray) -> np.ndarray:
+        """Decoded float32 vectors of `rows`, in the given order."""
+        return _decode(self.vectors[rows], self.scales[rows] if self.scales is not None else None)
+
+    def _score_rows(self, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        if rows is None and self.resident is not None:
+            return self.resident @ query
+        if rows is None:
+            parts = []
+            for i in range(0, len(self.ids), CHUNK_ROWS):
+                part = np.asarray(self.vectors[i:i + CHUNK_ROWS], dtype=np.float32) @ query
+                if self.scales is not None:
+                    part *= self.scales[i:i + CHUNK_ROWS]
+                parts.append(part)
+            return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+        part = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        if self.scales is not None:
+            part *= self.scales[rows]
+        return part
+
+    def search(self, query: np.ndarray, k: int, exclude_ids: Iterable[Any] = ()) -> List[Tuple[Any, float]]:
+        """(book ID, cosine similarity) of the k nearest rows, best first."""
+        query = np.asarray(query, dtype=np.float32)
+        rows = None
+        if self.ivf:
+            probe = np.argpartition(-(self.centroids @ query), min(self.nprobe, len(self.centroids)) - 1)[: self.nprobe]
+            rows = np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe]))
+        scores = self._score_rows(query, rows)
+        exclude = exclude_ids if isinstance(exclude_ids, (set, frozenset, ReadSet)) else set(exclude_ids)
+        want = min(len(scores), k + len(exclude))
+        if want <= 0:
+            return []
+        top = np.argpartition(-scores, want - 1)[:want]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        results = []
+        for pos in top:
+            row = int(rows[pos]) if rows is not None else int(pos)
+            if self.ids[row] in exclude:
+                continue
+            results.append((self.ids[row], float(scores[pos])))
+            if len(results) == k:
+                break
+        return results
+
+    def history_centroid(self, scored_history: List[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Love-score-weighted mean of the history books' vectors (unit length), or None."""
+        pairs = [(self.row_of[h["book_id"]], h["score"]) for h in scored_history if h["book_id"] in self.row_of]
+        if not pairs:
+            return None
+        rows = np.array([row for row, _ in pairs])
+        weights = np.array([max(score, 0.0) for _, score in pairs], dtype=np.float32)
+        if not weights.any():
+            weights[:] = 1.0
+        centroid = (self.vectors_for(rows) * weights[:, None]).sum(axis=0)
+        norm = np.linalg.norm(centroid)
+        return centroid / norm if norm else None
+
+    def similar_to_history(self, scored_history: List[Dict[str, Any]], exclude_ids: Iterable[Any],
+                           k: int) -> List[Tuple[Any, float]]:
+        centroid = self.history_centroid(scored_history)
+        return self.search(centroid, k, exclude_ids) if centroid is not None else []
+
+    def probe_latency(self, queries: int = 20, k: int = 50) -> Dict[str, float]:
+        """Times `queries` searches with random catalog rows as queries."""
+        if not self.ids:
+            return {}
+        rng = np.random.default_rng(0)
+        samples = []
+        for row in rng.integers(0, len(self.ids), size=queries):
+            query = self.vectors_for(np.array([row]))[0]
+            start = time.perf_counter()
+            self.search(query, k)
+            samples.append((time.perf_counter() - start) * 1000)
+        return {"query_p50_ms": round(float(np.percentile(samples, 50)), 2),
+                "query_p95_ms": round(float(np.percentile(samples, 95)), 2)}
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.ready:
+            return {"ready": False, "path": self.path}
+        return {
+            "ready": True,
+            "path": self.path,
+            "model": self.meta.get("model"),
+            "count": len(self.ids),
+            "dim": self.meta.get("dim"),
+            "dtype": self.meta.get("dtype"),
+            "mode": "ivf" if self.ivf else "exact",
+            "nprobe": self.nprobe if self.ivf else None,
+            **self.load_report,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", type=int, required=True, help="Rows in the synthetic catalog")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--dtype", default="float16", choices=["float16", "int8"])
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Clustered data, so IVF recall is meaningful
+    centers = rng.normal(size=(max(8, args.synthetic // 500), args.dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), size=args.synthetic)] + 0.6 * rng.normal(size=(args.synthetic, args.dim)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vectors")
+        start = time.time()
+        meta = write_artifact(path, list(range(args.synthetic)), vectors, "synthetic", args.dtype, ivf_min_rows=0)
+        print(f"Wrote {args.synthetic} x {args.dim} {args.dtype} (nlist={meta.get('nlist')}) in {time.time() - start:.1f}s")
+
+        exact = VectorIndex(path, exact_max=args.synthetic)
+        exact.load()
+        approx = VectorIndex(path, exact_max=0, nprobe=args.nprobe)
+        approx.load()
+        print(f"Mapped: {exact.load_report['mapped_mb']} MB")
+        recall = []
+        for row in rng.integers(0, args.synthetic, size=args.queries):
+            query = exact.vectors_for(np.array([row]))[0]
+            truth = {i for i, _ in exact.search(query, 10)}
+            recall.append(len(truth & {i for i, _ in approx.search(query, 10)}) / 10)
+        print(f"exact: {exact.probe_latency(args.queries)}")
+        print(f"ivf:   {approx.probe_latency(args.queries)}  recall@10={np.mean(recall):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Vector stores that ingest.py writes book embeddings to.
+
+Both stores take Pinecone-shaped records ({"id", "values", "metadata"}) and
+keep each ingestion generation in its own namespace, so a full rebuild
+fills a fresh namespace while the previous one keeps serving (see
+ingest_state.py for which namespace is active):
+
+    pinecone         the `nextchapter-books` Pinecone index
+    file:<dir>       a JSON-lines log per namespace; a local stand-in for tests
+
+Select with VECTOR_STORE or `ingest.py --store`.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+
+class VectorStore:
+    def upsert(self, vectors: List[Dict[str, Any]], namespace: str) -> None:
+        raise NotImplementedError
+
+    def delete(self, ids: List[str], namespace: str) -> None:
+        raise NotImplementedError
+
+    def drop_namespace(self, namespace: str) -> None:
+        raise NotImplementedError
+
+
+class PineconeStore(VectorStore):
+    def __init__(self, api_key: str, index_name: str, dimension: int, ready_timeout: float = 300):
+        from pinecone import Pinecone, ServerlessSpec
+
+        pc = Pinecone(api_key=api_key)
+        if index_name not in pc.list_indexes().names():
+            print(f"Creating new Pinecone index: {index_name} with dimension {dimension}")
+            pc.create_index(
+                name=index_name,
+                dimension=dimension,
+                metric="cosine",
+                spec=ServerlessSpec(cloud="aws", region="us-east-1"),
+            )
+            # Poll for readiness instead of sleeping a fixed amount
+            deadline = time.time() + ready_timeout
+            while not pc.describe_index(index_name).status["ready"]:
+                if time.time() > deadline:
+                    raise TimeoutError(f"Pinecone index '{index_name}' not ready after {ready_timeout}s")
+                time.sleep(1)
+        self.index = pc.Index(index_name)
+
+    def upsert(self, vectors: List[Dict[str, Any]], namespace: str) -> None:
+        self.index.upsert(vectors=vectors, namespace=namespace)
+
+    def delete(self, ids: List[str], namespace: str) -> None:
+        self.index.delete(ids=ids, namespace=namespace)
+
+    def drop_namespace(self, namespace: str) -> None:
+        self.index.delete(delete_all=True, namespace=namespace)
+
+
+class FileVectorStore(VectorStore):
+    """
+    Pinecone stand-in: each namespace is an append-only JSON-lines log of
+    upserts and deletes under `root`; replaying it gives the current records.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, namespace: str) -> str:
+        return os.path.join(self.root, f"{namespace or '_default'}.jsonl")
+
+    def _append(self, namespace: str, entries: List[Dict[str, Any]]) -> None:
+        with self._lock, open(self._path(namespace), "a") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+    def upsert(self, vectors: List[Dict[str, Any]], namespace: str) -> None:
+        self._append(namespace, [{"op": "upsert", **vector} for vector in vectors])
+
+    def delete(self, ids: List[str], namespace: str) -> None:
+        self._append(namespace, [{"op": "delete", "id": vector_id} for vector_id in ids])
+
+    def drop_namespace(self, namespace: str) -> None:
+        with self._lock:
+            if os.path.exists(self._path(namespace)):
+                os.remove(self._path(namespace))
+
+    def records(self, namespace: str) -> Dict[str, Dict[str, Any]]:
+        """id -> {"values", "metadata"} as of the end of the log."""
+        records: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            if not os.path.exists(self._path(namespace)):
+                return records
+            with open(self._path(namespace)) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry["op"] == "upsert":
+                        records[entry["id"]] = {"values": entry["values"], "metadata": entry.get("metadata", {})}
+                    else:
+                        records.pop(entry["id"], None)
+        return records
+
+
+def open_vector_store(spec: str, api_key: str, index_name: str, dimension: int) -> VectorStore:
+    """`pinecone` or `file:<dir>`."""
+    if spec == "pinecone":
+        return PineconeStore(api_key, index_name, dimension)
+    if spec.startswith("file:"):
+        return FileVectorStore(spec[len("file:"):])
+    raise ValueError(f"Unknown vector store: {spec}")
@@ -23,6 +23,7 @@ const Reader = () => {
   const viewerRef = useRef(null);
   const pdfUrlRef = useRef('');
   const messagesEndRef = useRef(null);
+  const chatSessionIdRef = useRef(null);
 
   const {
     loadPdf,
@@ -206,7 +207,7 @@ const Reader = () => {
     
     try {
       // Use local backend proxy to avoid CORS issues
-      const apiUrl = 'http://localhost:8001/api/chat';
+      const apiUrl = 'http://localhost:8001/api/chat/stream';
       
       console.log('Making API call to backend:', apiUrl);
       
@@ -219,22 +220,70 @@ const Reader = () => {
           message: message,
           book_title: bookTitle,
           current_page: currentPage,
-          total_pages: totalPages
+          total_pages: totalPages,
+          session_id: chatSessionIdRef.current
         })
       });
       
-      // Remove loading message
-      setMessages(prev => prev.filter(msg => msg.role !== 'loading'));
-      
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
+        setMessages(prev => prev.filter(msg => msg.role !== 'loading'));
         const errorData = await response.json().catch(() => ({}));
         const errorMessage = errorData.detail || `API Error: ${response.status}`;
         throw new Error(errorMessage);
       }
       
-      const data = await response.json();
-      const aiResponse = data.response || 'Sorry, I could not generate a response.';
-      setMessages(prev => [...prev, { role: 'ai', text: aiResponse }]);
+      // Read Server-Sent Events and append tokens to the AI message as they arrive
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let aiResponse = '';
+      let started = false;
+      
+      const handleEvent = (rawEvent) => {
+        let eventName = 'message';
+        let data = '';
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith('event:')) eventName = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        }
+        if (!data) return;
+        const payload = JSON.parse(data);
+        if (eventName === 'error') {
+          throw new Error(payload.detail || 'Streaming failed');
+        }
+        if (eventName === 'done') {
+          // The server keeps the conversation history for this session
+          chatSessionIdRef.current = payload.session_id || chatSessionIdRef.current;
+          return;
+        }
+        if (payload.token) {
+          aiResponse += payload.token;
+          if (!started) {
+            started = true;
+            setMessages(prev => [...prev.filter(msg => msg.role !== 'loading'), { role: 'ai', text: aiResponse }]);
+          } else {
+            setMessages(prev => [...prev.slice(0, -1), { role: 'ai', text: aiResponse }]);
+          }
+        }
+      };
+      
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          handleEvent(buffer.slice(0, boundary));
+          buffer = buffer.slice(boundary + 2);
+        }
+      }
+      
+      if (!started) {
+        setMessages(prev => [
+          ...prev.filter(msg => msg.role !== 'loading'),
+          { role: 'ai', text: 'Sorry, I could not generate a response.' }
+        ]);
+      }
     } catch (error) {
       // Remove loading message
       setMessages(prev => prev.filter(msg => msg.role !== 'loading'));
@@ -23,6 +23,8 @@ import logger from '../lib/logger';
 
 
 
+const AI_SUGGESTION_URL = import.meta.env.VITE_AI_SUGGESTION_URL;
+
 const TABLE_PREFERENCES = {
   comments: ['book_comments'],
   replies: ['book_comment_replies'],
@@ -747,6 +749,20 @@ const BookDetailPage = () => {
         );
 
       if (error) throw error;
+      // A new rating value doesn't change the history stamp, so drop cached picks explicitly
+      if (AI_SUGGESTION_URL) {
+        supabase.auth.getSession().then(({ data: { session } }) => {
+          if (!session?.access_token) return;
+          return fetch(`${AI_SUGGESTION_URL}/recommendations/invalidate`, {
+            method: 'POST',
+            headers: {
+              'Content-Type': 'application/json',
+              'Authorization': `Bearer ${session.access_token}`,
+            },
+            body: JSON.stringify({ user_id: user.id }),
+          });
+        }).catch(() => {});
+      }
       await loadRatings();
     } catch (error) {
       console.error('Error saving rating:', error);